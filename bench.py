@@ -0,0 +1,382 @@
+# bench.py
+# Offline load test for SmartLink Hub.
+#
+# Seeds synthetic datasets, then drives the real handlers from main.py with
+# fake Update/Context objects and a stub Bot (no network). For every handler
+# it reports throughput, p50/p99 latency, state-lock wait time and save_data
+# cost, and writes everything as JSON so runs can be diffed between revisions.
+#
+#   python bench.py --sizes 10000,100000,1000000 --out bench.json
+#   python bench.py --sizes 10000 --latency-ms 50 --retry-after-rate 0.01
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import resource
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+from itertools import islice
+from types import SimpleNamespace
+from typing import Dict, Any, List
+
+HANDLERS = ("start", "addlinks", "showlinks", "removelink", "leaderboard", "rotation")
+BENCH_CHAT = "-100000000001"
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark SmartLink Hub handlers offline.")
+    p.add_argument("--sizes", default="10000,100000,1000000",
+                   help="comma-separated dataset sizes (users and links each)")
+    p.add_argument("--ops", type=int, default=2000, help="calls per handler")
+    p.add_argument("--concurrency", type=int, default=8, help="handler calls in flight (like UPDATE_WORKERS)")
+    p.add_argument("--backend", choices=("json", "sqlite", "snapshot"), default="json")
+    p.add_argument("--latency-ms", type=float, default=0.0, help="simulated Telegram API latency")
+    p.add_argument("--retry-after-rate", type=float, default=0.0, help="fraction of API calls failing with RetryAfter")
+    p.add_argument("--save-lag-ms", type=int, default=1000, help="SAVE_MAX_LAG_MS for the write-behind flusher")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--workdir", default=None, help="where seeded data files go (default: temp dir)")
+    p.add_argument("--out", default="-", help="JSON results file ('-' for stdout)")
+    return p.parse_args(argv)
+
+# main.py reads its config at import time, so point it at the work dir first
+args = parse_args()
+workdir = args.workdir or tempfile.mkdtemp(prefix="smartlink-bench-")
+os.makedirs(workdir, exist_ok=True)
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["DATA_FILE"] = os.path.join(workdir, "data.json")
+os.environ["SQLITE_FILE"] = os.path.join(workdir, "data.db")
+os.environ["SNAPSHOT_FILE"] = os.path.join(workdir, "data.snap")
+os.environ["EVENTS_FILE"] = os.path.join(workdir, "events.log")
+os.environ["STORAGE_BACKEND"] = args.backend
+os.environ["SAVE_MAX_LAG_MS"] = str(args.save_lag_ms)
+os.environ["OUTBOX_COALESCE_SEC"] = "0"
+os.environ.pop("SHARED_STATE", None)
+
+from telegram.error import RetryAfter
+
+import main
+from metrics import LOCK_WAIT_SECONDS, SAVE_SECONDS
+from storage import open_storage, write_json_atomic, migrate_json_to_sqlite, convert_json_to_snapshot, empty_state
+from records import owner_name
+
+# injected failures are expected here; keep the handlers' logging out of the report
+logging.getLogger("smartlink-hub").setLevel(logging.CRITICAL)
+
+# ---------------------------
+# Stub Telegram objects
+# ---------------------------
+class StubBot:
+    """Records API calls; optionally slow and flaky like the real API."""
+
+    username = "smartlink_bench_bot"
+
+    def __init__(self, latency_ms: float, retry_after_rate: float, rng: random.Random):
+        self.latency = latency_ms / 1000
+        self.retry_after_rate = retry_after_rate
+        self.rng = rng
+        self.calls = 0
+        self.retry_after = 0
+        self._message_id = 0
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.retry_after_rate and self.rng.random() < self.retry_after_rate:
+            self.retry_after += 1
+            raise RetryAfter(1)
+        self._message_id += 1
+        return SimpleNamespace(message_id=self._message_id)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return await self._call()
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        return await self._call()
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return await self._call()
+
+    async def get_me(self):
+        await self._call()
+        return SimpleNamespace(id=0, username=self.username)
+
+class FakeMessage:
+    def __init__(self, bot: StubBot, chat_id: int):
+        self._bot = bot
+        self.chat_id = chat_id
+
+    async def reply_text(self, text, **kwargs):
+        return await self._bot.send_message(self.chat_id, text, **kwargs)
+
+def fake_update(bot: StubBot, user_id: int, cmd_args: List[str]):
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}", first_name=f"User {user_id}")
+    update = SimpleNamespace(
+        effective_user=user,
+        effective_chat=SimpleNamespace(id=user_id, type="private"),
+        message=FakeMessage(bot, user_id),
+        callback_query=None,
+    )
+    context = SimpleNamespace(bot=bot, args=cmd_args)
+    return update, context
+
+# ---------------------------
+# Dataset seeding
+# ---------------------------
+def seed_state(size: int, rng: random.Random) -> Dict[str, Any]:
+    """`size` users with a skewed invite distribution and `size` links."""
+    state = empty_state(main.DEFAULT_INTERVAL_MIN)
+    users = state["users"]
+    for uid in range(2, size + 2):
+        invites = min(int(rng.paretovariate(1.2)) - 1, 500)
+        users[str(uid)] = {
+            "username": f"user{uid}",
+            "token": f"t{uid:x}",
+            "invites": invites,
+            "links_added": 0,
+            "limit": main.compute_limit_from_invites(invites),
+            "interval": None,
+        }
+        state["referrals"][f"t{uid:x}"] = uid
+    added_at = "2024-01-01T00:00:00Z"
+    for link_id in range(1, size + 1):
+        owner = rng.randrange(2, size + 2)
+        u = users[str(owner)]
+        u["links_added"] += 1
+        u["limit"] = max(u["limit"], u["links_added"])
+        state["links"].append({
+            "id": link_id,
+            "link": f"https://t.me/+bench{link_id}",
+            "owner_id": owner,
+            "owner_username": u["username"],
+            "added_at": added_at,
+        })
+    return state
+
+def install_store(size: int, rng: random.Random) -> Dict[str, float]:
+    """Seed the data files for `size` and point main.py at a fresh Store."""
+    started = time.perf_counter()
+    state = seed_state(size, rng)
+    events_file = os.environ["EVENTS_FILE"]
+    for path in (os.environ["DATA_FILE"], os.environ["SQLITE_FILE"], os.environ["SNAPSHOT_FILE"],
+                 events_file, os.path.splitext(events_file)[0] + ".rollup.json"):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    write_json_atomic(os.environ["DATA_FILE"], state)
+    del state
+    if args.backend == "sqlite":
+        migrate_json_to_sqlite(os.environ["DATA_FILE"], os.environ["SQLITE_FILE"])
+    elif args.backend == "snapshot":
+        convert_json_to_snapshot(os.environ["DATA_FILE"], os.environ["SNAPSHOT_FILE"])
+    seeded = time.perf_counter()
+    main.store.backend.close()
+    main.store = main.Store(open_storage(
+        args.backend, os.environ["DATA_FILE"], os.environ["SQLITE_FILE"], os.environ["SNAPSHOT_FILE"]))
+    main.persister = main.WriteBehind(main.store, args.save_lag_ms, main.SAVE_MAX_PENDING)
+    main.scheduler = main.RotationScheduler()
+    main.events = main.EventLog(events_file, main.EVENTS_RAW_DAYS, main.EVENTS_KEEP_DAYS)
+    loaded = time.perf_counter()
+    return {"seed_seconds": round(seeded - started, 3), "load_seconds": round(loaded - seeded, 3)}
+
+# ---------------------------
+# Workloads
+# ---------------------------
+def workload(name: str, size: int, ops: int, rng: random.Random):
+    """Yields (handler, user_id, args) for one phase."""
+    existing = lambda: rng.randrange(2, size + 2)
+    for i in range(ops):
+        if name == "start":
+            # new users, most arriving through someone's referral link
+            ref = [f"t{existing():x}"] if rng.random() < 0.8 else []
+            yield main.cmd_start, size + 2 + i, ref
+        elif name == "addlinks":
+            uid = existing()
+            yield main.cmd_addlinks, uid, [f"https://t.me/+new{uid}x{i}x{j}" for j in range(rng.randint(1, 3))]
+        elif name == "showlinks":
+            yield main.cmd_showlinks, existing(), []
+        elif name == "removelink":
+            yield main.cmd_removelink, existing(), ["1"]
+        elif name == "leaderboard":
+            yield main.cmd_leaderboard, existing(), []
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def lock_totals():
+    # read straight from the lock-wait histograms the bot exports
+    children = [LOCK_WAIT_SECONDS.labels(kind) for kind in ("user", "pool", "settings")]
+    return sum(c.sum for c in children), sum(c.count for c in children)
+
+def save_totals():
+    return SAVE_SECONDS.labels("capture").sum, SAVE_SECONDS.labels("write").sum
+
+async def run_phase(name: str, size: int, bot: StubBot, rng: random.Random) -> Dict[str, Any]:
+    persister = main.persister
+    wait0, acq0 = lock_totals()
+    flushes0 = persister.flushes
+    capture0, write0 = save_totals()
+    calls0, retry0 = bot.calls, bot.retry_after
+    latencies, errors = [], 0
+    started = time.perf_counter()
+
+    if name == "rotation":
+        # rotation posts are serial per chat; drive rotate_chat back to back
+        main.store.update_chat(BENCH_CHAT, interval=1, policy="fair", paused=False, next_due=None)
+        for _ in range(args.ops):
+            t = time.perf_counter()
+            try:
+                await main.rotate_chat(bot, BENCH_CHAT, time.time())
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - t)
+        main.scheduler.cancel(BENCH_CHAT)
+    else:
+        jobs = workload(name, size, args.ops, rng)
+
+        async def worker():
+            nonlocal errors
+            for handler, user_id, cmd_args in jobs:
+                update, context = fake_update(bot, user_id, cmd_args)
+                t = time.perf_counter()
+                try:
+                    await handler(update, context)
+                except Exception:
+                    errors += 1   # e.g. injected RetryAfter on the reply
+                latencies.append(time.perf_counter() - t)
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+    # notices and rotation posts go out through the dispatcher; count them in
+    await main.outbox.join(30)
+    elapsed = time.perf_counter() - started
+    # whatever the phase left dirty is part of its cost
+    await persister.flush()
+    wait1, acq1 = lock_totals()
+    capture1, write1 = save_totals()
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        "lock_wait_ms": round((wait1 - wait0) * 1000, 3),
+        "lock_acquisitions": acq1 - acq0,
+        "save": {
+            "flushes": persister.flushes - flushes0,
+            "capture_ms": round((capture1 - capture0) * 1000, 3),
+            "write_ms": round((write1 - write0) * 1000, 3),
+        },
+        "api_calls": bot.calls - calls0,
+        "retry_after": bot.retry_after - retry0,
+    }
+
+async def measure_save(rounds: int = 5) -> Dict[str, Any]:
+    """Cost of one flush after a single-user change (full rewrite for JSON)."""
+    persister = main.persister
+    timings = []
+    for i in range(rounds):
+        main.store.add_invite(2 + i)
+        t = time.perf_counter()
+        await persister.flush()
+        timings.append(time.perf_counter() - t)
+    timings.sort()
+    path = {"json": os.environ["DATA_FILE"], "sqlite": os.environ["SQLITE_FILE"],
+            "snapshot": os.environ["SNAPSHOT_FILE"]}[args.backend]
+    return {
+        "rounds": rounds,
+        "p50_ms": round(percentile(timings, 0.5) * 1000, 3),
+        "max_ms": round(timings[-1] * 1000, 3),
+        "file_bytes": os.path.getsize(path),
+    }
+
+def object_bytes(obj) -> int:
+    """getsizeof of a record plus the field values it owns (small ints and None are shared)."""
+    values = obj.values() if isinstance(obj, dict) else (getattr(obj, f) for f in obj.__slots__)
+    total = sys.getsizeof(obj)
+    for v in values:
+        if isinstance(v, (str, float)) or (isinstance(v, int) and not -5 <= v <= 256):
+            total += sys.getsizeof(v)
+    return total
+
+def measure_memory(sample: int = 2000) -> Dict[str, Any]:
+    """Bytes per user / per link: in-memory records vs the JSON-shaped dicts they replaced."""
+    store = main.store
+    # mmap-backed users (snapshot backend) only become objects when touched
+    resident = getattr(store.users, "decoded", len(store.users))
+    users = list(islice(store.users.items(), sample))
+    links = list(islice(store.links, sample))
+    per_entry = sys.getsizeof(store.users) / max(1, len(store.users))
+    avg = lambda xs: round(sum(xs) / max(1, len(xs)), 1)
+    return {
+        "resident_users": resident,
+        "bytes_per_user": avg([per_entry + sys.getsizeof(uid) + object_bytes(u) for uid, u in users]),
+        "bytes_per_link": avg([object_bytes(l) for l in links]),
+        # the pre-records layout: str user id keys, dict links carrying owner_username and an ISO added_at
+        "dict_bytes_per_user": avg([per_entry + sys.getsizeof(str(uid)) + object_bytes(u.to_json()) for uid, u in users]),
+        "dict_bytes_per_link": avg([object_bytes(l.to_json(owner_name(store.users, l.owner_id))) for l in links]),
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+async def run_dataset(size: int) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    result = {"size": size, **install_store(size, rng)}
+    result["memory"] = measure_memory()
+    log(f"  memory: {result['memory']['bytes_per_user']} B/user, {result['memory']['bytes_per_link']} B/link "
+        f"(dicts: {result['memory']['dict_bytes_per_user']} / {result['memory']['dict_bytes_per_link']})")
+    bot = StubBot(args.latency_ms, args.retry_after_rate, rng)
+    result["handlers"] = {}
+    main.outbox = main.Outbox(main.OUTBOX_CONCURRENCY, main.OUTBOX_MAX_ATTEMPTS)
+    main.outbox.start(bot)
+    for name in HANDLERS:
+        result["handlers"][name] = await run_phase(name, size, bot, rng)
+        log(f"  {name:<12} {result['handlers'][name]['throughput']:>10} ops/s  "
+            f"p50 {result['handlers'][name]['p50_ms']:>8} ms  p99 {result['handlers'][name]['p99_ms']:>8} ms")
+    result["save_data"] = await measure_save()
+    await main.outbox.stop(0)
+    await main.persister.close()
+    return result
+
+def log(msg: str):
+    print(msg, file=sys.stderr, flush=True)
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+async def run() -> Dict[str, Any]:
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "backend": args.backend,
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "workdir")},
+        "datasets": [],
+    }
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        log(f"dataset {size} ({args.backend})")
+        report["datasets"].append(await run_dataset(size))
+    return report
+
+if __name__ == "__main__":
+    report = asyncio.run(run())
+    raw = json.dumps(report, indent=2)
+    if args.out == "-":
+        print(raw)
+    else:
+        with open(args.out, "w") as f:
+            f.write(raw + "\n")
+        log(f"results written to {args.out}")
@@ -0,0 +1,264 @@
+# events.py
+# Append-only rotation/referral event log with daily rollups for SmartLink Hub.
+#
+# Every rotation post and every referral is appended as one JSON line to
+# events.log. Rollups per UTC day (posts per owner, invites per referrer,
+# total queue wait from added_at to post) are folded in as lines are read,
+# so /status and /stats cost O(days) and never rescan history.
+#
+# Reading is incremental: catch_up() only parses bytes appended since the
+# last call, so several processes (SHARED_STATE=1) can append to the same
+# file and each one's rollups pick up the others' events. compact() folds
+# raw events older than `raw_days` into events.rollup.json and rewrites the
+# log without them; other processes notice the new inode and reload.
+#
+# Appends, catch_up() and the queries do file I/O and are meant to run on one
+# worker thread (main.py's events executor), never on the event loop;
+# compact() may run concurrently on another thread.
+import os
+import json
+import time
+import fcntl
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from storage import write_atomic
+
+logger = logging.getLogger("smartlink-hub")
+
+DAY = 86400
+
+def day_of(ts: float) -> int:
+    return int(ts // DAY)
+
+def day_label(day: int) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(day * DAY))
+
+def new_bucket() -> Dict[str, Any]:
+    return {"posts": {}, "invites": {}, "wait_sum": 0.0, "wait_n": 0}
+
+def fold(days: Dict[int, Dict[str, Any]], event: Dict[str, Any]):
+    """Add one raw event to the per-day rollups."""
+    day = day_of(event["ts"])
+    b = days.get(day)
+    if b is None:
+        b = days[day] = new_bucket()
+    if event["type"] == "post":
+        owner = event["owner_id"]
+        b["posts"][owner] = b["posts"].get(owner, 0) + 1
+        if event.get("wait") is not None:
+            b["wait_sum"] += event["wait"]
+            b["wait_n"] += 1
+    elif event["type"] == "invite":
+        ref = event["referrer_id"]
+        b["invites"][ref] = b["invites"].get(ref, 0) + 1
+
+def rollup_to_json(until: float, days: Dict[int, Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "until": until,
+        "days": {str(d): {"posts": {str(k): v for k, v in b["posts"].items()},
+                          "invites": {str(k): v for k, v in b["invites"].items()},
+                          "wait_sum": b["wait_sum"], "wait_n": b["wait_n"]}
+                 for d, b in days.items()},
+    }
+
+def rollup_from_json(raw: Dict[str, Any]) -> Tuple[float, Dict[int, Dict[str, Any]]]:
+    days = {}
+    for d, b in raw.get("days", {}).items():
+        days[int(d)] = {"posts": {int(k): v for k, v in b["posts"].items()},
+                        "invites": {int(k): v for k, v in b["invites"].items()},
+                        "wait_sum": b["wait_sum"], "wait_n": b["wait_n"]}
+    return raw.get("until", 0.0), days
+
+class EventLog:
+    def __init__(self, path: str, raw_days: int = 7, keep_days: int = 400):
+        self.path = path
+        self.rollup_path = os.path.splitext(path)[0] + ".rollup.json"
+        self.raw_days = raw_days
+        self.keep_days = keep_days
+        self.days: Dict[int, Dict[str, Any]] = {}   # day number -> rollup bucket (compacted + raw)
+        self.until = 0.0        # events at or before this are in the rollup file, not the log
+        self.oldest_raw = None  # ts of the oldest event still in the raw log
+        self._inode = None
+        self._offset = 0
+        self._mutex = threading.Lock()   # catch_up() vs compact(), which runs in another thread
+        self.catch_up()
+
+    @contextmanager
+    def _locked(self):
+        # serializes appends against compaction across processes
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # --- writing ---
+    def record_post(self, owner_id: int, link_id: int, chat_id, added_at: int, ts: float = None):
+        ts = time.time() if ts is None else ts
+        self._append({"ts": ts, "type": "post", "owner_id": owner_id, "link_id": link_id,
+                      "chat_id": chat_id, "wait": max(0.0, ts - added_at) if added_at else None})
+
+    def record_invite(self, referrer_id: int, user_id: int, ts: float = None):
+        self._append({"ts": time.time() if ts is None else ts, "type": "invite",
+                      "referrer_id": referrer_id, "user_id": user_id})
+
+    def _append(self, event: Dict[str, Any]):
+        line = (json.dumps(event, separators=(",", ":")) + "\n").encode()
+        with self._locked():
+            with open(self.path, "ab") as f:
+                f.write(line)
+        self.catch_up()
+
+    # --- reading ---
+    def catch_up(self):
+        """Fold in whatever was appended since the last call (by any process)."""
+        with self._mutex:
+            self._catch_up()
+
+    def _catch_up(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            if self._inode is None:
+                self._reload_rollup()
+                self._inode = 0
+            return
+        if st.st_ino != self._inode:
+            # first call, or the log was compacted and replaced
+            self._reload_rollup()
+            self._inode, self._offset = st.st_ino, 0
+        if st.st_size <= self._offset:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            data = f.read(st.st_size - self._offset)
+        end = data.rfind(b"\n") + 1   # leave a partially written last line for next time
+        for line in data[:end].splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping corrupt event line in %s", self.path)
+                continue
+            if event["ts"] <= self.until:
+                continue   # already folded in by a compaction that crashed before swapping the log
+            if self.oldest_raw is None or event["ts"] < self.oldest_raw:
+                self.oldest_raw = event["ts"]
+            fold(self.days, event)
+        self._offset += end
+
+    def _reload_rollup(self):
+        try:
+            with open(self.rollup_path, "r", encoding="utf-8") as f:
+                self.until, self.days = rollup_from_json(json.load(f))
+        except FileNotFoundError:
+            self.until, self.days = 0.0, {}
+        self.oldest_raw = None
+
+    # --- compaction ---
+    def compact(self, now: float = None) -> int:
+        """Fold raw events older than raw_days into the rollup file and drop
+        them from the log; day buckets older than keep_days are discarded.
+        Returns the number of events compacted.
+
+        The log is read and the replacement written without any lock; the
+        cross-process lock is only held for the swap, to copy over lines
+        appended meanwhile. The in-memory rollups are left alone: the next
+        catch_up() sees the new inode and reloads.
+        """
+        now = time.time() if now is None else now
+        cutoff = (day_of(now) - self.raw_days) * DAY
+        with self._mutex:
+            if self.oldest_raw is None or self.oldest_raw >= cutoff:
+                return 0
+            until = self.until
+        try:
+            with open(self.rollup_path, "r", encoding="utf-8") as f:
+                _, base = rollup_from_json(json.load(f))
+        except FileNotFoundError:
+            base = {}
+        tmp = self.path + ".compact"
+        folded = offset = 0
+        try:
+            with open(self.path, "rb") as src, open(tmp, "wb") as out:
+                inode = os.fstat(src.fileno()).st_ino
+                for line in src:
+                    if not line.endswith(b"\n"):
+                        break   # partial last line: it goes over with the tail
+                    offset += len(line)
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        continue
+                    if event["ts"] <= until:
+                        continue
+                    if event["ts"] < cutoff:
+                        fold(base, event)
+                        folded += 1
+                    else:
+                        out.write(line)
+                out.flush()
+                os.fsync(out.fileno())
+        except FileNotFoundError:
+            return 0
+        horizon = day_of(now) - self.keep_days
+        rollup = json.dumps(rollup_to_json(cutoff - 1e-6, {d: b for d, b in base.items() if d >= horizon}))
+        with self._locked():
+            try:
+                if os.stat(self.path).st_ino != inode:
+                    os.remove(tmp)   # replaced under us (another compactor)
+                    return 0
+                with open(self.path, "rb") as src:
+                    src.seek(offset)
+                    tail = src.read()
+            except FileNotFoundError:
+                os.remove(tmp)
+                return 0
+            with open(tmp, "ab") as out:
+                out.write(tail)
+                out.flush()
+                os.fsync(out.fileno())
+            # rollup first: if we crash before the log swap, `until` keeps the
+            # old lines from being counted twice
+            write_atomic(self.rollup_path, rollup.encode())
+            os.replace(tmp, self.path)
+        return folded
+
+    # --- queries (O(days)) ---
+    def _range(self, days: Optional[int], now: float):
+        today = day_of(now)
+        first = today - days + 1 if days else None
+        for d, b in self.days.items():
+            if first is None or first <= d <= today:
+                yield d, b
+
+    def owner_posts(self, owner_id: int, days: Optional[int] = None, now: float = None) -> int:
+        return sum(b["posts"].get(owner_id, 0) for _, b in self._range(days, now or time.time()))
+
+    def user_invites(self, user_id: int, days: Optional[int] = None, now: float = None) -> int:
+        return sum(b["invites"].get(user_id, 0) for _, b in self._range(days, now or time.time()))
+
+    def daily(self, days: int, now: float = None) -> List[Dict[str, Any]]:
+        """Per-day totals for the last `days` days, newest first."""
+        now = now or time.time()
+        today = day_of(now)
+        out = []
+        for d in range(today, today - days, -1):
+            b = self.days.get(d) or new_bucket()
+            out.append({
+                "day": day_label(d),
+                "posts": sum(b["posts"].values()),
+                "invites": sum(b["invites"].values()),
+                "avg_wait": b["wait_sum"] / b["wait_n"] if b["wait_n"] else None,
+            })
+        return out
+
+    def top_owners(self, days: int, n: int = 5, now: float = None) -> List[Tuple[int, int]]:
+        totals: Dict[int, int] = {}
+        for _, b in self._range(days, now or time.time()):
+            for owner, count in b["posts"].items():
+                totals[owner] = totals.get(owner, 0) + count
+        return sorted(totals.items(), key=lambda kv: -kv[1])[:n]
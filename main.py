@@ -1,31 +1,110 @@
 # main.py
 import os
+import copy
+import gzip
 import json
+import atexit
+import heapq
+import socket
+import functools
+import bisect
 import asyncio
 import logging
+import random
 import secrets
+import itertools
+import threading
+import traceback
+import contextvars
+import time
+from collections import deque, OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from contextlib import asynccontextmanager, AsyncExitStack
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional
 
 from fastapi import FastAPI, Request, Response
 from telegram import Update, Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import TelegramError, RetryAfter, Forbidden, BadRequest, NetworkError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
     ContextTypes,
     CallbackQueryHandler,
+    TypeHandler,
+    ApplicationHandlerStop,
+)
+
+from storage import Storage, ChangeSet, DatabaseBusy, open_storage, freeze, invite_counts, write_atomic
+from records import User, Link, state_to_json
+from events import EventLog
+from metrics import (
+    registry, CONTENT_TYPE, HANDLER_SECONDS, HANDLER_ERRORS, LOCK_WAIT_SECONDS, LOCK_HOLD_SECONDS,
+    SAVE_SECONDS, SAVE_BYTES, TELEGRAM_SECONDS, TELEGRAM_ERRORS, ROTATION_LAG_SECONDS, LINKS_SUBMITTED,
+    THROTTLED, OUTBOX_MESSAGES,
 )
 
 # ---------------------------
 # CONFIG (via env vars)
 # ---------------------------
-BOT_TOKEN = os.getenv("8423955356:AAFT6lTDIMkMsFnLLSPotJYSVuY619Rh-Bc")            # Bot token from BotFather
+BOT_TOKEN = os.getenv("BOT_TOKEN")            # Bot token from BotFather
 ADMIN_ID = int(os.getenv("ADMIN_ID", "5841736888"))   # Your Telegram user id (owner)
 SERVICE_URL = os.getenv("SERVICE_URL", "")   # e.g. https://your-app.onrender.com
-DATA_FILE = "data.json"
+DATA_FILE = os.getenv("DATA_FILE", "data.json")
 BACKUP_INTERVAL_HOURS = int(os.getenv("BACKUP_INTERVAL_HOURS", "6"))
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP_HOURLY = int(os.getenv("BACKUP_KEEP_HOURLY", "24"))   # newest backup of each of the last N hours
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY", "7"))      # newest backup of each of the last M days
 WEBHOOK_PATH = f"/{BOT_TOKEN}"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")   # optional X-Telegram-Bot-Api-Secret-Token check
+BOT_MODE = os.getenv("BOT_MODE", "webhook")       # "webhook" (behind uvicorn) or "polling" (local runs)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))   # concurrent update handlers
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))   # recent update_ids remembered for redelivery
+WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("WEBHOOK_ENQUEUE_TIMEOUT", "2"))   # then 503 so Telegram retries
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
 DEFAULT_INTERVAL_MIN = int(os.getenv("DEFAULT_INTERVAL_MIN", "30"))
+ROTATION_POLICIES = ("fifo", "fair")
+# Write-behind persistence: mutations are coalesced and flushed in the background.
+# SAVE_MAX_LAG_MS bounds how long an acknowledged change may live only in memory
+# (0 = write-through, every save_data() hits disk before returning).
+SAVE_MAX_LAG_MS = int(os.getenv("SAVE_MAX_LAG_MS", "1000"))
+SAVE_MAX_PENDING = int(os.getenv("SAVE_MAX_PENDING", "500"))   # flush early after this many mutations
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")   # "json" (data.json), "sqlite" or "snapshot" (binary, lazy)
+SQLITE_FILE = os.getenv("SQLITE_FILE", "data.db")
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "data.snap")   # created from DATA_FILE on first start
+# Multi-process mode (uvicorn --workers N): state shared through SQLite,
+# background workers run only on the process holding the leader lease.
+SHARED_STATE = os.getenv("SHARED_STATE", "") == "1"
+LEADER_LEASE_SEC = float(os.getenv("LEADER_LEASE_SEC", "15"))
+SHARED_POLL_SEC = float(os.getenv("SHARED_POLL_SEC", "1"))   # leader picks up other workers' changes this often
+CHANGELOG_KEEP = int(os.getenv("CHANGELOG_KEEP", "100000"))
+SHARED_BUSY_TIMEOUT_MS = int(os.getenv("SHARED_BUSY_TIMEOUT_MS", "20"))   # longest a write may block the loop on another worker's lock
+SHARED_BUSY_WAIT_SEC = float(os.getenv("SHARED_BUSY_WAIT_SEC", "5"))      # after that it retries asynchronously for up to this long
+BOT_IDENTITY_REFRESH_MIN = int(os.getenv("BOT_IDENTITY_REFRESH_MIN", "60"))   # re-read the bot's username this often
+EVENTS_FILE = os.getenv("EVENTS_FILE", "events.log")   # append-only rotation/referral history
+EVENTS_RAW_DAYS = int(os.getenv("EVENTS_RAW_DAYS", "7"))      # older raw events are folded into daily rollups
+EVENTS_KEEP_DAYS = int(os.getenv("EVENTS_KEEP_DAYS", "400"))  # daily rollups kept this long
+USER_LOCK_STRIPES = int(os.getenv("USER_LOCK_STRIPES", "64"))
+LOCK_DEBUG = os.getenv("LOCK_DEBUG", "") == "1"   # log Telegram calls made while holding a state lock
+LINK_DEDUP_WINDOW_HOURS = float(os.getenv("LINK_DEDUP_WINDOW_HOURS", "24"))   # rotated links can't be re-added for this long
+MAX_LINK_LENGTH = int(os.getenv("MAX_LINK_LENGTH", "512"))
+RATE_USER_PER_MIN = float(os.getenv("RATE_USER_PER_MIN", "20"))   # commands/callbacks per user, sustained
+RATE_USER_BURST = int(os.getenv("RATE_USER_BURST", "5"))
+RATE_GLOBAL_PER_SEC = float(os.getenv("RATE_GLOBAL_PER_SEC", "50"))   # across all non-admin users
+RATE_GLOBAL_BURST = int(os.getenv("RATE_GLOBAL_BURST", "100"))
+RATE_MAX_BUCKETS = int(os.getenv("RATE_MAX_BUCKETS", "10000"))   # least recently seen users are evicted
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", os.getenv("BROADCAST_RATE", "25")))   # all sends, messages/second (Telegram allows ~30)
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "2"))   # seconds, doubled per failed attempt
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "600"))
+OUTBOX_COALESCE_SEC = float(os.getenv("OUTBOX_COALESCE_SEC", "3"))   # mergeable notices wait this long for company
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_CHECKPOINT_EVERY = int(os.getenv("BROADCAST_CHECKPOINT_EVERY", "100"))
+BROADCAST_REPORT_SEC = int(os.getenv("BROADCAST_REPORT_SEC", "10"))
 # ---------------------------
 
 logging.basicConfig(level=logging.INFO)
@@ -36,59 +115,1027 @@ app = FastAPI()
 # ---------------------------
 # Persistent storage helpers
 # ---------------------------
-def init_data():
-    if not os.path.exists(DATA_FILE):
-        base = {
-            "settings": {
-                "chat_id": None,
-                "interval": DEFAULT_INTERVAL_MIN,
-                "running": False,
-                "last_link": None,
-                "rotation_index": 0
-            },
-            # links: list of { "link": str, "owner_id": int, "owner_username": str, "added_at": iso }
-            "links": [],
-            # users: userid -> { "username": str, "token": str, "invites": int, "links_added": int, "limit": int, "interval": None }
-            "users": {},
-            # referrals: token -> referrer_userid
-            "referrals": {}
+TELEGRAM_HOSTS = {"t.me", "telegram.me", "telegram.dog"}
+TRACKING_PARAMS = ("utm_", "fbclid", "gclid")
+
+def canonical_url(raw: str) -> Optional[str]:
+    """Normalized form of a submitted link, or None if it isn't a usable URL.
+
+    Scheme and host are lowercased, default ports, fragments, trailing
+    slashes and tracking parameters are dropped and the query is sorted.
+    Telegram hosts collapse to https://t.me and t.me/joinchat/X to t.me/+X,
+    so the same invite link always maps to the same string.
+    """
+    raw = raw.strip()
+    if not raw or len(raw) > MAX_LINK_LENGTH or any(c.isspace() for c in raw):
+        return None
+    if "://" not in raw:
+        raw = "https://" + raw
+    try:
+        parts = urlsplit(raw)
+        port = parts.port
+    except ValueError:
+        return None
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    if scheme not in ("http", "https") or "." not in host or parts.username is not None:
+        return None
+    if host.startswith("www."):
+        host = host[4:]
+    path = parts.path.rstrip("/")
+    if host in TELEGRAM_HOSTS:
+        scheme, host = "https", "t.me"
+        if path.startswith("/joinchat/"):
+            path = "/+" + path[len("/joinchat/"):]
+    if port is not None and port != {"http": 80, "https": 443}[scheme]:
+        host = f"{host}:{port}"
+    query = urlencode(sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                             if not k.lower().startswith(TRACKING_PARAMS)))
+    return urlunsplit((scheme, host, path, query, ""))
+
+class RecentLinks:
+    """Links rotated out within the last `window` seconds.
+
+    A dict gives O(1) membership; a FIFO of expiry times lets expired entries
+    be dropped in amortized O(1) as new ones arrive.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._expires = {}    # url -> expiry epoch
+        self._order = deque()  # (expiry, url), ascending
+
+    def __len__(self):
+        return len(self._expires)
+
+    def add(self, url: str, now: float):
+        expires = now + self.window
+        self._expires[url] = expires
+        self._order.append((expires, url))
+        self._prune(now)
+
+    def seen(self, url: str, now: float) -> bool:
+        self._prune(now)
+        return url in self._expires
+
+    def _prune(self, now: float):
+        order, expires = self._order, self._expires
+        while order and order[0][0] <= now:
+            t, url = order.popleft()
+            if expires.get(url) == t:
+                del expires[url]
+
+class LinkPool:
+    """The rotation pool: a FIFO queue plus an owner_id -> links index.
+
+    Removal from the middle of the queue (/removelink) only drops the link
+    from the live maps and leaves a tombstone in the deque, so append,
+    popleft, per-owner lookups and removal are all O(1) / O(k). Tombstones
+    are compacted away once they outnumber live links. A ring of owners
+    backs the "fair" (round-robin by owner) rotation policy, and a URL ->
+    count map answers "is this link already queued" for deduplication.
+    """
+
+    def __init__(self, links=()):
+        self._queue = deque()
+        self._live = {}       # link id -> link
+        self._by_owner = {}   # owner_id -> {link id: link}, insertion ordered
+        self._tombstones = 0
+        self._ring = deque()  # owners in round-robin order (may hold owners with no links left)
+        self._in_ring = set()
+        self._urls = {}       # link text -> live links with that text
+        for l in links:
+            self.append(l)
+
+    def __len__(self):
+        return len(self._live)
+
+    def __iter__(self):
+        # live links in rotation order (used for persistence snapshots)
+        live = self._live
+        return (l for l in self._queue if l.id in live)
+
+    def append(self, link: Link):
+        self._queue.append(link)
+        self._live[link.id] = link
+        self._by_owner.setdefault(link.owner_id, {})[link.id] = link
+        self._urls[link.link] = self._urls.get(link.link, 0) + 1
+        if link.owner_id not in self._in_ring:
+            self._in_ring.add(link.owner_id)
+            self._ring.append(link.owner_id)
+
+    def popleft(self) -> Optional[Link]:
+        while self._queue:
+            link = self._queue.popleft()
+            if link.id in self._live:
+                self._unindex(link)
+                return link
+            self._tombstones -= 1
+        return None
+
+    def pop_oldest(self, eligible=None, scan_limit: int = 1000) -> Optional[Link]:
+        """FIFO policy: the oldest link whose owner passes `eligible(owner_id)`.
+
+        Only the first `scan_limit` queue entries are considered when owners
+        are cooling down, so a pool full of throttled owners stays cheap.
+        """
+        if eligible is None:
+            return self.popleft()
+        for i, link in enumerate(self._queue):
+            if i >= scan_limit:
+                break
+            if link.id in self._live and eligible(link.owner_id):
+                break
+        else:
+            return None
+        if i >= scan_limit:
+            return None
+        if i == 0:
+            return self.popleft()
+        self.remove(link)
+        return link
+
+    def pop_fair(self, eligible=None) -> Optional[Link]:
+        """Fair policy: the oldest link of the next owner in round-robin order."""
+        for _ in range(len(self._ring)):
+            owner = self._ring.popleft()
+            owned = self._by_owner.get(owner)
+            if not owned:
+                self._in_ring.discard(owner)
+                continue
+            self._ring.append(owner)
+            if eligible is not None and not eligible(owner):
+                continue
+            link = next(iter(owned.values()))
+            self.remove(link)
+            return link
+        return None
+
+    def remove(self, link: Link) -> bool:
+        if link.id not in self._live:
+            return False
+        self._unindex(link)
+        self._tombstones += 1
+        if self._tombstones > 1024 and self._tombstones > len(self._live):
+            self._queue = deque(self)
+            self._tombstones = 0
+        return True
+
+    def _unindex(self, link: Link):
+        del self._live[link.id]
+        owned = self._by_owner[link.owner_id]
+        del owned[link.id]
+        if not owned:
+            del self._by_owner[link.owner_id]
+        n = self._urls[link.link] - 1
+        if n:
+            self._urls[link.link] = n
+        else:
+            del self._urls[link.link]
+
+    def owner_links(self, owner_id: int) -> List[Link]:
+        return list(self._by_owner.get(owner_id, {}).values())
+
+    def owner_count(self, owner_id: int) -> int:
+        return len(self._by_owner.get(owner_id, ()))
+
+    def get(self, link_id: int) -> Optional[Link]:
+        return self._live.get(link_id)
+
+    def has_url(self, url: str) -> bool:
+        return url in self._urls
+
+class Leaderboard:
+    """Invite ranking maintained incrementally as invites come in.
+
+    Users sit in per-invite-count buckets (insertion ordered, so ties keep the
+    order in which users reached that count) and a Fenwick tree over the
+    counts answers "how many users are ahead of me" in O(log max_invites).
+    The rendered /leaderboard text is cached until something that could
+    change the top K happens.
+    """
+
+    def __init__(self, size: int = 10):
+        self.size = size
+        self._buckets = {}    # invites -> {user id: None}
+        self._counts = []     # distinct invite counts, ascending
+        self._tree = [0] * 65  # Fenwick tree over invite counts (1-based)
+        self._total = 0
+        self._cutoff = -1     # invites of the last entry in the cached top K (-1 = fewer than K users)
+        self._shown = set()   # uids in the cached top K
+        self.text = None      # cached rendered leaderboard
+
+    def _tree_add(self, invites: int, delta: int):
+        i = invites + 1
+        if i >= len(self._tree):
+            # double and rebuild from the buckets (amortized O(1) per invite)
+            self._tree = [0] * (2 * i + 1)
+            for c, bucket in self._buckets.items():
+                self._tree_add(c, len(bucket))
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _tree_prefix(self, invites: int) -> int:
+        # users with invites <= `invites`
+        i, s = min(invites + 1, len(self._tree) - 1), 0
+        while i > 0:
+            s += self._tree[i]
+            i -= i & -i
+        return s
+
+    def _place(self, uid: int, invites: int):
+        # tree first: a resize rebuilds from buckets that must not include uid yet
+        self._tree_add(invites, 1)
+        bucket = self._buckets.get(invites)
+        if bucket is None:
+            bucket = self._buckets[invites] = {}
+            bisect.insort(self._counts, invites)
+        bucket[uid] = None
+
+    def _unplace(self, uid: int, invites: int):
+        bucket = self._buckets[invites]
+        del bucket[uid]
+        if not bucket:
+            del self._buckets[invites]
+            del self._counts[bisect.bisect_left(self._counts, invites)]
+        self._tree_add(invites, -1)
+
+    def add(self, uid: int, invites: int = 0):
+        self._place(uid, invites)
+        self._total += 1
+        # newcomers queue behind existing ties, so only a strictly higher
+        # count can push into the cached top K
+        if invites > self._cutoff:
+            self.text = None
+
+    def bump(self, uid: int, old: int, new: int):
+        self._unplace(uid, old)
+        self._place(uid, new)
+        if new > self._cutoff or uid in self._shown:
+            self.text = None
+
+    def touch(self, uid: int):
+        # display data (username) changed
+        if uid in self._shown:
+            self.text = None
+
+    def top(self) -> List[int]:
+        out = []
+        for invites in reversed(self._counts):
+            for uid in self._buckets[invites]:
+                out.append(uid)
+                if len(out) == self.size:
+                    return out
+        return out
+
+    def rank(self, invites: int) -> int:
+        """1-based rank of a user with `invites` (ties share the best rank)."""
+        return self._total - self._tree_prefix(invites) + 1
+
+    def remember(self, text: str, shown: List[int], cutoff: int):
+        self.text = text
+        self._shown = set(shown)
+        self._cutoff = cutoff if len(shown) == self.size else -1
+
+def mutation(method):
+    """Marks a Store mutator.
+
+    In shared (multi-process) mode the call runs inside one SQLite write
+    transaction: catch up with other processes first, mutate, then write the
+    touched rows plus changelog entries before committing. Nested mutator
+    calls join the outer transaction. In single-process mode this is a no-op
+    and persistence goes through the write-behind flusher.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.shared_pid is None or self._txn_depth:
+            return method(self, *args, **kwargs)
+        self.backend.begin()   # may raise DatabaseBusy; see mutate()
+        self._txn_depth += 1
+        try:
+            self.refresh()
+            result = method(self, *args, **kwargs)
+            changes = self.take_changes()
+            if changes:
+                self.backend.apply_rows(self.backend.capture(self.state, changes))
+                self.backend.log_changes(changes, self.shared_pid)
+            self.backend.commit()
+        except BaseException:
+            self.backend.rollback()
+            raise
+        finally:
+            self._txn_depth -= 1
+        return result
+    return wrapper
+
+class Store:
+    """In-memory state backed by a Storage backend.
+
+    Handlers go through these methods instead of poking at the raw dicts, so
+    every mutation is recorded in a ChangeSet and the backend can persist just
+    the touched rows (SQLite) or a fresh snapshot (JSON). In shared mode the
+    in-memory state is a cache kept in sync through the SQLite changelog.
+    """
+
+    def __init__(self, backend: Storage):
+        self.backend = backend
+        self.state = backend.load(DEFAULT_INTERVAL_MIN)
+        self.next_link_id = 1 + max((l.id for l in self.state["links"]), default=0)
+        self.state["links"] = LinkPool(self.state["links"])
+        self.owner_ready_at = {}  # owner_id -> epoch when their per-user interval has passed
+        self._ready_heap = []     # (ready_at, owner_id); entries no longer in owner_ready_at are stale
+        self.recent_links = RecentLinks(LINK_DEDUP_WINDOW_HOURS * 3600)
+        # copy-on-write bookkeeping for snapshot()
+        self._snap_epoch = 0
+        self._snapshots = 0
+        self._copied_at = {}  # uid -> snapshot epoch in which the live record was last copied
+        self.changes = ChangeSet()
+        self._upgrade_settings()
+        self.leaderboard = Leaderboard()
+        for uid, invites in invite_counts(self.users):
+            self.leaderboard.add(uid, invites)
+        # shared mode
+        self.shared_pid = None
+        self.on_remote_change = None   # callback(kind) for changes made by other processes
+        self._txn_depth = 0
+        self._seq = 0
+        self._data_version = None
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        return self.state["settings"]
+
+    @property
+    def links(self) -> LinkPool:
+        return self.state["links"]
+
+    @property
+    def users(self) -> Dict[int, User]:
+        return self.state["users"]
+
+    def take_changes(self) -> ChangeSet:
+        changes, self.changes = self.changes, ChangeSet()
+        return changes
+
+    # --- shared (multi-process) mode ---
+    def enable_shared(self, pid: str):
+        self.shared_pid = pid
+        self._seq = self.backend.changelog_bounds()[1]
+        self._data_version = self.backend.data_version()
+
+    def refresh(self):
+        """Apply changes other processes committed since the last refresh.
+
+        Cheap when nothing changed (one PRAGMA data_version). Falls back to a
+        full reload if the changelog was pruned past our position.
+        """
+        if self.shared_pid is None:
+            return
+        version = self.backend.data_version()
+        if version == self._data_version:
+            return
+        self._data_version = version
+        lo, hi = self.backend.changelog_bounds()
+        if lo > self._seq + 1:
+            return self._reload(hi)
+        for seq, kind, key, pid in self.backend.changes_since(self._seq):
+            self._seq = seq
+            if pid != self.shared_pid:
+                self._apply_remote(kind, key)
+
+    def _apply_remote(self, kind: str, key: str):
+        if kind == "user":
+            uid = int(key)
+            u = self.backend.load_user(uid)
+            if u is None:
+                return
+            old = self.users.get(uid)
+            self.users[uid] = u   # replace, never mutate: snapshots may hold the old record
+            if old is None:
+                self.leaderboard.add(uid, u.invites)
+            else:
+                if old.invites != u.invites:
+                    self.leaderboard.bump(uid, old.invites, u.invites)
+                if old.username != u.username:
+                    self.leaderboard.touch(uid)
+        elif kind == "referral":
+            uid = self.backend.load_referral(key)
+            if uid is not None:
+                self.state["referrals"][key] = uid
+        elif kind == "link_add":
+            # ids are never reused, even if the link is already gone again
+            self.next_link_id = max(self.next_link_id, int(key) + 1)
+            link = self.backend.load_link(int(key))
+            if link is not None and self.links.get(link.id) is None:
+                self.links.append(link)
+        elif kind == "link_del":
+            link = self.links.get(int(key))
+            if link is not None:
+                self.links.remove(link)
+        elif kind == "settings":
+            self.state["settings"] = self.backend.load_settings()
+            self._upgrade_settings()
+        if self.on_remote_change:
+            self.on_remote_change(kind)
+
+    def _reload(self, seq: int):
+        logger.info("Changelog pruned past seq %s, reloading state", self._seq)
+        self.state = self.backend.load(DEFAULT_INTERVAL_MIN)
+        self.next_link_id = max(self.next_link_id, 1 + max((l.id for l in self.state["links"]), default=0))
+        self.state["links"] = LinkPool(self.state["links"])
+        self._upgrade_settings()
+        self.leaderboard = Leaderboard()
+        for uid, invites in invite_counts(self.users):
+            self.leaderboard.add(uid, invites)
+        self._copied_at.clear()
+        self._seq = seq
+        if self.on_remote_change:
+            self.on_remote_change("settings")
+            self.on_remote_change("link_add")
+
+    # --- snapshots ---
+    def snapshot(self) -> Dict[str, Any]:
+        """Point-in-time view of the state, safe to serialize in a thread.
+
+        Containers are copied by reference only; user records stay shared with
+        the live state until the next write to them, which copies the record
+        first (_user_for_write). Every snapshot() must be paired with
+        release_snapshot() once the consumer is done with it.
+        """
+        self._snap_epoch += 1
+        self._snapshots += 1
+        return {
+            "settings": copy.deepcopy(self.settings),
+            "links": list(self.links),
+            "users": freeze(self.users),
+            "referrals": freeze(self.state["referrals"]),
         }
-        with open(DATA_FILE, "w") as f:
-            json.dump(base, f, indent=2)
-        return base
-    with open(DATA_FILE, "r") as f:
-        return json.load(f)
 
-def save_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+    def release_snapshot(self):
+        self._snapshots -= 1
+        if not self._snapshots:
+            self._copied_at.clear()
+
+    def _user_for_write(self, uid: int) -> User:
+        u = self.users[uid]
+        if self._snapshots and self._copied_at.get(uid) != self._snap_epoch:
+            # shared with a live snapshot: detach before mutating
+            u = self.users[uid] = u.copy()
+            self._copied_at[uid] = self._snap_epoch
+        return u
+
+    # --- users / referrals ---
+    def get_user(self, user_id: int) -> Optional[User]:
+        return self.users.get(user_id)
+
+    @mutation
+    def ensure_user(self, user_id: int, username: str = None) -> User:
+        u = self.users.get(user_id)
+        if u is None:
+            token = secrets.token_urlsafe(8)
+            u = self.users[user_id] = User(username or "", token, limit=5)  # starts with 5 slots
+            self.state["referrals"][token] = user_id
+            self.changes.users.add(user_id)
+            self.changes.referrals.add(token)
+            self.leaderboard.add(user_id)
+            save_data()
+        elif username and u.username != username:
+            # update username if changed
+            u = self._user_for_write(user_id)
+            u.username = username
+            self.changes.users.add(user_id)
+            self.leaderboard.touch(user_id)
+            save_data()
+        return u
+
+    def referrer_of(self, token: str) -> Optional[int]:
+        return self.state["referrals"].get(token)
+
+    @mutation
+    def add_invite(self, user_id: int) -> User:
+        u = self._user_for_write(user_id)
+        old = u.invites
+        u.invites = old + 1
+        u.limit = compute_limit_from_invites(u.invites)
+        self.leaderboard.bump(user_id, old, u.invites)
+        self.changes.users.add(user_id)
+        save_data()
+        return u
+
+    def user_ids(self) -> List[int]:
+        return list(self.users)
+
+    def top_inviters(self):
+        return [(uid, self.users[uid]) for uid in self.leaderboard.top()]
+
+    def rank_of(self, user_id: int) -> Optional[int]:
+        u = self.get_user(user_id)
+        if u is None:
+            return None
+        return self.leaderboard.rank(u.invites)
+
+    # --- link pool ---
+    @mutation
+    def add_links(self, user_id: int, links: List[str]) -> Dict[str, List[str]]:
+        """Canonicalize, dedupe and queue submitted links up to the user's
+        free slots. Returns them sorted into accepted / duplicate (queued,
+        repeated in this batch or rotated within LINK_DEDUP_WINDOW_HOURS) /
+        rejected (not a URL) / over_limit."""
+        result = {"accepted": [], "duplicate": [], "rejected": [], "over_limit": []}
+        u = self._user_for_write(user_id)
+        free = max(0, u.limit - u.links_added)
+        now = int(time.time())
+        batch = set()
+        for raw in links:
+            url = canonical_url(raw)
+            if url is None:
+                result["rejected"].append(raw)
+            elif url in batch or self.links.has_url(url) or self.recent_links.seen(url, now):
+                result["duplicate"].append(url)
+            elif len(result["accepted"]) >= free:
+                result["over_limit"].append(url)
+            else:
+                batch.add(url)
+                result["accepted"].append(url)
+        for url in result["accepted"]:
+            link_obj = Link(self.next_link_id, url, user_id, now)
+            self.next_link_id += 1
+            self.links.append(link_obj)
+            self.changes.added_links.append(link_obj)
+            u.links_added += 1
+        if result["accepted"]:
+            self.changes.users.add(user_id)
+            save_data()
+        return result
+
+    def user_links(self, user_id: int) -> List[Link]:
+        return self.links.owner_links(user_id)
+
+    @mutation
+    def remove_user_link(self, user_id: int, idx: int) -> bool:
+        user_links = self.user_links(user_id)
+        if idx < 0 or idx >= len(user_links):
+            return False
+        target = user_links[idx]
+        if not self.links.remove(target):
+            return False
+        self._user_for_write(user_id).links_added -= 1
+        self.changes.removed_links.add(target.id)
+        self.changes.users.add(user_id)
+        save_data()
+        return True
+
+    def _owner_eligible(self, now: float):
+        ready_at = self.owner_ready_at
+
+        def eligible(owner_id):
+            t = ready_at.get(owner_id)
+            if t is None:
+                return True
+            if t <= now:
+                del ready_at[owner_id]
+                return True
+            return False
+        return eligible
+
+    @mutation
+    def pop_link(self, policy: str, now: float) -> Optional[Link]:
+        """Take the next link to post under `policy` ("fifo" or "fair"),
+        skipping owners whose per-user interval has not elapsed yet."""
+        self._expire_owners(now)
+        eligible = self._owner_eligible(now) if self.owner_ready_at else None
+        if policy == "fair":
+            link_obj = self.links.pop_fair(eligible)
+        else:
+            link_obj = self.links.pop_oldest(eligible)
+        if link_obj is None:
+            return None
+        self.changes.removed_links.add(link_obj.id)
+        self.recent_links.add(link_obj.link, now)
+        owner = self.get_user(link_obj.owner_id)
+        if owner and owner.interval:
+            ready = now + owner.interval * 60
+            self.owner_ready_at[link_obj.owner_id] = ready
+            heapq.heappush(self._ready_heap, (ready, link_obj.owner_id))
+        self.update_settings(last_link=link_obj.link)
+        return link_obj
+
+    def _expire_owners(self, now: float):
+        # pop_oldest only scans a prefix of the queue, so owners whose links sit
+        # further back are never seen by _owner_eligible; expire them here
+        heap, ready_at = self._ready_heap, self.owner_ready_at
+        while heap and (heap[0][0] <= now or ready_at.get(heap[0][1]) != heap[0][0]):
+            t, owner_id = heapq.heappop(heap)
+            if ready_at.get(owner_id) == t:
+                del ready_at[owner_id]
+
+    def next_owner_ready(self, now: float) -> Optional[float]:
+        """Earliest future time a throttled owner becomes eligible again."""
+        self._expire_owners(now)
+        return self._ready_heap[0][0] if self._ready_heap else None
+
+    @mutation
+    def set_user_interval(self, user_id: int, minutes: Optional[int]):
+        self._user_for_write(user_id).interval = minutes
+        if not minutes:
+            self.owner_ready_at.pop(user_id, None)
+        self.changes.users.add(user_id)
+        save_data()
+
+    def owner_link_count(self, owner_id: int) -> int:
+        return self.links.owner_count(owner_id)
+
+    # --- settings ---
+    @mutation
+    def update_settings(self, **values):
+        self.settings.update(values)
+        self.changes.settings = True
+        save_data()
+
+    def _upgrade_settings(self):
+        # pre-scheduler data.json: one chat_id + global running flag. SQLite
+        # merges stored rows over DEFAULT_SETTINGS, so "chats" may already be
+        # there (empty) next to the legacy keys.
+        s = self.settings
+        if "interval" in s and not valid_interval(s["interval"]):
+            s["interval"] = DEFAULT_INTERVAL_MIN
+            self.changes.settings = True
+        legacy = [key for key in ("chat_id", "running", "rotation_index") if key in s]
+        if "chats" not in s or (legacy and not s["chats"]):
+            s["chats"] = {}
+            if s.get("chat_id"):
+                s["chats"][str(s["chat_id"])] = new_chat(s.get("interval", DEFAULT_INTERVAL_MIN), paused=not s.get("running"))
+            self.changes.settings = True
+        for key in legacy:
+            s.pop(key)
+            self.changes.settings = True
+        for chat_id, chat in s["chats"].items():
+            if not valid_interval(chat.get("interval")):
+                logger.warning("Chat %s had interval %r; using %s min", chat_id, chat.get("interval"), s.get("interval", DEFAULT_INTERVAL_MIN))
+                chat["interval"] = s.get("interval", DEFAULT_INTERVAL_MIN)
+                self.changes.settings = True
+
+    @property
+    def chats(self) -> Dict[str, Dict[str, Any]]:
+        return self.settings["chats"]
+
+    @mutation
+    def update_chat(self, chat_id: str, **values) -> Dict[str, Any]:
+        if "interval" in values and not valid_interval(values["interval"]):
+            raise ValueError(f"chat interval must be positive, got {values['interval']!r}")
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = new_chat(self.settings.get("interval", DEFAULT_INTERVAL_MIN))
+        chat.update(values)
+        self.changes.settings = True
+        save_data()
+        return chat
+
+    @mutation
+    def remove_chat(self, chat_id: str) -> bool:
+        if self.chats.pop(chat_id, None) is None:
+            return False
+        self.changes.settings = True
+        save_data()
+        return True
+
+    # --- outbound retry queue (settings["outbox"]) ---
+    @mutation
+    def outbox_put(self, entry: Dict[str, Any]):
+        entries = [e for e in self.settings.get("outbox") or () if e["id"] != entry["id"]]
+        entries.append(entry)
+        self.settings["outbox"] = entries
+        self.changes.settings = True
+        save_data()
+
+    @mutation
+    def outbox_remove(self, entry_id: str):
+        entries = self.settings.get("outbox") or []
+        if any(e["id"] == entry_id for e in entries):
+            self.settings["outbox"] = [e for e in entries if e["id"] != entry_id]
+            self.changes.settings = True
+            save_data()
+
+def valid_interval(minutes) -> bool:
+    # 0 or less would make next_due_after() post back to back
+    return isinstance(minutes, (int, float)) and minutes > 0
+
+def new_chat(interval: int, policy: str = "fifo", paused: bool = True) -> Dict[str, Any]:
+    if not valid_interval(interval):
+        raise ValueError(f"chat interval must be positive, got {interval!r}")
+    return {
+        "interval": interval,   # minutes between posts
+        "policy": policy,       # "fifo" (oldest link first) or "fair" (round-robin by owner)
+        "paused": paused,
+        "next_due": None,       # epoch seconds of the next scheduled post
+        "last_post": None,
+        "last_link": None,
+        "exhausted": False      # pool ran dry; resumes when links are added
+    }
+
+class WriteBehind:
+    """Coalesces save_data() calls into background group commits.
+
+    Handlers only bump a pending counter; a single flusher task wakes up after
+    SAVE_MAX_LAG_MS (or as soon as SAVE_MAX_PENDING mutations pile up), has the
+    backend capture what it needs on the event loop and does the actual write
+    in a worker thread.
+    """
+
+    def __init__(self, store: Store, max_lag_ms: int, max_pending: int):
+        self.store = store
+        self.max_lag = max_lag_ms / 1000
+        self.max_pending = max(1, max_pending)
+        self.pending = 0
+        self.flushes = 0
+        self._capture_timer = SAVE_SECONDS.labels("capture")   # on the event loop
+        self._write_timer = SAVE_SECONDS.labels("write")       # in the save-data thread
+        self._io_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="save-data")
+        self._dirty = None   # asyncio.Event, created on the running loop
+        self._full = None
+        self._task = None
+        self._inflight = None   # executor future of the write in progress
+
+    def mark_dirty(self):
+        self.pending += 1
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop (import time / scripts): behave like the old synchronous save
+            return self.flush_sync()
+        if self.max_lag <= 0:
+            return self.flush_sync()
+        if self._task is None or self._task.done():
+            self._dirty = asyncio.Event()
+            self._full = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+        self._dirty.set()
+        if self.pending >= self.max_pending:
+            self._full.set()
+
+    async def _run(self):
+        while True:
+            await self._dirty.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.max_lag)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("Background save failed: %s", e)
+                await asyncio.sleep(self.max_lag)
+
+    def _capture(self):
+        started = time.perf_counter()
+        changes = self.store.take_changes()
+        self.pending = 0
+        backend = self.store.backend
+        if backend.full_snapshot:
+            payload = backend.capture(self.store.snapshot(), changes)
+        else:
+            payload = backend.capture(self.store.state, changes)
+        self._capture_timer.observe(time.perf_counter() - started)
+        return changes, payload
+
+    def _release(self):
+        if self.store.backend.full_snapshot:
+            self.store.release_snapshot()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        changes, payload = self._capture()
+        self._dirty.clear()
+        self._full.clear()
+        fut = asyncio.get_running_loop().run_in_executor(self._executor, self._write, payload)
+        self._inflight = fut
+        fut.add_done_callback(functools.partial(self._write_done, changes))
+        # shielded: cancelling the flusher (shutdown) must not abandon a write
+        # whose thread is still using the payload and the backend connection
+        await asyncio.shield(fut)
+
+    def _write_done(self, changes: ChangeSet, fut):
+        self._release()
+        if fut.cancelled() or fut.exception() is not None:
+            # keep the state dirty so the next round retries
+            self.store.changes.merge(changes)
+            self.pending += 1
+            if self._dirty is not None:
+                self._dirty.set()
+
+    def flush_sync(self):
+        if not self.pending:
+            return
+        payload = self._capture()[1]
+        try:
+            self._write(payload)
+        finally:
+            self._release()
 
-data = init_data()
-data_lock = asyncio.Lock()
+    def _write(self, payload):
+        with self._io_lock:
+            started = time.perf_counter()
+            written = self.store.backend.write(payload)
+            self._write_timer.observe(time.perf_counter() - started)
+            SAVE_BYTES.observe(written or 0)
+            self.flushes += 1
+
+    async def close(self):
+        """Flush-on-shutdown: stop the flusher and persist whatever is pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight is not None and not self._inflight.done():
+            await asyncio.wait([self._inflight])
+            await asyncio.sleep(0)   # let _write_done run
+        if self.pending:
+            payload = self._capture()[1]
+            try:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._write, payload)
+            finally:
+                self._release()
+
+def save_data():
+    # marks state dirty; the actual write happens in WriteBehind
+    if store.shared_pid is not None:
+        return  # shared mode writes through in Store mutators
+    persister.mark_dirty()
+
+_load_started = time.perf_counter()
+store = Store(open_storage(STORAGE_BACKEND, DATA_FILE, SQLITE_FILE, SNAPSHOT_FILE))
+logger.info("State loaded from %s storage in %.0f ms: %d users, %d links, %d chats",
+            store.backend.name, (time.perf_counter() - _load_started) * 1000,
+            len(store.users), len(store.links), len(store.chats))
+if SHARED_STATE:
+    if store.backend.name != "sqlite":
+        raise RuntimeError("SHARED_STATE=1 needs STORAGE_BACKEND=sqlite")
+    store.enable_shared(f"{socket.gethostname()}:{os.getpid()}")
+    store.backend.set_busy_timeout(SHARED_BUSY_TIMEOUT_MS)
+persister = WriteBehind(store, SAVE_MAX_LAG_MS, SAVE_MAX_PENDING)
+# last-resort flush if the process exits without the shutdown hook running
+atexit.register(persister.flush_sync)
+events = EventLog(EVENTS_FILE, EVENTS_RAW_DAYS, EVENTS_KEEP_DAYS)
+# event log file I/O never runs on the event loop; one thread keeps appends ordered
+events_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="events")
+
+def _event_failed(fut):
+    if fut.exception() is not None:
+        logger.error("Recording event failed: %s", fut.exception())
+
+def record_event(fn, *args):
+    """Fire-and-forget append (events.record_post / record_invite)."""
+    events_executor.submit(fn, *args).add_done_callback(_event_failed)
+
+async def read_events(fn, *args):
+    """Run fn(*args) on the events thread after folding in new lines."""
+    def call():
+        events.catch_up()
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(events_executor, call)
+
+# ---------------------------
+# State locks
+# ---------------------------
+# Lock order (always acquire left to right): user stripes (ascending) ->
+# pool_lock -> settings_lock. Never await network I/O while holding any of
+# them: compute replies inside the critical section, send them afterwards.
+_locks_held = contextvars.ContextVar("locks_held", default=0)
+
+class StateLock:
+    """asyncio.Lock that tracks, per task, how many state locks are held.
+
+    The count is what LOCK_DEBUG checks before every Telegram request.
+    Wait and hold times go to the lock histograms (labelled by kind, so all
+    user stripes share one series).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = asyncio.Lock()
+        kind = name.split("-")[0]
+        self._wait = LOCK_WAIT_SECONDS.labels(kind)
+        self._hold = LOCK_HOLD_SECONDS.labels(kind)
+        self._acquired_at = 0.0
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        await self._lock.acquire()
+        self._acquired_at = time.perf_counter()
+        self._wait.observe(self._acquired_at - started)
+        _locks_held.set(_locks_held.get() + 1)
+        return self
+
+    async def __aexit__(self, *exc):
+        _locks_held.set(_locks_held.get() - 1)
+        self._hold.observe(time.perf_counter() - self._acquired_at)
+        self._lock.release()
+
+user_locks = [StateLock(f"user-{i}") for i in range(USER_LOCK_STRIPES)]
+pool_lock = StateLock("pool")
+settings_lock = StateLock("settings")
+
+@asynccontextmanager
+async def lock_users(*user_ids: int):
+    """Hold the stripes for all given users (deduplicated, in stripe order)."""
+    stripes = sorted({uid % USER_LOCK_STRIPES for uid in user_ids})
+    async with AsyncExitStack() as stack:
+        for s in stripes:
+            await stack.enter_async_context(user_locks[s])
+        yield
+
+# PTB's error for each Bot API status code (see telegram.request.BaseRequest)
+_STATUS_ERRORS = {400: "BadRequest", 401: "InvalidToken", 403: "Forbidden", 404: "InvalidToken",
+                  409: "Conflict", 429: "RetryAfter"}
+
+class MetricsRequest(HTTPXRequest):
+    """Times every Bot API call and counts failures by PTB error type.
+
+    Message sends first take a token from the shared send_budget at the
+    caller's send_priority, and a 429 pauses that budget for everyone.
+    """
+
+    def __init__(self, **kwargs):
+        # same pool size ApplicationBuilder would use for its own bot request
+        kwargs.setdefault("connection_pool_size", 256)
+        super().__init__(**kwargs)
+        self._timers = {}
+        self._errors = {}
+
+    def _count_error(self, method: str, error: str):
+        key = (method, error)
+        child = self._errors.get(key)
+        if child is None:
+            child = self._errors[key] = TELEGRAM_ERRORS.labels(*key)
+        child.inc()
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        timer = self._timers.get(api_method)
+        if timer is None:
+            timer = self._timers[api_method] = TELEGRAM_SECONDS.labels(api_method)
+        if api_method in BUDGETED_METHODS:
+            await send_budget.acquire(send_priority.get())
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            timer.observe(time.perf_counter() - started)
+            self._count_error(api_method, type(e).__name__)
+            raise
+        timer.observe(time.perf_counter() - started)
+        if code >= 300:
+            self._count_error(api_method, _STATUS_ERRORS.get(code, "NetworkError"))
+            if code == 429:
+                send_budget.pause(retry_after_of(payload))
+        return code, payload
+
+def retry_after_of(payload: bytes) -> float:
+    try:
+        return float(json.loads(payload)["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return 5.0
+
+class LockCheckingRequest(MetricsRequest):
+    """LOCK_DEBUG: log every Telegram API call made while a state lock is held."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        if _locks_held.get():
+            logger.warning(
+                "Network I/O (%s) while holding %d state lock(s):\n%s",
+                url.rsplit("/", 1)[-1], _locks_held.get(), "".join(traceback.format_stack(limit=12)),
+            )
+        return await super().do_request(url, method, *args, **kwargs)
 
 # ---------------------------
 # Utility functions
 # ---------------------------
-def ensure_user_entry(user_id: int, username: str = None):
-    uid = str(user_id)
-    if uid not in data["users"]:
-        token = secrets.token_urlsafe(8)
-        data["users"][uid] = {
-            "username": username or "",
-            "token": token,
-            "invites": 0,
-            "links_added": 0,
-            "limit": 5,  # starts with 5 slots
-            "interval": None  # optional per-user interval (minutes)
-        }
-        data["referrals"][token] = user_id
-        save_data(data)
-    else:
-        # update username if changed
-        if username and data["users"][uid].get("username") != username:
-            data["users"][uid]["username"] = username
-            save_data(data)
-    return data["users"][uid]
+async def mutate(fn, *args, **kwargs):
+    """Call a Store mutator.
+
+    In shared mode the mutator's SQLite transaction gives up after
+    SHARED_BUSY_TIMEOUT_MS if another worker holds the write lock; nothing
+    has been changed yet then, so wait without blocking the loop and retry.
+    """
+    deadline = time.monotonic() + SHARED_BUSY_WAIT_SEC
+    delay = 0.005
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except DatabaseBusy:
+            if time.monotonic() >= deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+
+async def ensure_user_entry(user_id: int, username: str = None):
+    return await mutate(store.ensure_user, user_id, username)
 
 def compute_limit_from_invites(invites:int) -> int:
     # tiered limits
@@ -100,136 +1147,168 @@ def compute_limit_from_invites(invites:int) -> int:
         return 10
     return 5
 
-def get_bot_username(bot: Bot):
-    return bot.username or bot.get_me().username
+class BotIdentity:
+    """The bot's own username, resolved with getMe at startup and refreshed
+    on a timer instead of on every /invite or help callback."""
+
+    def __init__(self):
+        self.username = None
+
+    def update(self, username: str):
+        if username != self.username:
+            if self.username is not None:
+                logger.info("Bot username changed: @%s -> @%s", self.username, username)
+            self.username = username
+            invite_link.cache_clear()
+
+    async def refresh(self, bot: Bot) -> str:
+        self.update((await bot.get_me()).username)
+        return self.username
+
+    async def resolve(self, bot: Bot) -> str:
+        # only pays a round trip if startup couldn't resolve it
+        return self.username or await self.refresh(bot)
+
+bot_identity = BotIdentity()
+
+@functools.lru_cache(maxsize=10000)
+def invite_link(bot_username: str, token: str) -> str:
+    return f"https://t.me/{bot_username}?start={token}"
+
+async def identity_worker(bot: Bot):
+    while True:
+        await asyncio.sleep(BOT_IDENTITY_REFRESH_MIN * 60)
+        try:
+            await bot_identity.refresh(bot)
+        except TelegramError as e:
+            logger.info("Bot identity refresh failed: %s", e)
 
 # ---------------------------
-# Keyboard helpers
+# Keyboard helpers + static texts
 # ---------------------------
-def help_markup():
-    kb = [
-        [InlineKeyboardButton("Getting Started", callback_data="help_getting_started")],
-        [InlineKeyboardButton("Earning Slots", callback_data="help_earning")],
-        [InlineKeyboardButton("Commands", callback_data="help_commands")],
-        [InlineKeyboardButton("Contact Admin", callback_data="help_admin")]
-    ]
-    return InlineKeyboardMarkup(kb)
+# built once; InlineKeyboardMarkup is immutable, so every reply can share it
+HELP_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Getting Started", callback_data="help_getting_started")],
+    [InlineKeyboardButton("Earning Slots", callback_data="help_earning")],
+    [InlineKeyboardButton("Commands", callback_data="help_commands")],
+    [InlineKeyboardButton("Contact Admin", callback_data="help_admin")]
+])
+
+# Stylish welcome (Style 3)
+WELCOME_TEXT = (
+    "👋 Welcome to SmartLink Hub!\n\n"
+    "📌 You can manage and rotate your links automatically every 30 minutes.\n"
+    "Start with 5 link slots for FREE.\n\n"
+    "📈 Unlock more slots by inviting friends:\n"
+    "➡️ 20 Invites = 10 slots\n"
+    "➡️ 40 Invites = 20 slots\n"
+    "➡️ 60 Invites = 30 slots\n\n"
+    "Use these commands:\n"
+    "🧩 /addlinks <link1> <link2> ... — Add links (within your limit)\n"
+    "🔗 /invite — Get your referral link to invite users\n"
+    "📊 /status — View your stats\n"
+    "❓ /help — Learn how to use the bot\n\n"
+    "Let’s automate your link growth 💫"
+)
+
+HELP_TEXTS = {
+    "help_getting_started": (
+        "🚀 Getting Started:\n"
+        "1) Use /invite to get your personal referral link.\n"
+        "2) Share it — when people join via it, you earn invite credits.\n"
+        "3) Use /addlinks to add up to your unlocked slots.\n"
+        "4) Admin rotates links into the target chat automatically."
+    ),
+    "help_earning": (
+        "🏆 Earning Slots:\n"
+        "• Start with 5 free slots.\n"
+        "• 20 invites → 10 slots\n"
+        "• 40 invites → 20 slots\n"
+        "• 60 invites → 30 slots\n"
+        "Use /status to check your current invites and limit."
+    ),
+    "help_commands": (
+        "📚 Commands:\n"
+        "/start — Intro\n"
+        "/invite — Your referral link\n"
+        "/addlinks l1 l2 ... — Add links (within your limit)\n"
+        "/removelink <index> — Remove your link\n"
+        "/showlinks — See your added links\n"
+        "/status — Your stats\n"
+        "/leaderboard — Top inviters\n"
+        "/help — This menu\n"
+    ),
+}
 
 # ---------------------------
 # Telegram command handlers
 # ---------------------------
+def referrer_dm(invites: int, limit: int, gained: int) -> str:
+    what = "1 invite" if gained == 1 else f"{gained} invites"
+    return f"🎉 Good news! You gained {what}. Total invites: {invites}. Your slot limit is now {limit}."
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     # Check referral parameter
     args = context.args or []
     ref_token = args[0] if args else None
+    # tokens never change owner, so the lookup needs no lock
+    ref_uid = store.referrer_of(ref_token) if ref_token else None
+    if ref_uid == user.id:
+        ref_uid = None  # no self-referral
     # ensure user in db
-    async with data_lock:
-        ensure_user_entry(user.id, user.username)
-        # if referred by token and not self-referral
-        if ref_token:
-            ref_uid = data["referrals"].get(ref_token)
-            if ref_uid and ref_uid != user.id:
-                # increment invites for referrer
-                ref_key = str(ref_uid)
-                data["users"][ref_key]["invites"] = data["users"][ref_key].get("invites", 0) + 1
-                # recompute limits
-                new_limit = compute_limit_from_invites(data["users"][ref_key]["invites"])
-                data["users"][ref_key]["limit"] = new_limit
-                save_data(data)
-                try:
-                    await context.bot.send_message(
-                        ref_uid,
-                        f"🎉 Good news! You gained 1 invite. Total invites: {data['users'][ref_key]['invites']}. "
-                        f"Your slot limit is now {new_limit}."
-                    )
-                except Exception as e:
-                    logger.info("Could not DM referrer: %s", e)
-
-    # Stylish welcome (Style 3)
-    welcome = (
-        "👋 Welcome to SmartLink Hub!\n\n"
-        "📌 You can manage and rotate your links automatically every 30 minutes.\n"
-        "Start with 5 link slots for FREE.\n\n"
-        "📈 Unlock more slots by inviting friends:\n"
-        "➡️ 20 Invites = 10 slots\n"
-        "➡️ 40 Invites = 20 slots\n"
-        "➡️ 60 Invites = 30 slots\n\n"
-        "Use these commands:\n"
-        "🧩 /addlinks <link1> <link2> ... — Add links (within your limit)\n"
-        "🔗 /invite — Get your referral link to invite users\n"
-        "📊 /status — View your stats\n"
-        "❓ /help — Learn how to use the bot\n\n"
-        "Let’s automate your link growth 💫"
-    )
-    await update.message.reply_text(welcome, reply_markup=help_markup())
+    async with lock_users(user.id, *([ref_uid] if ref_uid else [])):
+        await ensure_user_entry(user.id, user.username)
+        if ref_uid and store.get_user(ref_uid):
+            # increment invites for referrer (recomputes limits)
+            ref_user = await mutate(store.add_invite, ref_uid)
+            outbox.send(ref_uid, functools.partial(referrer_dm, ref_user.invites, ref_user.limit),
+                        coalesce=f"invite:{ref_uid}")
+        else:
+            ref_uid = None
+    if ref_uid:
+        record_event(events.record_invite, ref_uid, user.id)
+
+    await update.message.reply_text(WELCOME_TEXT, reply_markup=HELP_MARKUP)
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Choose a topic:", reply_markup=help_markup())
+    await update.message.reply_text("Choose a topic:", reply_markup=HELP_MARKUP)
 
 async def callback_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    data_key = query.data
-    if data_key == "help_getting_started":
-        text = (
-            "🚀 Getting Started:\n"
-            "1) Use /invite to get your personal referral link.\n"
-            "2) Share it — when people join via it, you earn invite credits.\n"
-            "3) Use /addlinks to add up to your unlocked slots.\n"
-            "4) Admin rotates links into the target chat automatically."
-        )
-    elif data_key == "help_earning":
-        text = (
-            "🏆 Earning Slots:\n"
-            "• Start with 5 free slots.\n"
-            "• 20 invites → 10 slots\n"
-            "• 40 invites → 20 slots\n"
-            "• 60 invites → 30 slots\n"
-            "Use /status to check your current invites and limit."
-        )
-    elif data_key == "help_commands":
-        text = (
-            "📚 Commands:\n"
-            "/start — Intro\n"
-            "/invite — Your referral link\n"
-            "/addlinks l1 l2 ... — Add links (within your limit)\n"
-            "/removelink <index> — Remove your link\n"
-            "/showlinks — See your added links\n"
-            "/status — Your stats\n"
-            "/leaderboard — Top inviters\n"
-            "/help — This menu\n"
-        )
-    else:
-        text = f"Need help? Contact admin: @{(await context.bot.get_me()).username}"
-
+    text = HELP_TEXTS.get(query.data)
+    if text is None:
+        text = f"Need help? Contact admin: @{await bot_identity.resolve(context.bot)}"
     await query.edit_message_text(text)
 
 async def cmd_invite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    async with data_lock:
-        u = ensure_user_entry(user.id, user.username)
-        token = u["token"]
-    bot_username = (await context.bot.get_me()).username
-    invite_link = f"https://t.me/{bot_username}?start={token}"
+    async with lock_users(user.id):
+        u = await ensure_user_entry(user.id, user.username)
+        token = u.token
+    link = invite_link(await bot_identity.resolve(context.bot), token)
     await update.message.reply_text(
-        f"🔗 Your referral link:\n{invite_link}\n\nShare this — each person who joins using it increases your invite count.",
+        f"🔗 Your referral link:\n{link}\n\nShare this — each person who joins using it increases your invite count.",
     )
 
 async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    uid = str(user.id)
-    async with data_lock:
-        u = data["users"].get(uid)
+    async with lock_users(user.id):
+        u = store.get_user(user.id)
         if not u:
-            u = ensure_user_entry(user.id, user.username)
+            u = await ensure_user_entry(user.id, user.username)
+        u = u.copy()
+    invites_7d, posted = await read_events(lambda: (
+        events.user_invites(user.id, 7), [events.owner_posts(user.id, d) for d in (1, 7, None)]))
     text = (
         f"📊 Your Stats:\n"
         f"👤 Username: @{user.username if user.username else user.first_name}\n"
-        f"🔢 Invites: {u['invites']}\n"
-        f"🔗 Links added: {u['links_added']}\n"
-        f"🎯 Slot limit: {u['limit']}\n"
-        f"⏱ Per-user interval: {u['interval'] or 'Default'} minutes"
+        f"🔢 Invites: {u.invites} ({invites_7d} in the last 7 days)\n"
+        f"🔗 Links added: {u.links_added}\n"
+        f"📣 Links posted: {posted[0]} today, {posted[1]} in 7 days, {posted[2]} total\n"
+        f"🎯 Slot limit: {u.limit}\n"
+        f"⏱ Per-user interval: {u.interval or 'Default'} minutes"
     )
     await update.message.reply_text(text)
 
@@ -238,38 +1317,44 @@ async def cmd_addlinks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     args = context.args or []
     if not args:
         return await update.message.reply_text("Usage: /addlinks <link1> <link2> ... (space-separated)")
-    uid = str(user.id)
-    async with data_lock:
-        ensure_user_entry(user.id, user.username)
-        user_entry = data["users"][uid]
-        allowed = user_entry["limit"] - user_entry["links_added"]
+    async with lock_users(user.id):
+        user_entry = await ensure_user_entry(user.id, user.username)
+        allowed = user_entry.limit - user_entry.links_added
         if allowed <= 0:
-            return await update.message.reply_text(
-                f"⚠️ You have reached your slot limit ({user_entry['limit']}). Invite more users to increase your limit."
-            )
-        to_add = args[:allowed]
-        added = 0
-        for l in to_add:
-            link_obj = {
-                "link": l,
-                "owner_id": user.id,
-                "owner_username": user.username or "",
-                "added_at": datetime.utcnow().isoformat()
-            }
-            data["links"].append(link_obj)
-            user_entry["links_added"] += 1
-            added += 1
-        save_data(data)
-    await update.message.reply_text(f"✅ Added {added} link(s). Total your links in pool: {user_entry['links_added']}")
+            reply = f"⚠️ You have reached your slot limit ({user_entry.limit}). Invite more users to increase your limit."
+        else:
+            async with pool_lock:
+                result = await mutate(store.add_links, user.id, args)
+            if result["accepted"]:
+                scheduler.links_available()
+            reply = addlinks_reply(result, store.get_user(user.id))
+    await update.message.reply_text(reply, disable_web_page_preview=True)
+
+def addlinks_reply(result: Dict[str, List[str]], u: User) -> str:
+    for outcome, urls in result.items():
+        if urls:
+            LINKS_SUBMITTED.labels(outcome).inc(len(urls))
+    lines = [f"✅ Added {len(result['accepted'])} link(s)."]
+    lines += [f"  • {l}" for l in result["accepted"]]
+    if result["duplicate"]:
+        lines.append("♻️ Already in the pool or posted recently:")
+        lines += [f"  • {l}" for l in result["duplicate"]]
+    if result["rejected"]:
+        lines.append("❌ Not a valid http(s) link:")
+        lines += [f"  • {l[:80]}" for l in result["rejected"]]
+    if result["over_limit"]:
+        lines.append(f"⚠️ Not added, slot limit ({u.limit}) reached:")
+        lines += [f"  • {l}" for l in result["over_limit"]]
+    lines.append(f"Total your links in pool: {u.links_added}")
+    return "\n".join(lines)
 
 async def cmd_showlinks(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    uid = str(user.id)
-    async with data_lock:
-        user_links = [l for l in data["links"] if str(l["owner_id"]) == uid]
+    async with pool_lock:
+        user_links = store.user_links(user.id)
     if not user_links:
         return await update.message.reply_text("You have no links in the pool.")
-    text = "\n".join([f"{i+1}. {l['link']}" for i, l in enumerate(user_links)])
+    text = "\n".join([f"{i+1}. {l.link}" for i, l in enumerate(user_links)])
     await update.message.reply_text(f"🔗 Your Links:\n{text}")
 
 async def cmd_removelink(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -281,31 +1366,34 @@ async def cmd_removelink(update: Update, context: ContextTypes.DEFAULT_TYPE):
         idx = int(args[0]) - 1
     except:
         return await update.message.reply_text("Provide a valid index number.")
-    uid = str(user.id)
-    async with data_lock:
-        user_links = [l for l in data["links"] if str(l["owner_id"]) == uid]
-        if idx < 0 or idx >= len(user_links):
-            return await update.message.reply_text("Invalid index.")
-        target = user_links[idx]
-        # remove first matching link instance
-        for i, l in enumerate(data["links"]):
-            if l is target:
-                data["links"].pop(i)
-                data["users"][uid]["links_added"] -= 1
-                save_data(data)
-                return await update.message.reply_text("✅ Link removed.")
-    await update.message.reply_text("Could not remove link.")
+    async with lock_users(user.id), pool_lock:
+        if idx < 0 or idx >= store.owner_link_count(user.id):
+            reply = "Invalid index."
+        elif await mutate(store.remove_user_link, user.id, idx):
+            reply = "✅ Link removed."
+        else:
+            reply = "Could not remove link."
+    await update.message.reply_text(reply)
 
 async def cmd_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    async with data_lock:
-        users = data["users"]
-        ranked = sorted(users.items(), key=lambda kv: kv[1].get("invites", 0), reverse=True)[:10]
-    if not ranked:
+    user = update.effective_user
+    # the leaderboard is only touched synchronously (no await between read and
+    # render), so it needs no lock of its own
+    board = store.leaderboard
+    text = board.text
+    if text is None:
+        ranked = store.top_inviters()
+        if ranked:
+            text = "🏆 Top Inviters:\n"
+            for i, (uid, u) in enumerate(ranked, start=1):
+                uname = u.username or uid
+                text += f"{i}. @{uname} — {u.invites} invites\n"
+            board.remember(text, [uid for uid, _ in ranked], ranked[-1][1].invites)
+    my_rank = store.rank_of(user.id)
+    if not text:
         return await update.message.reply_text("No invites yet.")
-    text = "🏆 Top Inviters:\n"
-    for i, (uid, u) in enumerate(ranked, start=1):
-        uname = u.get("username") or uid
-        text += f"{i}. @{uname} — {u.get('invites',0)} invites\n"
+    if my_rank is not None:
+        text += f"\nYour rank: #{my_rank}"
     await update.message.reply_text(text)
 
 # ---------------------------
@@ -315,181 +1403,1285 @@ async def admin_setchat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
     if not context.args:
-        return await update.message.reply_text("Usage: /setchat <@username or chat_id>")
-    chat = context.args[0]
-    async with data_lock:
-        data["settings"]["chat_id"] = chat
-        save_data(data)
-    await update.message.reply_text(f"✅ Target chat set to {chat}")
+        return await update.message.reply_text("Usage: /setchat <@username or chat_id> [minutes] [fifo|fair]")
+    chat_id = context.args[0]
+    values = {}
+    try:
+        if len(context.args) > 1:
+            values["interval"] = int(context.args[1])
+    except ValueError:
+        return await update.message.reply_text("Provide integer minutes.")
+    if values.get("interval", 1) <= 0:
+        return await update.message.reply_text("Provide integer minutes.")
+    if len(context.args) > 2:
+        if context.args[2] not in ROTATION_POLICIES:
+            return await update.message.reply_text(f"Policy must be one of: {', '.join(ROTATION_POLICIES)}")
+        values["policy"] = context.args[2]
+    async with settings_lock:
+        is_new = chat_id not in store.chats
+        chat = await mutate(store.update_chat, chat_id, **values)
+        if not is_new:
+            schedule_chat(chat_id, chat, time.time())
+    hint = " Use /startrotation to begin." if chat["paused"] else ""
+    await update.message.reply_text(
+        f"✅ Target chat {chat_id}: every {chat['interval']} min, {chat['policy']} policy.{hint}"
+    )
+
+async def admin_removechat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    if not context.args:
+        return await update.message.reply_text("Usage: /removechat <@username or chat_id>")
+    chat_id = context.args[0]
+    async with settings_lock:
+        removed = await mutate(store.remove_chat, chat_id)
+    scheduler.cancel(chat_id)
+    await update.message.reply_text(f"🗑 Removed {chat_id}" if removed else "Unknown chat.")
+
+async def admin_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    async with settings_lock:
+        chats = [(cid, dict(c)) for cid, c in store.chats.items()]
+    if not chats:
+        return await update.message.reply_text("No target chats. Add one with /setchat")
+    lines = []
+    for cid, c in chats:
+        if c["paused"]:
+            state = "⏸ paused"
+        elif c.get("exhausted"):
+            state = "⌛ waiting for links"
+        else:
+            due = scheduler.next_due(cid)
+            state = f"▶️ next in {max(0, int((due - time.time()) // 60))} min" if due else "▶️"
+        lines.append(f"{cid} — every {c['interval']} min, {c['policy']} — {state}")
+    await update.message.reply_text("🎯 Target chats:\n" + "\n".join(lines))
 
 async def admin_setinterval(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
     if not context.args:
-        return await update.message.reply_text("Usage: /setinterval <minutes>")
+        return await update.message.reply_text("Usage: /setinterval <minutes> [chat]")
     try:
         minutes = int(context.args[0])
     except:
         return await update.message.reply_text("Provide integer minutes.")
-    async with data_lock:
-        data["settings"]["interval"] = minutes
-        save_data(data)
-    await update.message.reply_text(f"✅ Interval set to {minutes} minutes")
+    if minutes <= 0:
+        return await update.message.reply_text("Provide integer minutes.")
+    target = context.args[1] if len(context.args) > 1 else None
+    now = time.time()
+    async with settings_lock:
+        if target is not None and target not in store.chats:
+            reply = "Unknown chat."
+        else:
+            if target is None:
+                # default for new chats, applied to all existing ones
+                await mutate(store.update_settings, interval=minutes)
+            for chat_id in ([target] if target else list(store.chats)):
+                chat = store.chats[chat_id]
+                nxt = chat.get("next_due")
+                if nxt is not None:
+                    nxt = max(now, (chat.get("last_post") or now) + minutes * 60)
+                chat = await mutate(store.update_chat, chat_id, interval=minutes, next_due=nxt)
+                schedule_chat(chat_id, chat, now)
+            reply = f"✅ Interval set to {minutes} minutes" + (f" for {target}" if target else "")
+    await update.message.reply_text(reply)
 
 async def admin_startrotation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
-    async with data_lock:
-        if not data["settings"]["chat_id"]:
-            return await update.message.reply_text("Set target chat first using /setchat")
-        if data["settings"]["running"]:
-            return await update.message.reply_text("Rotation already running.")
-        data["settings"]["running"] = True
-        save_data(data)
-    await update.message.reply_text("✅ Rotation started (admin)")
+    now = time.time()
+    async with settings_lock:
+        targets = [context.args[0]] if context.args else list(store.chats)
+        if not store.chats:
+            reply = "Set target chat first using /setchat"
+        elif any(t not in store.chats for t in targets):
+            reply = "Unknown chat."
+        elif not any(store.chats[t]["paused"] for t in targets):
+            reply = "Rotation already running."
+        else:
+            for chat_id in targets:
+                if store.chats[chat_id]["paused"]:
+                    chat = await mutate(store.update_chat, chat_id, paused=False, next_due=now)
+                    schedule_chat(chat_id, chat, now)
+            reply = "✅ Rotation started (admin)"
+    await update.message.reply_text(reply)
 
 async def admin_stoprotation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
-    async with data_lock:
-        data["settings"]["running"] = False
-        save_data(data)
+    async with settings_lock:
+        targets = [context.args[0]] if context.args else list(store.chats)
+        for chat_id in targets:
+            if chat_id in store.chats:
+                await mutate(store.update_chat, chat_id, paused=True)
+                scheduler.cancel(chat_id)
     await update.message.reply_text("⏹ Rotation stopped (admin)")
 
+async def admin_setuserinterval(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    if len(context.args or []) < 2:
+        return await update.message.reply_text("Usage: /setuserinterval <user_id> <minutes|off>")
+    try:
+        user_id = int(context.args[0])
+        minutes = None if context.args[1] == "off" else int(context.args[1])
+    except ValueError:
+        return await update.message.reply_text("Provide a user id and integer minutes (or 'off').")
+    async with lock_users(user_id):
+        if store.get_user(user_id) is None:
+            reply = "Unknown user."
+        else:
+            await mutate(store.set_user_interval, user_id, minutes)
+            reply = f"✅ Links of {user_id} rotate at most every {minutes} minutes" if minutes else f"✅ Per-user interval cleared for {user_id}"
+    await update.message.reply_text(reply)
+
 async def admin_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
     text = " ".join(context.args) or None
     if not text:
         return await update.message.reply_text("Usage: /broadcast <message>")
-    async with data_lock:
-        users = list(data["users"].keys())
-    sent = 0
-    for uid in users:
-        try:
-            await context.bot.send_message(int(uid), f"📣 Broadcast from admin:\n\n{text}")
-            sent += 1
-        except Exception:
-            pass
-    await update.message.reply_text(f"Broadcast sent to {sent} users (attempted).")
+    running = (store.settings.get("broadcast") or {}).get("status") == "running"
+    if running or (broadcast_task is not None and not broadcast_task.done()):
+        return await update.message.reply_text("A broadcast is already running.")
+    job = {
+        "text": text,
+        "total": len(store.users),
+        "cursor": 0,            # recipients handled so far (progress only)
+        "max_uid": max(store.users, default=0),
+        "after_uid": None,      # every recipient with uid <= this has been handled
+        "delivered": 0,
+        "blocked": 0,
+        "failed": 0,
+        "status": "running",
+        "admin_chat": update.effective_chat.id,
+        "progress_msg": None
+    }
+    msg = await update.message.reply_text(f"📣 Broadcast queued for {job['total']} users…")
+    job["progress_msg"] = msg.message_id
+    async with settings_lock:
+        await mutate(store.update_settings, broadcast=dict(job))
+    if is_leader():
+        start_broadcast(context.bot, job)
+    # otherwise the leader picks the job up from the shared settings
 
 # ---------------------------
-# Rotation task (background)
+# Outbound dispatcher
 # ---------------------------
-async def rotation_worker(app):
-    bot = app.bot
-    while True:
-        await asyncio.sleep(5)  # short startup delay
+# send priorities, lowest first
+PRIO_ROTATION, PRIO_REPLY, PRIO_NOTICE, PRIO_BULK = range(4)
+# handler replies run with the default; background senders set their own
+send_priority = contextvars.ContextVar("send_priority", default=PRIO_REPLY)
+BUDGETED_METHODS = {"sendMessage", "sendDocument", "sendPhoto", "copyMessage", "forwardMessage", "editMessageText"}
+
+def backoff_delay(attempt: int, base: float = OUTBOX_BACKOFF_BASE, cap: float = OUTBOX_BACKOFF_MAX) -> float:
+    """Exponential backoff with jitter: somewhere in [d/2, d], d = base * 2^attempt."""
+    d = min(cap, base * 2 ** attempt)
+    return d / 2 + random.uniform(0, d / 2)
+
+class SendBudget:
+    """Global send budget: `rate` messages/second with bursts up to `burst`,
+    handed out in priority order (FIFO within a priority).
+
+    pause() empties the budget for a flood-control RetryAfter so every sender
+    sharing it backs off together.
+    """
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters = []   # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._granter = None
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, priority: int = PRIO_BULK):
+        now = time.monotonic()
+        if not self._waiters and now >= self.paused_until:
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.create_task(self._grant())
+        try:
+            await fut
+        except asyncio.CancelledError:
+            fut.cancel()   # the granter skips it
+            raise
+
+    async def _grant(self):
+        waiters = self._waiters
+        while waiters:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            fut = heapq.heappop(waiters)[2]
+            if not fut.done():
+                self.tokens -= 1
+                fut.set_result(None)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+send_budget = SendBudget(OUTBOUND_RATE)
+
+class Outbox:
+    """The one queue for messages the bot sends on its own initiative.
+
+    Messages queue per chat and leave strictly in order, one in flight per
+    chat. Across chats the next message is picked by priority (rotation
+    posts, then replies, then notices, then bulk). A message with a
+    `coalesce` key waits OUTBOX_COALESCE_SEC and absorbs later messages with
+    the same key ("gained 1 invite" x3 becomes "gained 3 invites").
+
+    Failed sends are retried with exponential backoff and jitter. Anything
+    waiting for a retry, or still queued at shutdown, is kept in
+    settings["outbox"] so it survives a restart; the leader process adopts
+    those entries. Forbidden/BadRequest are final.
+    """
+
+    def __init__(self, concurrency: int, max_attempts: int):
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self._chats = {}       # chat id -> deque of messages, head first
+        self._ready = []       # heap of (priority, seq, chat id): heads that may go now
+        self._delayed = []     # heap of (not_before, seq, chat id): heads waiting for a retry/coalesce window
+        self._busy = set()     # chats with a send in flight
+        self._coalesce = {}    # coalesce key -> queued message
+        self._known = set()    # ids of messages held here
+        self._persisted = set()   # ids also stored in settings["outbox"]
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._sending = set()
+        self._task = None
+
+    def __len__(self):
+        return sum(len(q) for q in self._chats.values())
+
+    def send(self, chat_id, text, priority: int = PRIO_NOTICE, coalesce: str = None):
+        """Queue a message. `text` may be a function of the coalesced count;
+        a plain string simply replaces the queued text when coalescing."""
+        if coalesce is not None:
+            msg = self._coalesce.get(coalesce)
+            if msg is not None:
+                msg["count"] += 1
+                msg["text"] = text(msg["count"]) if callable(text) else text
+                OUTBOX_MESSAGES.labels("coalesced").inc()
+                return
+        msg = {
+            "id": secrets.token_hex(6),
+            "chat_id": chat_id,
+            "text": text(1) if callable(text) else text,
+            "priority": priority,
+            "attempts": 0,
+            "not_before": time.time() + OUTBOX_COALESCE_SEC if coalesce is not None else 0,
+        }
+        if coalesce is not None:
+            msg["count"] = 1
+            msg["render"] = text
+            msg["coalesce"] = coalesce
+            self._coalesce[coalesce] = msg
+        self._add(msg)
+
+    def _add(self, msg: Dict[str, Any]):
+        msg["seq"] = next(self._seq)
+        self._known.add(msg["id"])
+        q = self._chats.get(msg["chat_id"])
+        if q is None:
+            q = self._chats[msg["chat_id"]] = deque()
+        q.append(msg)
+        if len(q) == 1:
+            self._activate(msg["chat_id"])
+
+    def _activate(self, chat_id):
+        q = self._chats.get(chat_id)
+        if not q or chat_id in self._busy:
+            return
+        head = q[0]
+        if head["not_before"] > time.time():
+            heapq.heappush(self._delayed, (head["not_before"], head["seq"], chat_id))
+        else:
+            heapq.heappush(self._ready, (head["priority"], head["seq"], chat_id))
+        self._wake.set()
+
+    def restore(self, entries):
+        """Adopt persisted messages (after a restart, or handed over by another worker)."""
+        for e in entries or ():
+            if e["id"] not in self._known:
+                msg = dict(e)
+                self._persisted.add(msg["id"])
+                self._add(msg)
+
+    async def _next(self):
         while True:
-            async with data_lock:
-                running = data["settings"].get("running", False)
-                chat_id = data["settings"].get("chat_id")
-                interval = data["settings"].get("interval", DEFAULT_INTERVAL_MIN)
-                if not running or not chat_id:
-                    break
-                links: List[Dict[str,Any]] = data.get("links", [])
-                idx = data["settings"].get("rotation_index", 0)
-            # rotation loop
-            if not links:
-                # notify admin, keep last_link
-                last_link = data["settings"].get("last_link")
-                try:
-                    await bot.send_message(ADMIN_ID, "⚠️ All links exhausted in SmartLink Hub. Add new links to resume rotation.")
-                    if last_link and chat_id:
-                        # post last link again (best-effort) so it remains visible
-                        await bot.send_message(chat_id, f"🔗 Current link (last): {last_link}\n(Waiting for new links.)")
-                except Exception as e:
-                    logger.info("Admin notify failed: %s", e)
-                # stop rotation in memory
-                async with data_lock:
-                    data["settings"]["running"] = False
-                    save_data(data)
-                break
+            now = time.time()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, seq, chat_id = heapq.heappop(self._delayed)
+                q = self._chats.get(chat_id)
+                if q and q[0]["seq"] == seq:
+                    heapq.heappush(self._ready, (q[0]["priority"], seq, chat_id))
+            while self._ready:
+                _, seq, chat_id = heapq.heappop(self._ready)
+                q = self._chats.get(chat_id)
+                if q and q[0]["seq"] == seq and chat_id not in self._busy:
+                    return q[0]
+            self._wake.clear()
+            timeout = self._delayed[0][0] - now if self._delayed else None
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot: Bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def _run(self, bot: Bot):
+        while True:
+            await self._slots.acquire()
+            msg = await self._next()
+            self._busy.add(msg["chat_id"])
+            if msg.get("coalesce") is not None:
+                # from now on the text is fixed; later notices start a new message
+                self._coalesce.pop(msg.pop("coalesce"), None)
+                msg.pop("render", None)
+            task = asyncio.create_task(self._deliver(bot, msg))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _deliver(self, bot: Bot, msg: Dict[str, Any]):
+        send_priority.set(msg["priority"])
+        retry_in = None
+        try:
+            await bot.send_message(msg["chat_id"], msg["text"])
+            outcome = "sent"
+        except RetryAfter as e:
+            retry_in = max(float(e.retry_after), backoff_delay(msg["attempts"]))
+        except (Forbidden, BadRequest) as e:
+            logger.info("Dropping message to %s: %s", msg["chat_id"], e)
+            outcome = "dropped"
+        except NetworkError as e:
+            logger.info("Send to %s failed (attempt %d): %s", msg["chat_id"], msg["attempts"] + 1, e)
+            retry_in = backoff_delay(msg["attempts"])
+        except Exception as e:
+            logger.exception("Send to %s failed: %s", msg["chat_id"], e)
+            outcome = "dropped"
+        finally:
+            self._busy.discard(msg["chat_id"])
+            self._slots.release()
+        if retry_in is not None:
+            msg["attempts"] += 1
+            if msg["attempts"] < self.max_attempts:
+                msg["not_before"] = time.time() + retry_in
+                await self._keep(msg)
+                OUTBOX_MESSAGES.labels("retried").inc()
+                return
+            logger.info("Giving up on message to %s after %d attempts", msg["chat_id"], msg["attempts"])
+            outcome = "dropped"
+        OUTBOX_MESSAGES.labels(outcome).inc()
+        await self._finish(msg)
+
+    async def _keep(self, msg: Dict[str, Any]):
+        """Persist a message that has to wait; followers hand it to the leader."""
+        async with settings_lock:
+            await mutate(store.outbox_put, {k: msg[k] for k in ("id", "chat_id", "text", "priority", "attempts", "not_before")})
+        self._persisted.add(msg["id"])
+        if is_leader():
+            self._activate(msg["chat_id"])
+        else:
+            self._pop_head(msg)
+
+    async def _finish(self, msg: Dict[str, Any]):
+        self._pop_head(msg)
+        if msg["id"] in self._persisted:
+            self._persisted.discard(msg["id"])
+            async with settings_lock:
+                await mutate(store.outbox_remove, msg["id"])
 
-            # ensure index valid
-            async with data_lock:
-                if idx >= len(data["links"]):
-                    idx = 0
-                link_obj = data["links"].pop(0)  # pop front to rotate FIFO
-                data["settings"]["last_link"] = link_obj["link"]
-                data["settings"]["rotation_index"] = 0
-                save_data(data)
+    def _pop_head(self, msg: Dict[str, Any]):
+        chat_id = msg["chat_id"]
+        q = self._chats[chat_id]
+        q.popleft()
+        self._known.discard(msg["id"])
+        if q:
+            self._activate(chat_id)
+        else:
+            del self._chats[chat_id]
+
+    async def join(self, timeout: float) -> bool:
+        """Wait up to `timeout` for everything queued to go out; True if it did."""
+        deadline = time.time() + timeout
+        while self._task and (self._chats or self._sending) and time.time() < deadline:
+            await asyncio.sleep(0.01)
+        return not self._chats
+
+    async def stop(self, drain_timeout: float = 5):
+        """Give queued messages a moment to go out, then persist the rest."""
+        await self.join(drain_timeout)
+        tasks = [self._task, *self._sending] if self._task else list(self._sending)
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        left = [m for q in self._chats.values() for m in q if m["id"] not in self._persisted]
+        if left:
+            logger.info("Persisting %d unsent message(s) for the next start", len(left))
+            async with settings_lock:
+                for m in left:
+                    await mutate(store.outbox_put, {k: m[k] for k in ("id", "chat_id", "text", "priority", "attempts", "not_before")})
+
+outbox = Outbox(OUTBOX_CONCURRENCY, OUTBOX_MAX_ATTEMPTS)
+
+# ---------------------------
+# Broadcast jobs (background)
+# ---------------------------
+broadcast_task = None
+
+async def deliver_broadcast(bot: Bot, chat_id: int, text: str) -> str:
+    """Send one broadcast message; returns "delivered", "blocked" or "failed".
+
+    Runs at PRIO_BULK, so it only gets send_budget tokens nobody else wants;
+    a RetryAfter has already paused the budget by the time we see it.
+    """
+    for attempt in range(5):
+        try:
+            await bot.send_message(chat_id, text)
+            return "delivered"
+        except RetryAfter as e:
+            logger.info("Broadcast hit flood control, pausing %ss", e.retry_after)
+        except Forbidden:
+            return "blocked"
+        except BadRequest:
+            return "failed"
+        except NetworkError:
+            await asyncio.sleep(backoff_delay(attempt, 1, 60))
+        except TelegramError as e:
+            logger.info("Broadcast to %s failed: %s", chat_id, e)
+            return "failed"
+    return "failed"
+
+def broadcast_summary(job: Dict[str, Any]) -> str:
+    done = job["delivered"] + job["blocked"] + job["failed"]
+    return (
+        f"📣 Broadcast {job['status']}: {done}/{job['total']}\n"
+        f"✅ Delivered: {job['delivered']}\n"
+        f"🚫 Blocked: {job['blocked']}\n"
+        f"⚠️ Failed: {job['failed']}"
+    )
 
-            # send to chat
+async def run_broadcast(bot: Bot, job: Dict[str, Any]):
+    """Fan a broadcast out with bounded concurrency, checkpointing the cursor.
+
+    `job` lives in settings["broadcast"]. Recipients are the users with
+    uid <= job["max_uid"] in ascending uid order, which every backend and
+    every process agrees on (in-memory insertion order does not survive a
+    reload). job["after_uid"] is the low-water mark: every recipient up to
+    and including it has been handled, so a restart or a new leader resumes
+    right after it.
+    """
+    send_priority.set(PRIO_BULK)   # inherited by the sender/reporter tasks
+    if "max_uid" not in job:
+        # checkpointed by an older version: map its positional cursor onto the uid order
+        ids = sorted(store.user_ids())[:job["total"]]
+        job["max_uid"] = ids[-1] if ids else 0
+        job["after_uid"] = ids[job["cursor"] - 1] if 0 < job["cursor"] <= len(ids) else None
+    ids = sorted(uid for uid in store.user_ids() if uid <= job["max_uid"])
+    after = job["after_uid"]
+    recipients = ids[bisect.bisect_right(ids, after):] if after is not None else ids
+    text = f"📣 Broadcast from admin:\n\n{job['text']}"
+    next_index = 0
+    finished = set()
+    done = 0            # recipients[:done] are all handled
+    last_checkpoint = job["cursor"]
+
+    async def checkpoint():
+        async with settings_lock:
+            await mutate(store.update_settings, broadcast=dict(job))
+
+    async def sender():
+        nonlocal next_index, last_checkpoint, done
+        while next_index < len(recipients):
+            i = next_index
+            next_index += 1
+            outcome = await deliver_broadcast(bot, recipients[i], text)
+            job[outcome] += 1
+            finished.add(i)
+            while done in finished:
+                finished.remove(done)
+                job["after_uid"] = recipients[done]
+                job["cursor"] += 1
+                done += 1
+            if job["cursor"] - last_checkpoint >= BROADCAST_CHECKPOINT_EVERY:
+                last_checkpoint = job["cursor"]
+                await checkpoint()
+
+    async def reporter():
+        send_priority.set(PRIO_NOTICE)
+        while True:
+            await asyncio.sleep(BROADCAST_REPORT_SEC)
             try:
-                await bot.send_message(chat_id, f"🔁 New invite link:\n{link_obj['link']}")
-            except Exception as e:
-                logger.exception("Failed to send link to chat: %s", e)
+                await bot.edit_message_text(broadcast_summary(job), chat_id=job["admin_chat"], message_id=job["progress_msg"])
+            except TelegramError as e:
+                logger.info("Broadcast progress update failed: %s", e)
 
-            # notify owner that one of their links was used; if owner has no more links then notify them
-            owner_id = link_obj.get("owner_id")
-            if owner_id:
+    report = asyncio.create_task(reporter()) if job.get("progress_msg") else None
+    try:
+        await asyncio.gather(*(sender() for _ in range(BROADCAST_CONCURRENCY)))
+        job["status"] = "finished"
+    finally:
+        if report:
+            report.cancel()
+        await checkpoint()
+    outbox.send(job["admin_chat"], broadcast_summary(job), PRIO_NOTICE)
+
+def start_broadcast(bot: Bot, job: Dict[str, Any]):
+    global broadcast_task
+    broadcast_task = asyncio.create_task(run_broadcast(bot, job))
+
+def resume_broadcast(bot: Bot):
+    """Pick up an interrupted broadcast after a restart."""
+    job = store.settings.get("broadcast")
+    if job and job.get("status") == "running" and (broadcast_task is None or broadcast_task.done()):
+        logger.info("Resuming broadcast at %s/%s (after uid %s)", job["cursor"], job["total"], job.get("after_uid"))
+        start_broadcast(bot, dict(job))
+
+# ---------------------------
+# Rotation scheduler (background)
+# ---------------------------
+class RotationScheduler:
+    """One coroutine serving every target chat from a min-heap of due times.
+
+    Entries are (next_due, chat_id). Rescheduling or cancelling a chat just
+    updates `_due`; stale heap entries are skipped when they surface. The
+    loop sleeps exactly until the earliest due time (or until woken by a
+    schedule change), so idle chats cost nothing.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}          # chat_id -> due time of its live heap entry
+        self._waiting = set()   # chats to wake early when new links arrive
+        self._running = set()   # chats with a post in flight
+        self._wake = asyncio.Event()
+
+    def schedule(self, chat_id: str, due: float, wake_on_links: bool = False):
+        self._due[chat_id] = due
+        if wake_on_links:
+            self._waiting.add(chat_id)
+        else:
+            self._waiting.discard(chat_id)
+        heapq.heappush(self._heap, (due, chat_id))
+        if self._heap[0] == (due, chat_id):
+            self._wake.set()
+
+    def cancel(self, chat_id: str):
+        self._due.pop(chat_id, None)
+        self._waiting.discard(chat_id)
+
+    def park(self, chat_id: str):
+        self._due.pop(chat_id, None)
+        self._waiting.add(chat_id)
+
+    def links_available(self):
+        """Wake chats that ran out of (eligible) links."""
+        now = time.time()
+        for chat_id in list(self._waiting):
+            self.schedule(chat_id, now)
+
+    def next_due(self, chat_id: str) -> Optional[float]:
+        return self._due.get(chat_id)
+
+    def tracked(self, chat_id: str) -> bool:
+        return chat_id in self._due or chat_id in self._waiting or chat_id in self._running
+
+    def chat_ids(self):
+        return set(self._due) | self._waiting
+
+    async def run(self, bot: Bot):
+        while True:
+            heap = self._heap
+            while heap and self._due.get(heap[0][1]) != heap[0][0]:
+                heapq.heappop(heap)  # cancelled or rescheduled
+            self._wake.clear()
+            if not heap:
+                await self._wake.wait()
+                continue
+            due, chat_id = heap[0]
+            delay = due - time.time()
+            if delay > 0:
                 try:
-                    # count remaining links owner has
-                    async with data_lock:
-                        owner_links = [l for l in data["links"] if l.get("owner_id") == owner_id]
-                        if not owner_links:
-                            await bot.send_message(owner_id, "ℹ️ All your links currently used in rotation. Add new links or invite more users to unlock more slots.")
-                except Exception as e:
-                    logger.info("Could not DM owner: %s", e)
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(heap)
+            del self._due[chat_id]
+            # posts run as their own tasks so one slow chat can't hold up the rest;
+            # the chat is rescheduled when its post is done
+            self._running.add(chat_id)
+            asyncio.create_task(self._rotate(bot, chat_id, due))
+
+    async def _rotate(self, bot: Bot, chat_id: str, due: float):
+        try:
+            await rotate_chat(bot, chat_id, due)
+        except Exception as e:
+            # the chat already left _due; without this it would never post again
+            logger.exception("Rotation failed for %s: %s", chat_id, e)
+            chat = store.chats.get(chat_id)
+            if chat and not chat.get("paused") and chat_id not in self._due:
+                self.schedule(chat_id, next_due_after(chat, due, time.time()))
+        finally:
+            self._running.discard(chat_id)
+
+scheduler = RotationScheduler()
+
+def next_due_after(chat: Dict[str, Any], due: float, now: float) -> float:
+    step = chat["interval"] * 60
+    nxt = due + step
+    # don't burst to catch up after a long stall
+    return nxt if nxt > now else now + step
 
-            # wait interval
-            await asyncio.sleep(interval * 60)
+async def rotate_chat(bot: Bot, chat_id: str, due: float):
+    now = time.time()
+    async with settings_lock:
+        chat = store.chats.get(chat_id)
+        if not chat or chat.get("paused"):
+            return
+        policy = chat.get("policy", "fifo")
+    async with pool_lock, settings_lock:
+        link_obj = await mutate(store.pop_link, policy, now)
+        if link_obj is not None:
+            ROTATION_LAG_SECONDS.observe(max(0.0, now - due))
+            nxt = next_due_after(chat, due, now)
+            await mutate(store.update_chat, chat_id, next_due=nxt, last_post=now, last_link=link_obj.link, exhausted=False)
+            outcome = "posted"
+        elif store.links:
+            # everything left belongs to owners whose per-user interval hasn't passed
+            nxt = max(store.next_owner_ready(now) or now, now + 1)
+            await mutate(store.update_chat, chat_id, next_due=nxt)
+            outcome = "throttled"
+        else:
+            notify = not chat.get("exhausted")
+            await mutate(store.update_chat, chat_id, next_due=None, exhausted=True)
+            last_link = chat.get("last_link") or store.settings.get("last_link")
+            outcome = "exhausted"
+        exhausted_owner = None
+        if link_obj is not None and link_obj.owner_id:
+            # count remaining links owner has
+            if not store.owner_link_count(link_obj.owner_id):
+                exhausted_owner = link_obj.owner_id
+
+    if outcome == "exhausted":
+        scheduler.park(chat_id)
+        if notify:
+            outbox.send(ADMIN_ID, f"⚠️ All links exhausted in SmartLink Hub ({chat_id}). Add new links to resume rotation.")
+            if last_link:
+                # post last link again so it remains visible
+                outbox.send(chat_id, f"🔗 Current link (last): {last_link}\n(Waiting for new links.)", PRIO_ROTATION)
+        return
+
+    scheduler.schedule(chat_id, nxt, wake_on_links=outcome == "throttled")
+    if outcome != "posted":
+        return
+    record_event(events.record_post, link_obj.owner_id, link_obj.id, chat_id, link_obj.added_at, now)
+    # send to chat
+    outbox.send(chat_id, f"🔁 New invite link:\n{link_obj.link}", PRIO_ROTATION)
+    # notify owner that one of their links was used and they have none left
+    if exhausted_owner:
+        outbox.send(exhausted_owner, "ℹ️ All your links currently used in rotation. Add new links or invite more users to unlock more slots.")
+
+def schedule_chat(chat_id: str, chat: Dict[str, Any], now: float):
+    """(Re)queue a chat according to its stored state."""
+    if chat.get("paused"):
+        scheduler.cancel(chat_id)
+    elif chat.get("exhausted") and not store.links:
+        scheduler.park(chat_id)
+    else:
+        scheduler.schedule(chat_id, chat.get("next_due") or now)
+
+def sync_schedule(now: float):
+    """Leader in shared mode: follow chat changes made by other processes."""
+    chats = store.chats
+    for chat_id in scheduler.chat_ids() - set(chats):
+        scheduler.cancel(chat_id)
+    for chat_id, chat in chats.items():
+        due = chat.get("next_due")
+        if chat.get("paused"):
+            scheduler.cancel(chat_id)
+        elif not scheduler.tracked(chat_id) or (due and due > now and scheduler.next_due(chat_id) not in (None, due)):
+            schedule_chat(chat_id, chat, now)
+
+async def rotation_worker(app):
+    now = time.time()
+    async with settings_lock:
+        for chat_id, chat in store.chats.items():
+            # short startup delay for anything already overdue
+            schedule_chat(chat_id, chat, now + 5)
+    await scheduler.run(app.bot)
 
 # ---------------------------
 # Auto-backup task
 # ---------------------------
+backup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup")
+
+def write_backup(path: str, snap: Dict[str, Any]) -> int:
+    # runs in backup_executor: serialize, compress, swap in atomically
+    raw = gzip.compress(json.dumps(state_to_json(snap), separators=(",", ":")).encode(), compresslevel=6)
+    return write_atomic(path, raw)
+
+def list_backups() -> List[str]:
+    """Backup file names, newest first (timestamps sort lexically)."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    names = [n for n in os.listdir(BACKUP_DIR) if n.startswith("data-backup-") and n.endswith(".json.gz")]
+    return sorted(names, reverse=True)
+
+def prune_backups(keep_hourly: int, keep_daily: int) -> List[str]:
+    """Retention: newest snapshot of each of the last `keep_hourly` hours and
+    `keep_daily` days is kept, everything else is deleted."""
+    keep, hours, days = set(), set(), set()
+    for name in list_backups():
+        ts = name[len("data-backup-"):-len(".json.gz")]
+        hour, day = ts[:10], ts[:8]
+        if hour not in hours and len(hours) < keep_hourly:
+            hours.add(hour)
+            keep.add(name)
+        if day not in days and len(days) < keep_daily:
+            days.add(day)
+            keep.add(name)
+    removed = []
+    for name in list_backups():
+        if name not in keep:
+            os.remove(os.path.join(BACKUP_DIR, name))
+            removed.append(name)
+    return removed
+
+async def take_backup() -> str:
+    """Write a compressed backup of a point-in-time snapshot; returns its path.
+
+    Only the snapshot itself is taken on the event loop (no state lock is
+    needed, the loop is single-threaded); serialization, compression and
+    retention run in backup_executor.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    path = os.path.join(BACKUP_DIR, f"data-backup-{ts}.json.gz")
+    loop = asyncio.get_running_loop()
+    snap = store.snapshot()
+    try:
+        size = await loop.run_in_executor(backup_executor, write_backup, path, snap)
+    finally:
+        store.release_snapshot()
+    removed = await loop.run_in_executor(backup_executor, prune_backups, BACKUP_KEEP_HOURLY, BACKUP_KEEP_DAILY)
+    logger.info("Backup written: %s (%d bytes), pruned %d", path, size, len(removed))
+    return path
+
 async def backup_worker(app):
-    bot = app.bot
     while True:
         await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
-        # create a simple backup copy and DM admin
         try:
-            ts = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-            backup_name = f"data-backup-{ts}.json"
-            async with data_lock:
-                with open(DATA_FILE, "r") as f:
-                    raw = f.read()
-                with open(backup_name, "w") as bf:
-                    bf.write(raw)
-            # send small notification to admin (file sending sometimes blocked, so send summary)
-            await bot.send_message(ADMIN_ID, f"🔐 Backup created: {backup_name} (stored on server). If you need the file, request /getbackup.")
+            path = await take_backup()
         except Exception as e:
             logger.exception("Backup failed: %s", e)
+            continue
+        # send small notification to admin (file sending sometimes blocked, so send summary)
+        outbox.send(ADMIN_ID, f"🔐 Backup created: {os.path.basename(path)} (stored on server). If you need the file, request /getbackup.",
+                    coalesce="backup")
 
 async def admin_getbackup(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         return
-    # send latest backup file content
+    # send the newest consistent snapshot (take one if none exists yet)
     try:
-        with open(DATA_FILE, "rb") as f:
-            await context.bot.send_document(ADMIN_ID, f)
+        backups = list_backups()
+        path = os.path.join(BACKUP_DIR, backups[0]) if backups else await take_backup()
+        with open(path, "rb") as f:
+            await context.bot.send_document(ADMIN_ID, f, filename=os.path.basename(path))
     except Exception as e:
+        logger.info("Sending backup failed: %s", e)
         await update.message.reply_text("Failed to send backup file.")
 
+# ---------------------------
+# Event log rollups
+# ---------------------------
+async def events_worker():
+    """Leader: hourly, fold raw events older than EVENTS_RAW_DAYS into the rollups."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            folded = await loop.run_in_executor(backup_executor, events.compact)
+            if folded:
+                logger.info("Compacted %d events into daily rollups", folded)
+        except Exception as e:
+            logger.exception("Event log compaction failed: %s", e)
+        await asyncio.sleep(3600)
+
+def format_wait(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds / 3600:.1f}h"
+
+async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    try:
+        days = max(1, min(90, int(context.args[0]))) if context.args else 7
+    except ValueError:
+        return await update.message.reply_text("Usage: /stats [days]")
+    daily, top = await read_events(lambda: (events.daily(days), events.top_owners(days)))
+    lines = [f"📈 Last {days} day(s) (UTC): posts / invites / avg queue wait"]
+    for d in daily:
+        lines.append(f"{d['day']}: {d['posts']} / {d['invites']} / {format_wait(d['avg_wait'])}")
+    if top:
+        lines.append("🏅 Most posted owners:")
+        for owner_id, n in top:
+            u = store.get_user(owner_id)
+            name = f"@{u.username}" if u and u.username else str(owner_id)
+            lines.append(f"  {name}: {n}")
+    await update.message.reply_text("\n".join(lines))
+
+# ---------------------------
+# Inbound rate limiting
+# ---------------------------
+class _UserBucket:
+    __slots__ = ("tokens", "updated", "throttled", "warned")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+        self.throttled = 0
+        self.warned = False
+
+class RateLimiter:
+    """Token bucket per user plus one global bucket, checked before any
+    handler runs.
+
+    Buckets live in an OrderedDict used as an LRU, so memory stays bounded
+    at `max_buckets` no matter how many users show up; an evicted user
+    simply starts again with a full bucket. Everything is synchronous and
+    O(1) per update.
+    """
+
+    def __init__(self, per_min: float, burst: int, global_rate: float, global_burst: int, max_buckets: int):
+        self.rate = per_min / 60
+        self.burst = burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.global_tokens = float(global_burst)
+        self.global_updated = time.monotonic()
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()   # user id -> _UserBucket, least recently seen first
+        self.throttled = {"user": 0, "global": 0}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def check(self, user_id: int) -> Optional[str]:
+        """None if the update may proceed, else "user"/"global" for the budget it exceeded."""
+        now = time.monotonic()
+        b = self._buckets.get(user_id)
+        if b is None:
+            b = self._buckets[user_id] = _UserBucket(float(self.burst), now)
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            b.tokens = min(self.burst, b.tokens + (now - b.updated) * self.rate)
+            b.updated = now
+        if b.tokens < 1:
+            return self._reject(b, "user")
+        self.global_tokens = min(self.global_burst, self.global_tokens + (now - self.global_updated) * self.global_rate)
+        self.global_updated = now
+        if self.global_tokens < 1:
+            return self._reject(b, "global")
+        self.global_tokens -= 1
+        b.tokens -= 1
+        b.warned = False
+        return None
+
+    def _reject(self, b: _UserBucket, scope: str) -> str:
+        b.throttled += 1
+        self.throttled[scope] += 1
+        THROTTLED.labels(scope).inc()
+        return scope
+
+    def should_warn(self, user_id: int) -> bool:
+        """True once per throttled streak; later rejections are dropped silently."""
+        b = self._buckets.get(user_id)
+        if b is None or b.warned:
+            return False
+        b.warned = True
+        return True
+
+    def top_throttled(self, n: int = 5):
+        ranked = sorted(((b.throttled, uid) for uid, b in self._buckets.items() if b.throttled), reverse=True)
+        return [(uid, count) for count, uid in ranked[:n]]
+
+inbound = RateLimiter(RATE_USER_PER_MIN, RATE_USER_BURST, RATE_GLOBAL_PER_SEC, RATE_GLOBAL_BURST, RATE_MAX_BUCKETS)
+
+async def throttle_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # runs first (group -2): throttled updates never reach a handler or a lock
+    user = update.effective_user
+    if user is None or user.id == ADMIN_ID:
+        return
+    message = update.message
+    if update.callback_query is None and not (message and message.text and message.text.startswith("/")):
+        return
+    scope = inbound.check(user.id)
+    if scope is None:
+        return
+    if scope == "user" and inbound.should_warn(user.id):
+        try:
+            if update.callback_query is not None:
+                await update.callback_query.answer("⏳ Too many requests, slow down a little.")
+            else:
+                await message.reply_text("⏳ Too many requests, slow down a little.")
+        except TelegramError as e:
+            logger.info("Throttle notice failed: %s", e)
+    raise ApplicationHandlerStop
+
+async def admin_ratelimits(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        return
+    lines = [
+        "🚦 Rate limiting:",
+        f"Per user: {RATE_USER_PER_MIN:g}/min, burst {RATE_USER_BURST}",
+        f"Global: {RATE_GLOBAL_PER_SEC:g}/s, burst {RATE_GLOBAL_BURST}",
+        f"Throttled: {inbound.throttled['user']} per-user, {inbound.throttled['global']} global",
+        f"Tracked users: {len(inbound)} (max {RATE_MAX_BUCKETS})",
+    ]
+    top = inbound.top_throttled()
+    if top:
+        lines.append("Most throttled (recently active):")
+        lines += [f"  {uid}: {n}" for uid, n in top]
+    await update.message.reply_text("\n".join(lines))
+
+# ---------------------------
+# Multi-process mode (leader election)
+# ---------------------------
+class LeaderLease:
+    """Keeps the process that runs rotation and backups unique.
+
+    Every process tries to take or renew a lease row in the shared SQLite
+    file every ttl/3 seconds. Whoever holds it runs the leader tasks; if the
+    leader dies its lease expires and another process takes over within ttl.
+    """
+
+    def __init__(self, backend, holder: str, ttl: float):
+        self.backend = backend
+        self.holder = holder
+        self.ttl = ttl
+        self.is_leader = False
+        self.expires = 0.0
+
+    async def run(self, on_elected, on_demoted):
+        try:
+            while True:
+                try:
+                    held = self.backend.acquire_lease("leader", self.holder, self.ttl)
+                except Exception as e:
+                    # database busy: keep what we have until the lease would run out anyway
+                    logger.info("Lease renewal failed: %s", e)
+                    held = self.is_leader and time.time() < self.expires - self.ttl / 3
+                if held:
+                    self.expires = time.time() + self.ttl
+                if held and not self.is_leader:
+                    self.is_leader = True
+                    logger.info("Elected leader (%s)", self.holder)
+                    on_elected()
+                elif not held and self.is_leader:
+                    self.is_leader = False
+                    logger.warning("Lost leader lease (%s)", self.holder)
+                    await on_demoted()
+                await asyncio.sleep(self.ttl / 3)
+        finally:
+            if self.is_leader:
+                self.is_leader = False
+                await on_demoted()
+
+    def release(self):
+        try:
+            self.backend.release_lease("leader", self.holder)
+        except Exception as e:
+            logger.info("Lease release failed: %s", e)
+
+lease = LeaderLease(store.backend, store.shared_pid, LEADER_LEASE_SEC) if SHARED_STATE else None
+leader_tasks = []
+
+def is_leader() -> bool:
+    return lease is None or lease.is_leader
+
+def on_remote_change(kind: str):
+    # followers keep their caches fresh; only the leader has a running scheduler
+    if not is_leader():
+        return
+    if kind == "link_add":
+        scheduler.links_available()
+    elif kind == "settings":
+        sync_schedule(time.time())
+        resume_broadcast(telegram_app.bot)   # /broadcast issued on another worker
+        outbox.restore(store.settings.get("outbox"))
+
+store.on_remote_change = on_remote_change
+
+async def shared_worker():
+    """Leader: pick up other workers' writes promptly and trim the changelog."""
+    last_prune = 0.0
+    while True:
+        await asyncio.sleep(SHARED_POLL_SEC)
+        try:
+            store.refresh()
+            if time.time() - last_prune > 60:
+                store.backend.prune_changelog(CHANGELOG_KEEP)
+                last_prune = time.time()
+        except Exception as e:
+            logger.exception("Shared state refresh failed: %s", e)
+
+def start_leader_tasks():
+    leader_tasks.append(asyncio.create_task(rotation_worker(telegram_app)))
+    leader_tasks.append(asyncio.create_task(backup_worker(telegram_app)))
+    leader_tasks.append(asyncio.create_task(events_worker()))
+    if SHARED_STATE:
+        store.refresh()
+        leader_tasks.append(asyncio.create_task(shared_worker()))
+    resume_broadcast(telegram_app.bot)
+    outbox.restore(store.settings.get("outbox"))   # retries left over from a restart or handed over by workers
+
+async def stop_leader_tasks():
+    for t in leader_tasks:
+        t.cancel()
+    if broadcast_task is not None:
+        broadcast_task.cancel()
+    await asyncio.gather(*leader_tasks, return_exceptions=True)
+    leader_tasks.clear()
+
+async def refresh_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # runs before every handler (group -1) so reads see other workers' writes
+    store.refresh()
+
 # ---------------------------
 # Webhook endpoint + startup/shutdown
 # ---------------------------
-telegram_app = ApplicationBuilder().token(BOT_TOKEN).build()
+builder = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(UPDATE_WORKERS)
+builder = builder.request(LockCheckingRequest() if LOCK_DEBUG else MetricsRequest())
+telegram_app = builder.build()
+
+def timed(name: str, handler):
+    """Wrap a handler so its latency and failures land in the metrics."""
+    timer = HANDLER_SECONDS.labels(name)
+    errors = HANDLER_ERRORS.labels(name)
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            timer.observe(time.perf_counter() - started)
+    return wrapper
+
+def command(name: str, handler) -> CommandHandler:
+    return CommandHandler(name, timed(name, handler))
 
 # Register handlers
-telegram_app.add_handler(CommandHandler("start", cmd_start))
-telegram_app.add_handler(CommandHandler("help", cmd_help))
-telegram_app.add_handler(CallbackQueryHandler(callback_help))
-telegram_app.add_handler(CommandHandler("invite", cmd_invite))
-telegram_app.add_handler(CommandHandler("status", cmd_status))
-telegram_app.add_handler(CommandHandler("addlinks", cmd_addlinks))
-telegram_app.add_handler(CommandHandler("showlinks", cmd_showlinks))
-telegram_app.add_handler(CommandHandler("removelink", cmd_removelink))
-telegram_app.add_handler(CommandHandler("leaderboard", cmd_leaderboard))
+telegram_app.add_handler(TypeHandler(Update, throttle_update), group=-2)
+if SHARED_STATE:
+    telegram_app.add_handler(TypeHandler(Update, refresh_state), group=-1)
+telegram_app.add_handler(command("start", cmd_start))
+telegram_app.add_handler(command("help", cmd_help))
+telegram_app.add_handler(CallbackQueryHandler(timed("help_callback", callback_help)))
+telegram_app.add_handler(command("invite", cmd_invite))
+telegram_app.add_handler(command("status", cmd_status))
+telegram_app.add_handler(command("addlinks", cmd_addlinks))
+telegram_app.add_handler(command("showlinks", cmd_showlinks))
+telegram_app.add_handler(command("removelink", cmd_removelink))
+telegram_app.add_handler(command("leaderboard", cmd_leaderboard))
 
 # admin handlers
-telegram_app.add_handler(CommandHandler("setchat", admin_setchat))
-telegram_app.add_handler(CommandHandler("setinterval", admin_setinterval))
-telegram_app.add_handler(CommandHandler("startrotation", admin_startrotation))
-telegram_app.add_handler(CommandHandler("stoprotation", admin_stoprotation))
-telegram_app.add_handler(CommandHandler("broadcast", admin_broadcast))
-telegram_app.add_handler(CommandHandler("getbackup", admin_getbackup))
-
-@telegram_app.post(WEBHOOK_PATH)  # type: ignore
-async def telegram_webhoo
+telegram_app.add_handler(command("setchat", admin_setchat))
+telegram_app.add_handler(command("removechat", admin_removechat))
+telegram_app.add_handler(command("chats", admin_chats))
+telegram_app.add_handler(command("setinterval", admin_setinterval))
+telegram_app.add_handler(command("setuserinterval", admin_setuserinterval))
+telegram_app.add_handler(command("startrotation", admin_startrotation))
+telegram_app.add_handler(command("stoprotation", admin_stoprotation))
+telegram_app.add_handler(command("broadcast", admin_broadcast))
+telegram_app.add_handler(command("getbackup", admin_getbackup))
+telegram_app.add_handler(command("ratelimits", admin_ratelimits))
+telegram_app.add_handler(command("stats", admin_stats))
+
+# ---------------------------
+# Update ingestion (webhook queue)
+# ---------------------------
+class UpdateIngest:
+    """Bounded queue between the webhook route and the handler pool.
+
+    The route only parses the JSON body and enqueues it, so Telegram gets its
+    200 right away. Redelivered update_ids (seen in the last `dedup_size`
+    updates) are acknowledged and dropped. When the queue stays full for
+    `enqueue_timeout` seconds the route answers 503 and Telegram retries the
+    delivery later.
+    """
+
+    def __init__(self, maxsize: int, workers: int, dedup_size: int, enqueue_timeout: float):
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.workers = workers
+        self.enqueue_timeout = enqueue_timeout
+        self.dedup_size = dedup_size
+        self._seen = set()
+        self._seen_order = deque()
+        self._tasks = []
+        self.duplicates = 0
+        self.rejected = 0
+
+    def _remember(self, update_id: int):
+        self._seen.add(update_id)
+        self._seen_order.append(update_id)
+        if len(self._seen_order) > self.dedup_size:
+            self._seen.discard(self._seen_order.popleft())
+
+    async def put(self, payload: Dict[str, Any]) -> int:
+        """Enqueue one update; returns the HTTP status for Telegram."""
+        update_id = payload.get("update_id")
+        if update_id in self._seen:
+            self.duplicates += 1
+            return 200
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(self.queue.put(payload), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return 503
+        if update_id is not None:
+            self._remember(update_id)
+        return 200
+
+    async def _consume(self, application):
+        while True:
+            payload = await self.queue.get()
+            try:
+                update = Update.de_json(payload, application.bot)
+                await application.process_update(update)
+            except Exception as e:
+                logger.exception("Update %s failed: %s", payload.get("update_id"), e)
+            finally:
+                self.queue.task_done()
+
+    def start(self, application):
+        self._tasks = [asyncio.create_task(self._consume(application)) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 10):
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            logger.info("Shutting down with %d updates still queued", self.queue.qsize())
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+ingest = UpdateIngest(WEBHOOK_QUEUE_SIZE, UPDATE_WORKERS, WEBHOOK_DEDUP_SIZE, WEBHOOK_ENQUEUE_TIMEOUT)
+background_tasks: List[asyncio.Task] = []
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return Response(status_code=403)
+    try:
+        payload = await request.json()
+    except ValueError:
+        return Response(status_code=400)
+    if not isinstance(payload, dict):
+        return Response(status_code=400)   # valid JSON, but not an Update object
+    return Response(status_code=await ingest.put(payload))
+
+# ---------------------------
+# Metrics
+# ---------------------------
+# state gauges are read at scrape time only
+registry.gauge_fn("smartlink_pool_links", "Links waiting in the rotation pool.", lambda: len(store.links))
+registry.gauge_fn("smartlink_users", "Known users.", lambda: len(store.users))
+registry.gauge_fn("smartlink_outbox_depth", "Messages waiting in the outbound dispatcher.", lambda: len(outbox))
+registry.gauge_fn("smartlink_webhook_queue_depth", "Updates queued between webhook and handlers.",
+                  lambda: ingest.queue.qsize())
+registry.counter_fn("smartlink_webhook_duplicates_total", "Redelivered updates dropped.", lambda: ingest.duplicates)
+registry.counter_fn("smartlink_webhook_rejected_total", "Updates answered 503 (queue full).", lambda: ingest.rejected)
+registry.counter_fn("smartlink_saves_total", "Write-behind flushes.", lambda: persister.flushes)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return Response(registry.render(), media_type=CONTENT_TYPE)
+
+@app.on_event("startup")
+async def on_startup():
+    if SHARED_STATE and BOT_MODE == "polling":
+        raise RuntimeError("SHARED_STATE=1 needs BOT_MODE=webhook (only one process may poll)")
+    await telegram_app.initialize()
+    await telegram_app.start()
+    bot_identity.update(telegram_app.bot.username)   # initialize() already called getMe
+    background_tasks.append(asyncio.create_task(identity_worker(telegram_app.bot)))
+    if BOT_MODE == "polling":
+        # local runs: no public URL needed, PTB fetches updates itself
+        await telegram_app.updater.start_polling()
+    else:
+        ingest.start(telegram_app)
+        if SERVICE_URL:
+            await telegram_app.bot.set_webhook(
+                f"{SERVICE_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+            )
+    outbox.start(telegram_app.bot)
+    if lease is None:
+        start_leader_tasks()
+    else:
+        background_tasks.append(asyncio.create_task(lease.run(start_leader_tasks, stop_leader_tasks)))
+    logger.info("SmartLink Hub started (%s mode, %s storage%s)", BOT_MODE, store.backend.name,
+                ", shared" if SHARED_STATE else "")
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if BOT_MODE == "polling":
+        await telegram_app.updater.stop()
+    else:
+        await ingest.stop()
+    for t in background_tasks:
+        t.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await stop_leader_tasks()
+    await outbox.stop()
+    await asyncio.get_running_loop().run_in_executor(None, events_executor.shutdown)   # queued appends
+    if lease is not None:
+        lease.release()
+    await telegram_app.stop()
+    await telegram_app.shutdown()
+    # flush-on-shutdown, after the last handler has run
+    await persister.close()
+    store.backend.close()
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8000")))
@@ -0,0 +1,194 @@
+# metrics.py
+# Minimal in-process Prometheus metrics for SmartLink Hub.
+#
+# Hot paths only touch preallocated objects: Histogram.observe() is a bisect
+# plus two additions on a fixed bucket list, Counter.inc() a single addition.
+# Labelled children are created once (at import or on first use of a label)
+# and looked up from a dict afterwards. Gauges that mirror existing state are
+# callbacks evaluated only when /metrics is scraped. Nothing is formatted
+# until render() runs.
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# seconds; covers sub-millisecond in-memory handlers up to slow API calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOCK_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+LAG_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0, 60.0, 300.0, 900.0)
+BYTES_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+
+def _labels_text(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{str(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._default = self._new_child()
+            self._children[()] = self._default
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values) -> object:
+        """Child for these label values; keep the result around on hot paths."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return "\n".join(lines)
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1):
+        self._default.value += amount
+
+    def _samples(self):
+        return [f"{self.name}{_labels_text(self.labelnames, k)} {_num(c.value)}" for k, c in self._children.items()]
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def _samples(self):
+        out = []
+        for key, child in self._children.items():
+            running = 0
+            for bound, n in zip(self.buckets + (float("inf"),), child.counts):
+                running += n
+                labels = _labels_text(self.labelnames + ("le",), key + (_num(bound),))
+                out.append(f"{self.name}_bucket{labels} {running}")
+            labels = _labels_text(self.labelnames, key)
+            out.append(f"{self.name}_sum{labels} {_num(child.sum)}")
+            out.append(f"{self.name}_count{labels} {running}")
+        return out
+
+class CallbackMetric(_Metric):
+    """Gauge (or counter) whose value is read from `fn` at scrape time."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float], kind: str = "gauge"):
+        self.fn = fn
+        self.kind = kind
+        super().__init__(name, help)
+
+    def _new_child(self):
+        return None
+
+    def _samples(self):
+        return [f"{self.name} {_num(self.fn())}"]
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge_fn(self, name: str, help: str, fn: Callable[[], float]) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, fn))
+
+    def counter_fn(self, name: str, help: str, fn: Callable[[], float]) -> CallbackMetric:
+        return self.register(CallbackMetric(name, help, fn, kind="counter"))
+
+    def render(self) -> str:
+        """Prometheus text exposition format 0.0.4."""
+        return "\n".join(m.render() for m in self._metrics) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+
+# ---------------------------
+# SmartLink Hub metrics
+# ---------------------------
+HANDLER_SECONDS = registry.histogram(
+    "smartlink_handler_seconds", "Command/callback handler latency, including the reply.", ("handler",))
+HANDLER_ERRORS = registry.counter(
+    "smartlink_handler_errors_total", "Handler calls that raised.", ("handler",))
+LOCK_WAIT_SECONDS = registry.histogram(
+    "smartlink_lock_wait_seconds", "Time spent waiting to acquire a state lock.", ("lock",), LOCK_BUCKETS)
+LOCK_HOLD_SECONDS = registry.histogram(
+    "smartlink_lock_hold_seconds", "Time a state lock was held.", ("lock",), LOCK_BUCKETS)
+SAVE_SECONDS = registry.histogram(
+    "smartlink_save_seconds", "save_data cost: snapshot capture on the event loop, write in the save thread.",
+    ("phase",))
+SAVE_BYTES = registry.histogram(
+    "smartlink_save_bytes", "Bytes written per save (row payload for SQLite).", (), BYTES_BUCKETS)
+TELEGRAM_SECONDS = registry.histogram(
+    "smartlink_telegram_request_seconds", "Outbound Bot API call latency.", ("method",))
+TELEGRAM_ERRORS = registry.counter(
+    "smartlink_telegram_errors_total", "Failed Bot API calls by error type (RetryAfter = flood control).",
+    ("method", "error"))
+ROTATION_LAG_SECONDS = registry.histogram(
+    "smartlink_rotation_lag_seconds", "Actual minus scheduled rotation post time.", (), LAG_BUCKETS)
+LINKS_SUBMITTED = registry.counter(
+    "smartlink_links_submitted_total", "Links sent to /addlinks by outcome (accepted, duplicate, rejected, over_limit).",
+    ("outcome",))
+THROTTLED = registry.counter(
+    "smartlink_throttled_total", "Inbound commands/callbacks dropped by the rate limiter.", ("scope",))
+OUTBOX_MESSAGES = registry.counter(
+    "smartlink_outbox_messages_total", "Outbound dispatcher results (sent, retried, dropped, coalesced).", ("outcome",))
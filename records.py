@@ -0,0 +1,109 @@
+# records.py
+# Compact in-memory records for SmartLink Hub.
+#
+# Users and links are the collections that grow with the community, so they
+# are __slots__ objects (no per-instance dict), users are keyed by int id and
+# timestamps are epoch seconds. A link only keeps its owner's id; the
+# username lives on the User. The on-disk formats (data.json, SQLite rows,
+# backups) are unchanged: from_json/to_json convert at the persistence
+# boundary.
+import calendar
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional
+
+class User:
+    __slots__ = ("username", "token", "invites", "links_added", "limit", "interval")
+
+    def __init__(self, username: str = "", token: str = "", invites: int = 0, links_added: int = 0,
+                 limit: int = 5, interval: Optional[int] = None):
+        self.username = username
+        self.token = token
+        self.invites = invites
+        self.links_added = links_added
+        self.limit = limit
+        self.interval = interval   # optional per-user interval (minutes)
+
+    def copy(self) -> "User":
+        return User(self.username, self.token, self.invites, self.links_added, self.limit, self.interval)
+
+    @classmethod
+    def from_json(cls, d: Dict[str, Any]) -> "User":
+        return cls(d.get("username") or "", d.get("token", ""), d.get("invites", 0), d.get("links_added", 0),
+                   d.get("limit", 5), d.get("interval"))
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "username": self.username,
+            "token": self.token,
+            "invites": self.invites,
+            "links_added": self.links_added,
+            "limit": self.limit,
+            "interval": self.interval,
+        }
+
+    def __repr__(self):
+        return f"User({self.to_json()!r})"
+
+class Link:
+    """A link in the rotation pool. Never mutated once created."""
+
+    __slots__ = ("id", "link", "owner_id", "added_at")
+
+    def __init__(self, id: int, link: str, owner_id: int, added_at: int):
+        self.id = id
+        self.link = link
+        self.owner_id = owner_id
+        self.added_at = added_at   # epoch seconds
+
+    @classmethod
+    def from_json(cls, d: Dict[str, Any]) -> "Link":
+        return cls(d["id"], d["link"], d["owner_id"], iso_to_epoch(d.get("added_at")))
+
+    def to_json(self, owner_username: str = "") -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "link": self.link,
+            "owner_id": self.owner_id,
+            "owner_username": owner_username,
+            "added_at": epoch_to_iso(self.added_at),
+        }
+
+    def __repr__(self):
+        return f"Link({self.id}, {self.link!r}, owner={self.owner_id})"
+
+def iso_to_epoch(value) -> int:
+    """data.json stores naive UTC ISO strings (datetime.utcnow().isoformat())."""
+    if value is None:
+        return 0
+    if isinstance(value, (int, float)):
+        return int(value)
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return calendar.timegm(dt.timetuple())
+
+def epoch_to_iso(ts: int) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None).isoformat()
+
+def owner_name(users: Dict[int, User], owner_id: int) -> str:
+    u = users.get(owner_id)
+    return u.username if u is not None else ""
+
+def state_from_json(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON-shaped state (string user ids, link dicts) -> in-memory records."""
+    return {
+        "settings": raw["settings"],
+        "users": {int(uid): User.from_json(u) for uid, u in raw["users"].items()},
+        "links": [Link.from_json(l) for l in raw["links"]],
+        "referrals": {token: int(uid) for token, uid in raw["referrals"].items()},
+    }
+
+def state_to_json(state: Dict[str, Any]) -> Dict[str, Any]:
+    """In-memory records -> the data.json shape (also used for backups)."""
+    users = state["users"]
+    return {
+        "settings": state["settings"],
+        "links": [l.to_json(owner_name(users, l.owner_id)) for l in state["links"]],
+        "users": {str(uid): u.to_json() for uid, u in users.items()},
+        "referrals": dict(state["referrals"].items()),
+    }
@@ -0,0 +1,808 @@
+# storage.py
+# Storage backends for SmartLink Hub.
+#
+# Both backends load the full state into the dict the bot works on
+# ({"settings", "links", "users", "referrals"}, with User/Link records from
+# records.py) and persist changes handed to them by the write-behind flusher
+# in main.py; the on-disk formats are unchanged and converted here:
+#   - JsonStorage rewrites data.json from a point-in-time snapshot
+#   - SqliteStorage applies only the rows that changed (WAL mode, indexed tables)
+#   - SnapshotStorage rewrites a binary, memory-mapped data.snap whose users
+#     are decoded lazily, for fast cold starts on large datasets
+#
+# With SHARED_STATE=1 several bot processes share one SQLite file: each write
+# is its own transaction that also appends to a changelog, which the other
+# processes replay to keep their in-memory state current. A lease row elects
+# the single process that runs rotation/backups.
+#
+# One-shot migration / conversion of an existing data.json:
+#   python storage.py migrate --json data.json --db data.db
+#   python storage.py convert --json data.json --snapshot data.snap
+import os
+import json
+import mmap
+import time
+import heapq
+import struct
+import sqlite3
+import argparse
+import logging
+from contextlib import contextmanager
+from collections.abc import Mapping, MutableMapping
+from typing import Dict, Any, List, Optional
+
+from records import User, Link, state_from_json, state_to_json, owner_name, iso_to_epoch, epoch_to_iso
+
+logger = logging.getLogger("smartlink-hub")
+
+DEFAULT_SETTINGS = {
+    "interval": 30,      # default interval (minutes) for new target chats
+    "last_link": None,
+    "chats": {}          # target chat -> rotation schedule (see main.new_chat)
+}
+
+def empty_state(default_interval: int = 30) -> Dict[str, Any]:
+    settings = json.loads(json.dumps(DEFAULT_SETTINGS))
+    settings["interval"] = default_interval
+    return {
+        "settings": settings,
+        # links: list of Link (data.json: { "id", "link", "owner_id", "owner_username", "added_at": iso })
+        "links": [],
+        # users: int user id -> User (data.json: str id -> { "username", "token", "invites", ... })
+        "users": {},
+        # referrals: token -> referrer_userid
+        "referrals": {}
+    }
+
+@contextmanager
+def atomic_file(path: str):
+    """Binary file to write `path` through: a temp file next to it that is
+    fsynced and swapped in on a clean exit (removed on error), so readers
+    only ever see the old or the new contents."""
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    os.replace(tmp, path)
+
+def write_atomic(path: str, raw: bytes) -> int:
+    with atomic_file(path) as f:
+        f.write(raw)
+    return len(raw)
+
+def write_json_atomic(path: str, payload: Dict[str, Any]) -> int:
+    return write_atomic(path, json.dumps(payload, separators=(",", ":")).encode())
+
+class ChangeSet:
+    """Keys touched since the last flush. Values are read back at capture time."""
+
+    def __init__(self):
+        self.users = set()        # int user ids
+        self.referrals = set()    # tokens
+        self.added_links = []     # Link records (immutable once added)
+        self.removed_links = set()  # link ids
+        self.settings = False
+
+    def __bool__(self):
+        return bool(self.users or self.referrals or self.added_links or self.removed_links or self.settings)
+
+    def merge(self, other: "ChangeSet"):
+        # used to re-queue a batch whose write failed; `other` is the older batch
+        self.users |= other.users
+        self.referrals |= other.referrals
+        self.added_links = other.added_links + self.added_links
+        self.removed_links |= other.removed_links
+        self.settings = self.settings or other.settings
+
+class Storage:
+    """Backend interface.
+
+    load() runs once at startup. capture() runs on the event loop and must copy
+    everything write() needs; write() runs in the persistence thread.
+    Backends with full_snapshot set get a point-in-time Store.snapshot()
+    instead of the live state.
+    """
+
+    name = "base"
+    full_snapshot = False
+
+    def load(self, default_interval: int) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    def capture(self, state: Dict[str, Any], changes: ChangeSet) -> Any:
+        raise NotImplementedError
+
+    def write(self, payload: Any) -> int:
+        """Persist a captured payload; returns (approximate) bytes written."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class JsonStorage(Storage):
+    name = "json"
+    full_snapshot = True
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, default_interval: int) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            base = empty_state(default_interval)
+            write_json_atomic(self.path, base)
+            return base
+        with open(self.path, "r") as f:
+            raw = json.load(f)
+        assign_link_ids(raw)
+        return state_from_json(raw)
+
+    def capture(self, state, changes):
+        # the whole file is rewritten from the snapshot, so individual changes don't matter
+        return state
+
+    def write(self, payload):
+        return write_json_atomic(self.path, state_to_json(payload))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id          INTEGER PRIMARY KEY,
+    username    TEXT NOT NULL DEFAULT '',
+    token       TEXT NOT NULL,
+    invites     INTEGER NOT NULL DEFAULT 0,
+    links_added INTEGER NOT NULL DEFAULT 0,
+    "limit"     INTEGER NOT NULL DEFAULT 5,
+    interval    INTEGER
+);
+CREATE INDEX IF NOT EXISTS users_invites ON users(invites);
+CREATE TABLE IF NOT EXISTS links (
+    id             INTEGER PRIMARY KEY,   -- insertion order
+    link           TEXT NOT NULL,
+    owner_id       INTEGER NOT NULL,
+    owner_username TEXT NOT NULL DEFAULT '',
+    added_at       TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS links_owner ON links(owner_id, id);
+CREATE TABLE IF NOT EXISTS referrals (
+    token   TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS settings (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+-- shared (multi-process) mode: what each committed transaction touched, so
+-- other processes can refresh just those rows in their in-memory cache
+CREATE TABLE IF NOT EXISTS changelog (
+    seq  INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,      -- user | referral | link_add | link_del | settings
+    key  TEXT NOT NULL,
+    pid  TEXT NOT NULL       -- writer, so a process can skip its own entries
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name    TEXT PRIMARY KEY,
+    holder  TEXT NOT NULL,
+    expires REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+class DatabaseBusy(Exception):
+    """Another process held the SQLite write lock for longer than busy_timeout."""
+
+class SqliteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        # only ever used from one thread at a time (the persistence executor,
+        # or the caller during startup/shutdown)
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        self.conn.executescript(SCHEMA)
+
+    def set_busy_timeout(self, ms: int):
+        # shared mode runs transactions on the event loop: fail fast, retry async
+        self.conn.execute(f"PRAGMA busy_timeout={int(ms)}")
+
+    def load(self, default_interval: int) -> Dict[str, Any]:
+        state = empty_state(default_interval)
+        for key, value in self.conn.execute("SELECT key, value FROM settings"):
+            state["settings"][key] = json.loads(value)
+        for row in self.conn.execute('SELECT id, username, token, invites, links_added, "limit", interval FROM users'):
+            state["users"][row[0]] = User(*row[1:])
+        # links that arrived in one /addlinks share their added_at text; parse it once
+        last_text, last_ts = None, 0
+        for row in self.conn.execute("SELECT id, link, owner_id, added_at FROM links ORDER BY id"):
+            if row[3] != last_text:
+                last_text, last_ts = row[3], iso_to_epoch(row[3])
+            state["links"].append(Link(row[0], row[1], row[2], last_ts))
+        state["referrals"] = dict(self.conn.execute("SELECT token, user_id FROM referrals"))
+        return state
+
+    def capture(self, state, changes):
+        users = []
+        for uid in changes.users:
+            u = state["users"].get(uid)
+            if u is not None:
+                users.append((uid, u.username, u.token, u.invites, u.links_added, u.limit, u.interval))
+        referrals = []
+        for token in changes.referrals:
+            if token in state["referrals"]:
+                referrals.append((token, state["referrals"][token]))
+        # owner_username / ISO added_at keep the table readable by older versions
+        links = [
+            (l.id, l.link, l.owner_id, owner_name(state["users"], l.owner_id), epoch_to_iso(l.added_at))
+            for l in changes.added_links
+        ]
+        settings = None
+        if changes.settings:
+            settings = [(k, json.dumps(v)) for k, v in state["settings"].items()]
+        return {
+            "users": users,
+            "referrals": referrals,
+            "links": links,
+            "removed_links": [(i,) for i in changes.removed_links],
+            "settings": settings,
+        }
+
+    def write(self, payload):
+        self.write_rows(payload)
+        return payload_bytes(payload)
+
+    def write_rows(self, payload):
+        c = self.conn
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            self.apply_rows(payload)
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+
+    def apply_rows(self, payload):
+        # caller owns the transaction
+        c = self.conn
+        if payload["users"]:
+            c.executemany(
+                'INSERT OR REPLACE INTO users (id, username, token, invites, links_added, "limit", interval) '
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", payload["users"])
+        if payload["referrals"]:
+            c.executemany("INSERT OR REPLACE INTO referrals (token, user_id) VALUES (?, ?)", payload["referrals"])
+        if payload["links"]:
+            c.executemany(
+                "INSERT OR REPLACE INTO links (id, link, owner_id, owner_username, added_at) VALUES (?, ?, ?, ?, ?)",
+                payload["links"])
+        if payload["removed_links"]:
+            c.executemany("DELETE FROM links WHERE id = ?", payload["removed_links"])
+        if payload["settings"]:
+            # settings are small; replace the whole table so dropped keys go away
+            c.execute("DELETE FROM settings")
+            c.executemany("INSERT INTO settings (key, value) VALUES (?, ?)", payload["settings"])
+
+    # --- shared (multi-process) mode ---
+    def begin(self):
+        # takes the database write lock up front (waits up to busy_timeout)
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.OperationalError as e:
+            if (e.sqlite_errorcode & 0xff) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED):
+                raise DatabaseBusy(str(e)) from e
+            raise
+
+    def commit(self):
+        self.conn.execute("COMMIT")
+
+    def rollback(self):
+        self.conn.execute("ROLLBACK")
+
+    def data_version(self) -> int:
+        # changes whenever *another* connection commits
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def log_changes(self, changes: ChangeSet, pid: str):
+        rows = [("user", str(uid), pid) for uid in changes.users]
+        rows += [("referral", t, pid) for t in changes.referrals]
+        rows += [("link_add", str(l.id), pid) for l in changes.added_links]
+        rows += [("link_del", str(i), pid) for i in changes.removed_links]
+        if changes.settings:
+            rows.append(("settings", "", pid))
+        self.conn.executemany("INSERT INTO changelog (kind, key, pid) VALUES (?, ?, ?)", rows)
+
+    def changelog_bounds(self):
+        return self.conn.execute("SELECT COALESCE(MIN(seq), 0), COALESCE(MAX(seq), 0) FROM changelog").fetchone()
+
+    def changes_since(self, seq: int):
+        return self.conn.execute("SELECT seq, kind, key, pid FROM changelog WHERE seq > ? ORDER BY seq", (seq,)).fetchall()
+
+    def prune_changelog(self, keep: int):
+        self.conn.execute("DELETE FROM changelog WHERE seq <= (SELECT MAX(seq) FROM changelog) - ?", (keep,))
+
+    def load_user(self, uid: int) -> Optional[User]:
+        row = self.conn.execute(
+            'SELECT username, token, invites, links_added, "limit", interval FROM users WHERE id = ?', (uid,)).fetchone()
+        return User(*row) if row else None
+
+    def load_referral(self, token: str) -> Optional[int]:
+        row = self.conn.execute("SELECT user_id FROM referrals WHERE token = ?", (token,)).fetchone()
+        return row[0] if row else None
+
+    def load_link(self, link_id: int) -> Optional[Link]:
+        row = self.conn.execute("SELECT id, link, owner_id, added_at FROM links WHERE id = ?", (link_id,)).fetchone()
+        if row is None:
+            return None
+        return Link(row[0], row[1], row[2], iso_to_epoch(row[3]))
+
+    def load_settings(self) -> Dict[str, Any]:
+        return {key: json.loads(value) for key, value in self.conn.execute("SELECT key, value FROM settings")}
+
+    def acquire_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Take or renew a named lease; False if someone else holds an unexpired one."""
+        now = time.time()
+        self.begin()
+        try:
+            row = self.conn.execute("SELECT holder, expires FROM leases WHERE name = ?", (name,)).fetchone()
+            if row and row[0] != holder and row[1] > now:
+                self.commit()
+                return False
+            self.conn.execute(
+                "INSERT OR REPLACE INTO leases (name, holder, expires) VALUES (?, ?, ?)", (name, holder, now + ttl))
+            self.commit()
+            return True
+        except Exception:
+            self.rollback()
+            raise
+
+    def release_lease(self, name: str, holder: str):
+        self.conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def close(self):
+        self.conn.close()
+
+# ---------------------------
+# Binary snapshot backend
+# ---------------------------
+# data.snap layout (little-endian). All sections are length-prefixed or use
+# fixed-size entries so the file can be memory-mapped and read in place:
+#   magic "SLHSNAP1" | u64 offset of the footer | sections... | footer
+#   footer:     u32 length + JSON {section: [offset, size, count]}
+#   settings:   JSON
+#   links:      per link: id, owner_id, added_at (i64 x3), u32 len + utf-8 link, in rotation order
+#   users_data: per user: invites, links_added, limit (u32 x3), interval (i32, -1 = none),
+#               u16 len(username), u16 len(token), username, token
+#   users_idx:  per user, sorted by id: id (i64), invites (u32), offset into users_data (u64)
+#   refs_data:  token bytes
+#   refs_idx:   per token, sorted by token bytes: offset into refs_data (u64), u16 length, user id (i64)
+# Settings and links are decoded at startup; users and referrals are looked
+# up by binary search on first access and only then become objects.
+SNAPSHOT_MAGIC = b"SLHSNAP1"
+_U64 = struct.Struct("<Q")
+_U32 = struct.Struct("<I")
+_LINK_HEAD = struct.Struct("<qqqI")
+_USER_HEAD = struct.Struct("<IIIiHH")
+_USER_IDX = struct.Struct("<qIQ")
+_REF_IDX = struct.Struct("<QHq")
+
+def encode_user(u: User) -> bytes:
+    name, token = u.username.encode(), u.token.encode()
+    interval = -1 if u.interval is None else u.interval
+    return _USER_HEAD.pack(u.invites, u.links_added, u.limit, interval, len(name), len(token)) + name + token
+
+class MappedSnapshot:
+    """Read-only view of a data.snap file through mmap."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self.mm
+        if mm[:8] != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} is not a SmartLink Hub snapshot")
+        footer = _U64.unpack_from(mm, 8)[0]
+        size = _U32.unpack_from(mm, footer)[0]
+        self.sections = json.loads(mm[footer + 4:footer + 4 + size])
+        self.user_count = self.sections["users_idx"][2]
+        self.ref_count = self.sections["refs_idx"][2]
+
+    def settings(self) -> Dict[str, Any]:
+        off, size, _ = self.sections["settings"]
+        return json.loads(self.mm[off:off + size])
+
+    def links(self) -> List[Link]:
+        mm, (pos, _, count) = self.mm, self.sections["links"]
+        out = []
+        head, unpack = _LINK_HEAD.size, _LINK_HEAD.unpack_from
+        for _ in range(count):
+            link_id, owner_id, added_at, n = unpack(mm, pos)
+            pos += head
+            out.append(Link(link_id, mm[pos:pos + n].decode(), owner_id, added_at))
+            pos += n
+        return out
+
+    # --- users ---
+    def _user_index(self, i: int):
+        return _USER_IDX.unpack_from(self.mm, self.sections["users_idx"][0] + i * _USER_IDX.size)
+
+    def user_offset(self, uid: int) -> Optional[int]:
+        lo, hi = 0, self.user_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, _, off = self._user_index(mid)
+            if key < uid:
+                lo = mid + 1
+            elif key > uid:
+                hi = mid
+            else:
+                return off
+        return None
+
+    def user_raw(self, off: int) -> bytes:
+        start = self.sections["users_data"][0] + off
+        head = _USER_HEAD.unpack_from(self.mm, start)
+        return self.mm[start:start + _USER_HEAD.size + head[4] + head[5]]
+
+    def decode_user(self, off: int) -> User:
+        start = self.sections["users_data"][0] + off
+        invites, links_added, limit, interval, n_name, n_token = _USER_HEAD.unpack_from(self.mm, start)
+        pos = start + _USER_HEAD.size
+        name = self.mm[pos:pos + n_name].decode()
+        token = self.mm[pos + n_name:pos + n_name + n_token].decode()
+        return User(name, token, invites, links_added, limit, None if interval < 0 else interval)
+
+    def find_user(self, uid: int) -> Optional[User]:
+        off = self.user_offset(uid)
+        return None if off is None else self.decode_user(off)
+
+    def iter_user_index(self):
+        """(user id, invites, offset) in id order, without decoding records."""
+        off, size, _ = self.sections["users_idx"]
+        return _USER_IDX.iter_unpack(self.mm[off:off + size])
+
+    # --- referrals ---
+    def _token_at(self, i: int):
+        off, n, uid = _REF_IDX.unpack_from(self.mm, self.sections["refs_idx"][0] + i * _REF_IDX.size)
+        start = self.sections["refs_data"][0] + off
+        return self.mm[start:start + n], uid
+
+    def find_referral(self, token: str) -> Optional[int]:
+        key = token.encode()
+        lo, hi = 0, self.ref_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            t, uid = self._token_at(mid)
+            if t < key:
+                lo = mid + 1
+            elif t > key:
+                hi = mid
+            else:
+                return uid
+        return None
+
+    def iter_referrals(self):
+        """(token bytes, user id) in token order."""
+        for i in range(self.ref_count):
+            yield self._token_at(i)
+
+class MappedUsersView(Mapping):
+    """int user id -> User over a snapshot file, with newer records in front.
+
+    This read-only form is what Store.snapshot() hands to the persistence
+    thread; MappedUsers below is the live, writable one.
+    """
+
+    def __init__(self, snap: MappedSnapshot, live: Dict[int, User], new: set):
+        self._snap = snap
+        self._live = live   # decoded or changed records
+        self._new = new     # ids created since the file was written
+
+    def __getitem__(self, uid: int) -> User:
+        u = self._live.get(uid)
+        if u is None:
+            u = self._snap.find_user(uid)
+            if u is None:
+                raise KeyError(uid)
+        return u
+
+    def __len__(self):
+        return self._snap.user_count + len(self._new)
+
+    def __iter__(self):
+        for uid, _, _ in self._snap.iter_user_index():
+            yield uid
+        yield from self._new
+
+    @property
+    def decoded(self) -> int:
+        """Users currently held as objects."""
+        return len(self._live)
+
+    def items(self):
+        live, snap = self._live, self._snap
+        for uid, _, off in snap.iter_user_index():
+            u = live.get(uid)
+            yield uid, (u if u is not None else snap.decode_user(off))
+        for uid in self._new:
+            yield uid, live[uid]
+
+    def invite_counts(self):
+        """(user id, invites) for every user, read from the index where possible."""
+        live = self._live
+        for uid, invites, _ in self._snap.iter_user_index():
+            u = live.get(uid)
+            yield uid, (u.invites if u is not None else invites)
+        for uid in self._new:
+            yield uid, live[uid].invites
+
+    def records(self):
+        """(user id, invites, encoded record) in id order; untouched records are copied raw."""
+        live, snap = self._live, self._snap
+        new = iter(sorted(self._new))
+        nxt = next(new, None)
+        for uid, invites, off in snap.iter_user_index():
+            while nxt is not None and nxt < uid:
+                yield nxt, live[nxt].invites, encode_user(live[nxt])
+                nxt = next(new, None)
+            u = live.get(uid)
+            if u is not None:
+                yield uid, u.invites, encode_user(u)
+            else:
+                yield uid, invites, snap.user_raw(off)
+        while nxt is not None:
+            yield nxt, live[nxt].invites, encode_user(live[nxt])
+            nxt = next(new, None)
+
+class MappedUsers(MappedUsersView, MutableMapping):
+    """Live user table: records are decoded on first access and kept; users are never deleted."""
+
+    def __init__(self, snap: MappedSnapshot):
+        super().__init__(snap, {}, set())
+
+    def __getitem__(self, uid: int) -> User:
+        u = self._live.get(uid)
+        if u is None:
+            u = self._live[uid] = super().__getitem__(uid)
+        return u
+
+    def __setitem__(self, uid: int, u: User):
+        if uid not in self._live and self._snap.user_offset(uid) is None:
+            self._new.add(uid)
+        self._live[uid] = u
+
+    def __delitem__(self, uid: int):
+        raise TypeError("users are never deleted")
+
+    def snapshot(self) -> MappedUsersView:
+        return MappedUsersView(self._snap, dict(self._live), set(self._new))
+
+class MappedReferralsView(Mapping):
+    """token -> referrer id over a snapshot file; newer tokens sit in a dict."""
+
+    def __init__(self, snap: MappedSnapshot, extra: Dict[str, int]):
+        self._snap = snap
+        self._extra = extra
+
+    def __getitem__(self, token: str) -> int:
+        uid = self._extra.get(token)
+        if uid is None:
+            uid = self._snap.find_referral(token)
+            if uid is None:
+                raise KeyError(token)
+        return uid
+
+    def __len__(self):
+        return self._snap.ref_count + len(self._extra)
+
+    def __iter__(self):
+        for token, _ in self._snap.iter_referrals():
+            yield token.decode()
+        yield from self._extra
+
+    def items(self):
+        for token, uid in self.records():
+            yield token.decode(), uid
+
+    def records(self):
+        """(token bytes, user id) in token byte order."""
+        extra = sorted((t.encode(), uid) for t, uid in self._extra.items())
+        return heapq.merge(self._snap.iter_referrals(), extra)
+
+class MappedReferrals(MappedReferralsView, MutableMapping):
+    def __init__(self, snap: MappedSnapshot):
+        super().__init__(snap, {})
+
+    def __setitem__(self, token: str, uid: int):
+        self._extra[token] = uid
+
+    def __delitem__(self, token: str):
+        raise TypeError("referral tokens are never deleted")
+
+    def snapshot(self) -> MappedReferralsView:
+        return MappedReferralsView(self._snap, dict(self._extra))
+
+def freeze(mapping):
+    """Point-in-time copy of a state mapping (cheap views for mmap-backed ones)."""
+    return mapping.snapshot() if hasattr(mapping, "snapshot") else dict(mapping)
+
+def invite_counts(users):
+    if hasattr(users, "invite_counts"):
+        return users.invite_counts()
+    return ((uid, u.invites) for uid, u in users.items())
+
+def write_snapshot(path: str, state: Dict[str, Any]) -> int:
+    """Write `state` (records or mapped views) as data.snap; returns the file size."""
+    users, refs = state["users"], state["referrals"]
+    if hasattr(users, "records"):
+        user_records = users.records()
+    else:
+        user_records = ((uid, users[uid].invites, encode_user(users[uid])) for uid in sorted(users))
+    if hasattr(refs, "records"):
+        ref_records = refs.records()
+    else:
+        ref_records = sorted((t.encode(), uid) for t, uid in refs.items())
+
+    sections = {}
+    with atomic_file(path) as f:
+        f.write(SNAPSHOT_MAGIC + _U64.pack(0))
+
+        def section(name: str, chunks, count: int = 0):
+            start, size = f.tell(), 0
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+            sections[name] = [start, size, count]
+
+        section("settings", [json.dumps(state["settings"], separators=(",", ":")).encode()])
+        links = state["links"]
+        if not isinstance(links, list):
+            links = list(links)
+        section("links", (_LINK_HEAD.pack(l.id, l.owner_id, l.added_at, len(b)) + b
+                          for l in links for b in (l.link.encode(),)), len(links))
+
+        index, offset = bytearray(), 0
+        def user_data():
+            nonlocal offset
+            for uid, invites, record in user_records:
+                index.extend(_USER_IDX.pack(uid, invites, offset))
+                offset += len(record)
+                yield record
+        section("users_data", user_data())
+        section("users_idx", [bytes(index)], len(index) // _USER_IDX.size)
+
+        index, offset = bytearray(), 0
+        def ref_data():
+            nonlocal offset
+            for token, uid in ref_records:
+                index.extend(_REF_IDX.pack(offset, len(token), uid))
+                offset += len(token)
+                yield token
+        section("refs_data", ref_data())
+        section("refs_idx", [bytes(index)], len(index) // _REF_IDX.size)
+
+        footer = f.tell()
+        raw = json.dumps(sections).encode()
+        f.write(_U32.pack(len(raw)) + raw)
+        size = f.tell()
+        f.seek(len(SNAPSHOT_MAGIC))
+        f.write(_U64.pack(footer))
+    return size
+
+class SnapshotStorage(Storage):
+    """Binary data.snap: settings and the rotation queue load at startup,
+    users and referrals are read from the memory-mapped file on demand.
+    An existing data.json is converted automatically on first start."""
+
+    name = "snapshot"
+    full_snapshot = True
+
+    def __init__(self, path: str, json_path: str):
+        self.path = path
+        self.json_path = json_path
+
+    def load(self, default_interval: int) -> Dict[str, Any]:
+        if not os.path.exists(self.path):
+            if os.path.exists(self.json_path):
+                started = time.perf_counter()
+                counts = convert_json_to_snapshot(self.json_path, self.path)
+                logger.info("Converted %s to %s in %.0f ms (%d users, %d links)", self.json_path, self.path,
+                            (time.perf_counter() - started) * 1000, counts["users"], counts["links"])
+            else:
+                write_snapshot(self.path, empty_state(default_interval))
+        snap = MappedSnapshot(self.path)
+        return {
+            "settings": snap.settings(),
+            "links": snap.links(),
+            "users": MappedUsers(snap),
+            "referrals": MappedReferrals(snap),
+        }
+
+    def capture(self, state, changes):
+        # rewritten from the snapshot; untouched user records are copied raw
+        return state
+
+    def write(self, payload):
+        return write_snapshot(self.path, payload)
+
+def convert_json_to_snapshot(json_path: str, snapshot_path: str) -> Dict[str, int]:
+    """One-shot conversion of data.json into data.snap."""
+    with open(json_path, "r") as f:
+        raw = json.load(f)
+    assign_link_ids(raw)
+    state = state_from_json(raw)
+    write_snapshot(snapshot_path, state)
+    return {"users": len(state["users"]), "links": len(state["links"]), "referrals": len(state["referrals"])}
+
+def payload_bytes(payload: Dict[str, Any]) -> int:
+    """Rough size of the row data in a SQLite payload (text length, 8 bytes per number)."""
+    total = 0
+    for key in ("users", "referrals", "links", "settings"):
+        for row in payload[key] or ():
+            for v in row:
+                total += len(v) if isinstance(v, str) else 8
+    return total + 8 * len(payload["removed_links"])
+
+def assign_link_ids(state: Dict[str, Any]) -> int:
+    """Give legacy links (pre-storage-layer data.json) a stable id; returns the next free id."""
+    next_id = 1 + max((l.get("id", 0) for l in state["links"]), default=0)
+    for l in state["links"]:
+        if "id" not in l:
+            l["id"] = next_id
+            next_id += 1
+    return next_id
+
+def open_storage(backend: str, json_path: str, sqlite_path: str, snapshot_path: str = "data.snap") -> Storage:
+    if backend == "sqlite":
+        return SqliteStorage(sqlite_path)
+    if backend == "snapshot":
+        return SnapshotStorage(snapshot_path, json_path)
+    if backend == "json":
+        return JsonStorage(json_path)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend!r}")
+
+def migrate_json_to_sqlite(json_path: str, sqlite_path: str) -> Dict[str, int]:
+    """Import an existing data.json into a (new or empty) SQLite database."""
+    with open(json_path, "r") as f:
+        raw = json.load(f)
+    assign_link_ids(raw)
+    state = state_from_json(raw)
+    db = SqliteStorage(sqlite_path)
+    try:
+        existing = db.conn.execute("SELECT (SELECT COUNT(*) FROM users) + (SELECT COUNT(*) FROM links)").fetchone()[0]
+        if existing:
+            raise RuntimeError(f"{sqlite_path} already contains data; refusing to migrate over it")
+        changes = ChangeSet()
+        changes.users = set(state["users"])
+        changes.referrals = set(state["referrals"])
+        changes.added_links = list(state["links"])
+        changes.settings = True
+        db.write_rows(db.capture(state, changes))
+    finally:
+        db.close()
+    return {"users": len(state["users"]), "links": len(state["links"]), "referrals": len(state["referrals"])}
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="SmartLink Hub storage tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    mig = sub.add_parser("migrate", help="import data.json into a SQLite database")
+    mig.add_argument("--json", default="data.json")
+    mig.add_argument("--db", default="data.db")
+    conv = sub.add_parser("convert", help="convert data.json into a binary data.snap")
+    conv.add_argument("--json", default="data.json")
+    conv.add_argument("--snapshot", default="data.snap")
+    args = parser.parse_args(argv)
+    if args.cmd == "migrate":
+        counts = migrate_json_to_sqlite(args.json, args.db)
+        print(f"Imported {counts['users']} users, {counts['links']} links, {counts['referrals']} referrals into {args.db}")
+    elif args.cmd == "convert":
+        counts = convert_json_to_snapshot(args.json, args.snapshot)
+        print(f"Converted {counts['users']} users, {counts['links']} links, {counts['referrals']} referrals into {args.snapshot}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+# tests/conftest.py
+# main.py reads its config at import time: point it at a scratch directory
+# before any test module imports it.
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_workdir = tempfile.mkdtemp(prefix="smartlink-test-")
+os.environ.setdefault("BOT_TOKEN", "0:test")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ["DATA_FILE"] = os.path.join(_workdir, "data.json")
+os.environ["EVENTS_FILE"] = os.path.join(_workdir, "events.log")
+os.environ["BACKUP_DIR"] = os.path.join(_workdir, "backups")
+os.environ["STORAGE_BACKEND"] = "json"
+os.environ.pop("SHARED_STATE", None)
@@ -0,0 +1,81 @@
+# tests/test_leaderboard.py
+# Leaderboard: incremental top K, ranks and the cached text.
+import random
+
+import main
+
+def test_top_orders_by_invites_then_arrival():
+    lb = main.Leaderboard(size=3)
+    for uid, invites in ((1, 5), (2, 7), (3, 5), (4, 0)):
+        lb.add(uid, invites)
+    assert lb.top() == [2, 1, 3]
+    lb.bump(3, 5, 6)
+    assert lb.top() == [2, 3, 1]
+    lb.bump(4, 0, 5)   # reached 5 after user 1
+    lb.bump(3, 6, 5)
+    assert lb.top() == [2, 1, 4]
+
+def test_rank_counts_users_strictly_ahead():
+    lb = main.Leaderboard()
+    for uid, invites in enumerate((0, 3, 3, 10, 1)):
+        lb.add(uid, invites)
+    assert lb.rank(10) == 1
+    assert lb.rank(3) == 2   # ties share the best rank
+    assert lb.rank(1) == 4
+    assert lb.rank(0) == 5
+    assert lb.rank(99) == 1
+
+def test_tree_grows_for_large_counts():
+    lb = main.Leaderboard()
+    lb.add(1, 0)
+    lb.add(2, 1000)
+    lb.bump(1, 0, 5000)
+    assert lb.top() == [1, 2]
+    assert lb.rank(5000) == 1 and lb.rank(1000) == 2 and lb.rank(4999) == 2
+
+def test_cached_text_is_dropped_only_when_top_can_change():
+    lb = main.Leaderboard(size=2)
+    for uid, invites in ((1, 10), (2, 8), (3, 1)):
+        lb.add(uid, invites)
+    lb.remember("cached", lb.top(), cutoff=8)
+    lb.add(4, 8)          # joins behind the tie: no change
+    lb.bump(3, 1, 2)      # below the cutoff, not shown
+    lb.touch(3)
+    assert lb.text == "cached"
+    lb.touch(2)           # shown user renamed
+    assert lb.text is None
+    lb.remember("cached", lb.top(), cutoff=8)
+    lb.bump(3, 2, 9)      # overtakes a shown user
+    assert lb.text is None
+    lb.remember("cached", lb.top(), cutoff=9)
+    lb.bump(1, 10, 11)    # shown user moves
+    assert lb.text is None
+
+def test_short_board_invalidates_on_any_newcomer():
+    lb = main.Leaderboard(size=3)
+    lb.add(1, 4)
+    lb.remember("cached", lb.top(), cutoff=4)
+    lb.add(2, 0)          # fewer than K shown, so anyone joins the board
+    assert lb.text is None
+
+def test_matches_brute_force_under_random_bumps():
+    rng = random.Random(3)
+    lb = main.Leaderboard(size=10)
+    invites, reached, clock = {}, {}, 0
+    for uid in range(200):
+        invites[uid] = 0
+        reached[uid] = clock = clock + 1
+        lb.add(uid, 0)
+    for _ in range(3000):
+        uid = rng.randrange(200)
+        old = invites[uid]
+        new = max(0, old + rng.choice((1, 1, 1, 2, -1)))
+        if new == old:
+            continue
+        invites[uid] = new
+        reached[uid] = clock = clock + 1
+        lb.bump(uid, old, new)
+    want = sorted(invites, key=lambda u: (-invites[u], reached[u]))[:10]
+    assert lb.top() == want
+    for uid in rng.sample(range(200), 30):
+        assert lb.rank(invites[uid]) == 1 + sum(1 for v in invites.values() if v > invites[uid])
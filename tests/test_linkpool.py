@@ -0,0 +1,100 @@
+# tests/test_linkpool.py
+# LinkPool: FIFO queue with tombstones, per-owner index and round-robin ring.
+import random
+
+import main
+from records import Link
+
+def pool_of(*owners):
+    return main.LinkPool(Link(i, f"https://t.me/l{i}", owner, 0) for i, owner in enumerate(owners, 1))
+
+def ids(links):
+    return [l.id for l in links]
+
+def test_fifo_order_and_indexes():
+    pool = pool_of(1, 2, 1, 3)
+    assert len(pool) == 4
+    assert ids(pool.owner_links(1)) == [1, 3]
+    assert pool.owner_count(3) == 1 and pool.owner_count(9) == 0
+    assert pool.has_url("https://t.me/l2")
+    assert pool.popleft().id == 1
+    assert ids(pool.owner_links(1)) == [3]
+    assert ids(pool) == [2, 3, 4]
+
+def test_remove_leaves_tombstones_that_popleft_skips():
+    pool = pool_of(1, 1, 2, 2)
+    assert pool.remove(pool.get(2)) and pool.remove(pool.get(1))
+    assert not pool.remove(Link(1, "https://t.me/l1", 1, 0))   # already gone
+    assert ids(pool) == [3, 4]
+    assert pool.get(1) is None and not pool.has_url("https://t.me/l1")
+    assert pool.owner_count(1) == 0
+    assert pool.popleft().id == 3
+    assert pool.popleft().id == 4
+    assert pool.popleft() is None and len(pool) == 0
+
+def test_tombstones_are_compacted():
+    pool = pool_of(*([1] * 3000))
+    for i in range(1, 2001):
+        pool.remove(pool.get(i))
+    # compaction kicks in once tombstones outnumber live links
+    assert pool._tombstones <= len(pool)
+    assert len(pool._queue) < 3000
+    assert ids(pool) == list(range(2001, 3001))
+
+def test_duplicate_urls_are_counted():
+    pool = main.LinkPool([Link(1, "https://t.me/x", 1, 0), Link(2, "https://t.me/x", 2, 0)])
+    pool.remove(pool.get(1))
+    assert pool.has_url("https://t.me/x")
+    pool.popleft()
+    assert not pool.has_url("https://t.me/x")
+
+def test_pop_fair_rotates_owners():
+    pool = pool_of(1, 1, 1, 2, 3, 3)
+    order = [pool.pop_fair() for _ in range(6)]
+    assert [(l.owner_id, l.id) for l in order] == [(1, 1), (2, 4), (3, 5), (1, 2), (3, 6), (1, 3)]
+    assert pool.pop_fair() is None
+
+def test_pop_fair_skips_ineligible_owners():
+    pool = pool_of(1, 2, 1)
+    assert pool.pop_fair(lambda owner: owner != 1).id == 2
+    assert pool.pop_fair(lambda owner: owner != 1) is None
+    assert ids(pool) == [1, 3]
+
+def test_pop_oldest_with_eligibility_and_scan_limit():
+    pool = pool_of(1, 1, 2, 1, 3)
+    assert pool.pop_oldest(lambda owner: owner != 1).id == 3
+    assert ids(pool) == [1, 2, 4, 5]
+    # the limit counts queue entries, including the tombstone left by id 3
+    assert pool.pop_oldest(lambda owner: owner == 3, scan_limit=4) is None
+    assert pool.pop_oldest(lambda owner: owner == 3, scan_limit=5).id == 5
+    assert pool.pop_oldest().id == 1
+
+def test_matches_a_plain_list_under_random_operations():
+    rng = random.Random(7)
+    pool, model, next_id = main.LinkPool(), [], 1
+    for _ in range(5000):
+        op = rng.random()
+        if op < 0.45 or not model:
+            link = Link(next_id, f"https://t.me/r{rng.randrange(50)}", rng.randrange(8), 0)
+            next_id += 1
+            pool.append(link)
+            model.append(link)
+        elif op < 0.65:
+            link = rng.choice(model)
+            assert pool.remove(link)
+            model.remove(link)
+        elif op < 0.85:
+            banned = rng.randrange(8)
+            got = pool.pop_oldest(lambda owner: owner != banned)
+            want = next((l for l in model if l.owner_id != banned), None)
+            assert got is want
+            if want is not None:
+                model.remove(want)
+        else:
+            assert pool.popleft() is model.pop(0)
+        assert len(pool) == len(model)
+    assert ids(pool) == ids(model)
+    for owner in range(8):
+        assert ids(pool.owner_links(owner)) == [l.id for l in model if l.owner_id == owner]
+    for url in {l.link for l in model}:
+        assert pool.has_url(url)
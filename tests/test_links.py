@@ -0,0 +1,69 @@
+# tests/test_links.py
+# Link canonicalization and the recently-rotated window used for dedup.
+import time
+
+import pytest
+
+import main
+from storage import JsonStorage
+
+@pytest.mark.parametrize("raw, canonical", [
+    ("https://t.me/+AbC", "https://t.me/+AbC"),
+    ("t.me/+AbC", "https://t.me/+AbC"),
+    ("  HTTPS://T.ME/+AbC/  ", "https://t.me/+AbC"),
+    ("http://telegram.me/joinchat/AbC", "https://t.me/+AbC"),
+    ("https://www.telegram.dog/somechannel#top", "https://t.me/somechannel"),
+    ("https://Example.com:443/path/?b=2&a=1&utm_source=x&fbclid=y", "https://example.com/path?a=1&b=2"),
+    ("http://example.com:80/", "http://example.com"),
+    ("http://example.com:8080/x", "http://example.com:8080/x"),
+    ("https://example.com./x?flag=", "https://example.com/x?flag="),
+])
+def test_canonical_url(raw, canonical):
+    assert main.canonical_url(raw) == canonical
+
+@pytest.mark.parametrize("raw", [
+    "", "   ", "not a link", "https://localhost/x", "ftp://example.com/x", "javascript:alert(1)",
+    "https://user:pw@example.com/", "https://example.com:99999/", "https://exa mple.com/",
+    "https://example.com/" + "a" * 600,
+])
+def test_canonical_url_rejects(raw):
+    assert main.canonical_url(raw) is None
+
+def test_recent_links_expire_after_window():
+    recent = main.RecentLinks(100)
+    recent.add("a", now=0)
+    recent.add("b", now=50)
+    assert recent.seen("a", now=99) and recent.seen("b", now=99)
+    assert not recent.seen("a", now=100)
+    assert recent.seen("b", now=100)
+    assert len(recent) == 1
+    assert not recent.seen("b", now=150)
+    assert len(recent) == 0
+
+def test_recent_links_readd_extends_window():
+    recent = main.RecentLinks(100)
+    recent.add("a", now=0)
+    recent.add("a", now=80)
+    # the stale first expiry must not drop the renewed entry
+    assert recent.seen("a", now=120)
+    assert not recent.seen("a", now=180)
+
+def test_add_links_sorts_submissions(tmp_path):
+    store = main.Store(JsonStorage(str(tmp_path / "data.json")))
+    store.ensure_user(1, "one")
+    store.ensure_user(2, "two")
+    store.add_links(2, ["https://t.me/+queued"])
+    store.recent_links.add("https://t.me/+rotated", time.time())
+
+    result = store.add_links(1, [
+        "t.me/+new", "https://t.me/+NEW2", "https://t.me/+new/", "telegram.me/joinchat/queued",
+        "https://t.me/+rotated", "nonsense", "https://t.me/+a", "https://t.me/+b", "https://t.me/+c", "https://t.me/+d",
+    ])
+    assert result == {
+        "accepted": ["https://t.me/+new", "https://t.me/+NEW2", "https://t.me/+a", "https://t.me/+b", "https://t.me/+c"],
+        "duplicate": ["https://t.me/+new", "https://t.me/+queued", "https://t.me/+rotated"],
+        "rejected": ["nonsense"],
+        "over_limit": ["https://t.me/+d"],
+    }
+    assert store.users[1].links_added == 5
+    assert [l.link for l in store.links.owner_links(1)] == result["accepted"]
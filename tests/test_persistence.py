@@ -0,0 +1,129 @@
+# tests/test_persistence.py
+# WriteBehind: group commit, requeue on failure, flush on shutdown.
+import asyncio
+import threading
+
+import pytest
+
+import main
+from storage import JsonStorage, SqliteStorage
+
+class Flaky:
+    """Backend mixin: `fail` makes the next writes raise, `gate` holds them."""
+    fail = 0
+    gate = None
+
+    def write(self, payload):
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.fail:
+            self.fail -= 1
+            raise OSError("disk full")
+        return super().write(payload)
+
+class FlakyJson(Flaky, JsonStorage):
+    pass
+
+class FlakySqlite(Flaky, SqliteStorage):
+    pass
+
+BACKENDS = {"json": (FlakyJson, JsonStorage, "data.json"), "sqlite": (FlakySqlite, SqliteStorage, "data.db")}
+
+@pytest.fixture
+def make(tmp_path, monkeypatch):
+    """make(kind, lag_ms) -> (store, persister, reopen); save_data() goes to this persister."""
+    def make(kind: str, lag_ms: int, max_pending: int = 1000):
+        flaky, plain, name = BACKENDS[kind]
+        path = str(tmp_path / name)
+        store = main.Store(flaky(path))
+        persister = main.WriteBehind(store, lag_ms, max_pending)
+        monkeypatch.setattr(main, "store", store)
+        monkeypatch.setattr(main, "persister", persister)
+        return store, persister, lambda: main.Store(plain(path))
+    return make
+
+@pytest.mark.parametrize("kind", BACKENDS)
+def test_failed_write_requeues_changes(make, kind):
+    store, persister, reopen = make(kind, lag_ms=60_000)
+
+    async def scenario():
+        store.ensure_user(1, "one")
+        store.add_links(1, ["https://t.me/kept"])
+        store.backend.fail = 1
+        with pytest.raises(OSError):
+            await persister.flush()
+        # nothing was lost: the change set is back and the state still dirty
+        assert 1 in store.changes.users
+        assert [l.link for l in store.changes.added_links] == ["https://t.me/kept"]
+        assert persister.pending and persister.flushes == 0
+        store.ensure_user(2, "two")   # merges with the requeued changes
+        await persister.flush()
+        await persister.close()
+
+    asyncio.run(scenario())
+    assert persister.flushes == 1 and persister.pending == 0
+    assert store._snapshots == 0   # snapshots released on failure and success
+    again = reopen()
+    assert sorted(again.users) == [1, 2]
+    assert [l.link for l in again.links] == ["https://t.me/kept"]
+
+@pytest.mark.parametrize("kind", BACKENDS)
+def test_close_waits_for_inflight_write(make, kind):
+    store, persister, reopen = make(kind, lag_ms=10)
+    gate = store.backend.gate = threading.Event()
+
+    async def scenario():
+        store.ensure_user(77, "first")
+        await asyncio.sleep(0.1)   # the flusher has taken it and is stuck in write()
+        assert persister._inflight is not None and not persister._inflight.done()
+        store.ensure_user(78, "second")
+        asyncio.get_running_loop().call_later(0.2, gate.set)
+        await persister.close()
+        assert persister._inflight.done()
+
+    asyncio.run(scenario())
+    assert persister.flushes == 2 and persister.pending == 0
+    assert store._snapshots == 0
+    assert sorted(reopen().users) == [77, 78]
+
+def test_failed_inflight_write_is_retried_on_close(make):
+    store, persister, reopen = make("json", lag_ms=10)
+    gate = store.backend.gate = threading.Event()
+    store.backend.fail = 1
+
+    async def scenario():
+        store.ensure_user(5, "five")
+        await asyncio.sleep(0.1)
+        asyncio.get_running_loop().call_later(0.1, gate.set)
+        await persister.close()
+
+    asyncio.run(scenario())
+    assert sorted(reopen().users) == [5]
+
+def test_zero_lag_writes_through(make):
+    store, persister, reopen = make("json", lag_ms=0)
+
+    async def scenario():
+        store.ensure_user(9, "nine")
+        # written before control ever returns to the loop
+        assert persister.flushes == 1 and persister.pending == 0
+        assert 9 in reopen().users
+        store.add_invite(9)
+        assert persister.flushes == 2
+        assert reopen().users[9].invites == 1
+        assert persister._task is None
+
+    asyncio.run(scenario())
+
+def test_max_pending_flushes_before_the_lag(make):
+    store, persister, reopen = make("sqlite", lag_ms=60_000, max_pending=3)
+
+    async def scenario():
+        for uid in (1, 2, 3):
+            store.ensure_user(uid, f"u{uid}")
+        await asyncio.sleep(0.2)
+        assert persister.flushes == 1
+        await persister.close()
+
+    asyncio.run(scenario())
+    assert sorted(reopen().users) == [1, 2, 3]
@@ -0,0 +1,72 @@
+# tests/test_ratelimit.py
+# Inbound RateLimiter: per-user and global token buckets, LRU bound.
+import pytest
+
+import main
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(main.time, "monotonic", c.monotonic)
+    return c
+
+def limiter(per_min=60, burst=3, global_rate=1000, global_burst=1000, max_buckets=100):
+    return main.RateLimiter(per_min, burst, global_rate, global_burst, max_buckets)
+
+def test_user_burst_then_refill(clock):
+    rl = limiter(per_min=60, burst=3)
+    assert [rl.check(1) for _ in range(4)] == [None, None, None, "user"]
+    assert rl.check(2) is None   # other users have their own bucket
+    clock.now += 1               # 1 token per second
+    assert rl.check(1) is None
+    assert rl.check(1) == "user"
+    clock.now += 100             # refill is capped at the burst
+    assert [rl.check(1) for _ in range(4)] == [None, None, None, "user"]
+    assert rl.throttled == {"user": 3, "global": 0}
+
+def test_global_budget(clock):
+    rl = limiter(burst=10, global_rate=2, global_burst=2)
+    assert [rl.check(uid) for uid in (1, 2, 3)] == [None, None, "global"]
+    # a globally rejected update doesn't cost the user a token
+    assert rl._buckets[3].tokens == 10
+    clock.now += 0.5
+    assert rl.check(3) is None
+    assert rl.throttled == {"user": 0, "global": 1}
+
+def test_warns_once_per_streak(clock):
+    rl = limiter(burst=1)
+    rl.check(1)
+    assert rl.check(1) == "user"
+    assert rl.should_warn(1)
+    assert rl.check(1) == "user"
+    assert not rl.should_warn(1)
+    clock.now += 1
+    assert rl.check(1) is None   # streak over
+    assert rl.check(1) == "user"
+    assert rl.should_warn(1)
+    assert not rl.should_warn(99)   # unknown user
+
+def test_buckets_are_bounded_lru(clock):
+    rl = limiter(burst=1, max_buckets=3)
+    for uid in (1, 2, 3):
+        rl.check(uid)
+    rl.check(1)          # 1 is now most recently seen
+    rl.check(4)          # evicts 2
+    assert len(rl) == 3 and 2 not in rl._buckets
+    assert rl.check(2) is None   # evicted users start with a full bucket
+    assert 3 not in rl._buckets
+
+def test_top_throttled(clock):
+    rl = limiter(burst=1)
+    for uid, extra in ((1, 1), (2, 3), (3, 0)):
+        for _ in range(1 + extra):
+            rl.check(uid)
+    assert rl.top_throttled() == [(2, 3), (1, 1)]
+    assert rl.top_throttled(1) == [(2, 3)]
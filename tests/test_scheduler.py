@@ -0,0 +1,38 @@
+# tests/test_scheduler.py
+# Rotation chat settings and scheduling.
+import json
+
+import pytest
+
+import main
+from storage import JsonStorage
+
+@pytest.fixture
+def store(tmp_path):
+    return main.Store(JsonStorage(str(tmp_path / "data.json")))
+
+@pytest.mark.parametrize("minutes", [0, -5, None, "10"])
+def test_chat_interval_must_be_positive(store, minutes):
+    with pytest.raises(ValueError):
+        main.new_chat(minutes)
+    with pytest.raises(ValueError):
+        store.update_chat("@chan", interval=minutes)
+    assert "@chan" not in store.chats
+
+def test_stored_nonpositive_interval_is_replaced(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps({
+        "settings": {"interval": 0, "chats": {"@a": dict(main.new_chat(15), interval=0), "@b": main.new_chat(15)}},
+        "links": [], "users": {}, "referrals": {},
+    }))
+    store = main.Store(JsonStorage(str(path)))
+    assert store.settings["interval"] == main.DEFAULT_INTERVAL_MIN
+    assert store.chats["@a"]["interval"] == main.DEFAULT_INTERVAL_MIN
+    assert store.chats["@b"]["interval"] == 15
+    assert store.changes.settings
+
+def test_next_due_after_never_bursts():
+    chat = main.new_chat(10)
+    assert main.next_due_after(chat, due=1000, now=1000) == 1600
+    # far behind schedule: one interval from now, not a catch-up burst
+    assert main.next_due_after(chat, due=1000, now=5000) == 5600
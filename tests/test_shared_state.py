@@ -0,0 +1,141 @@
+# tests/test_shared_state.py
+# Two Stores on one SQLite file, as two SHARED_STATE=1 workers would run:
+# changelog replay, falling back to a full reload, leader failover and
+# waiting out another worker's write lock without blocking the loop.
+import time
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+from storage import SqliteStorage, DatabaseBusy
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "data.db")
+
+def worker(db: str, pid: str) -> "main.Store":
+    backend = SqliteStorage(db)
+    store = main.Store(backend)
+    store.enable_shared(pid)
+    backend.set_busy_timeout(20)
+    return store
+
+def test_changelog_replay(db):
+    a, b = worker(db, "a"), worker(db, "b")
+    seen = []
+    b.on_remote_change = seen.append
+
+    a.ensure_user(10, "alice")
+    a.add_links(10, ["https://t.me/one", "https://t.me/two"])
+    a.update_settings(interval=45)
+    b.refresh()
+    assert b.users[10].username == "alice"
+    assert [l.link for l in b.links.owner_links(10)] == ["https://t.me/one", "https://t.me/two"]
+    assert b.settings["interval"] == 45
+    assert {"user", "link_add", "settings"} <= set(seen)
+
+    # the other direction, including a removal and a leaderboard change
+    b.ensure_user(20, "bob")
+    b.add_invite(20)
+    b.remove_user_link(10, 0)
+    a.refresh()
+    assert a.users[20].invites == 1
+    assert a.leaderboard.top()[0] == 20
+    assert [l.link for l in a.links.owner_links(10)] == ["https://t.me/two"]
+    # new ids never collide with the other worker's
+    assert a.next_link_id == b.next_link_id
+
+    # own changes are not replayed back
+    seen.clear()
+    b.update_settings(interval=50)
+    b.refresh()
+    assert seen == []
+
+def test_reload_after_changelog_pruned(db):
+    a, b = worker(db, "a"), worker(db, "b")
+    seen = []
+    b.on_remote_change = seen.append
+    a.ensure_user(1, "one")
+    b.refresh()
+    seen.clear()
+
+    a.ensure_user(2, "two")
+    a.add_links(2, ["https://t.me/pruned"])
+    a.add_invite(2)
+    a.backend.prune_changelog(1)   # b's position is gone from the log
+    b.refresh()
+    assert set(b.users) == {1, 2}
+    assert b.users[2].invites == 1
+    assert [l.link for l in b.links.owner_links(2)] == ["https://t.me/pruned"]
+    assert seen == ["settings", "link_add"]
+    assert b._seq == a.backend.changelog_bounds()[1]
+
+    # and replay carries on normally from there
+    a.ensure_user(3, "three")
+    b.refresh()
+    assert 3 in b.users
+
+def test_leader_failover(db):
+    a, b = SqliteStorage(db), SqliteStorage(db)
+    ttl = 0.3
+    la, lb = main.LeaderLease(a, "a", ttl), main.LeaderLease(b, "b", ttl)
+    events = []
+
+    async def demoted(name):
+        events.append(("demoted", name))
+
+    async def scenario():
+        ta = asyncio.create_task(la.run(lambda: events.append(("elected", "a")), lambda: demoted("a")))
+        await asyncio.sleep(0.05)
+        tb = asyncio.create_task(lb.run(lambda: events.append(("elected", "b")), lambda: demoted("b")))
+        await asyncio.sleep(ttl)
+        assert la.is_leader and not lb.is_leader
+        # the leader dies without releasing its lease: b takes over once it expires
+        ta.cancel()
+        await asyncio.gather(ta, return_exceptions=True)
+        await asyncio.sleep(ttl * 2)
+        assert lb.is_leader
+        tb.cancel()
+        await asyncio.gather(tb, return_exceptions=True)
+
+    asyncio.run(scenario())
+    assert events == [("elected", "a"), ("demoted", "a"), ("elected", "b"), ("demoted", "b")]
+
+def test_mutation_waits_for_write_lock_off_the_loop(db):
+    a = worker(db, "a")
+    other = sqlite3.connect(db, isolation_level=None)
+
+    async def scenario():
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        t = asyncio.create_task(ticker())
+        other.execute("BEGIN IMMEDIATE")
+        asyncio.get_running_loop().call_later(0.3, other.execute, "COMMIT")
+        started = time.monotonic()
+        await main.mutate(a.update_settings, interval=15)
+        waited = time.monotonic() - started
+        t.cancel()
+        return waited, ticks
+
+    waited, ticks = asyncio.run(scenario())
+    assert waited >= 0.25
+    assert ticks >= 15   # the loop kept running while the write waited
+    assert a.settings["interval"] == 15
+    assert a._txn_depth == 0
+
+    # a lock that is never released surfaces as DatabaseBusy, state untouched
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(DatabaseBusy):
+            a.update_settings(interval=99)
+        assert a._txn_depth == 0
+        assert a.settings["interval"] == 15
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
@@ -0,0 +1,149 @@
+# tests/test_storage.py
+# Storage backends: loading and converting a legacy data.json, and the
+# binary snapshot format.
+import os
+import json
+
+import pytest
+
+import main
+from records import User
+from storage import (open_storage, migrate_json_to_sqlite, convert_json_to_snapshot, empty_state,
+                     write_snapshot, JsonStorage, SnapshotStorage, MappedSnapshot)
+
+# data.json as written before the rotation scheduler: one target chat plus a
+# global running flag in settings
+LEGACY = {
+    "settings": {"interval": 20, "chat_id": "@chan", "running": True, "rotation_index": 3, "last_link": None},
+    "links": [
+        {"link": "https://t.me/a", "owner_id": 5, "owner_username": "u5", "added_at": "2024-01-01T00:00:00"},
+        {"link": "https://t.me/b", "owner_id": 6, "owner_username": "u6", "added_at": "2024-01-02T00:00:00"},
+    ],
+    "users": {
+        "5": {"username": "u5", "token": "tok5", "invites": 2, "links_added": 1, "limit": 3},
+        "6": {"username": "u6", "token": "tok6", "invites": 0, "links_added": 1, "limit": 1},
+    },
+    "referrals": {"tok5": 5, "tok6": 6},
+}
+
+@pytest.fixture
+def legacy_json(tmp_path):
+    path = tmp_path / "data.json"
+    path.write_text(json.dumps(LEGACY))
+    return str(path)
+
+def open_legacy(backend: str, legacy_json: str, tmp_path):
+    db, snap = str(tmp_path / "data.db"), str(tmp_path / "data.snap")
+    if backend == "sqlite":
+        migrate_json_to_sqlite(legacy_json, db)
+    elif backend == "snapshot":
+        convert_json_to_snapshot(legacy_json, snap)
+    return open_storage(backend, legacy_json, db, snap)
+
+@pytest.mark.parametrize("backend", ["json", "sqlite", "snapshot"])
+def test_legacy_chat_survives_upgrade(backend, legacy_json, tmp_path):
+    store = main.Store(open_legacy(backend, legacy_json, tmp_path))
+    assert list(store.chats) == ["@chan"]
+    chat = store.chats["@chan"]
+    assert chat["interval"] == 20 and chat["paused"] is False
+    for key in ("chat_id", "running", "rotation_index"):
+        assert key not in store.settings
+    assert store.changes.settings
+
+    # once written back, the next start sees the upgraded settings as they are
+    backend_obj = store.backend
+    backend_obj.write(backend_obj.capture(store.snapshot(), store.take_changes()))
+    store.release_snapshot()
+    again = main.Store(open_storage(backend, legacy_json, str(tmp_path / "data.db"), str(tmp_path / "data.snap")))
+    assert again.chats == store.chats
+    assert not again.changes.settings
+    assert sorted(again.users) == [5, 6]
+    assert [l.link for l in again.links] == ["https://t.me/a", "https://t.me/b"]
+
+# --- binary snapshot (data.snap) ---
+def dump(store: "main.Store"):
+    """Everything the snapshot format persists, as plain values."""
+    users = {uid: (u.username, u.token, u.invites, u.links_added, u.limit, u.interval) for uid, u in store.users.items()}
+    links = [(l.id, l.link, l.owner_id, l.added_at) for l in store.links]
+    return store.settings, links, users, dict(store.state["referrals"].items())
+
+def persist(store: "main.Store"):
+    snap = store.snapshot()
+    try:
+        store.backend.write(store.backend.capture(snap, store.take_changes()))
+    finally:
+        store.release_snapshot()
+
+def test_snapshot_round_trip_after_mutations(tmp_path):
+    path, missing_json = str(tmp_path / "data.snap"), str(tmp_path / "none.json")
+    store = main.Store(SnapshotStorage(path, missing_json))
+    for uid in (500, 100, 300):
+        store.ensure_user(uid, f"user{uid}")
+    store.add_links(100, ["https://t.me/first", "https://t.me/second"])
+    store.add_invite(300)
+    store.set_user_interval(300, 15)
+    store.update_chat("@chan", interval=10, paused=False)
+    persist(store)
+
+    again = main.Store(SnapshotStorage(path, missing_json))
+    assert dump(again) == dump(store)
+    assert again.users.decoded == 0   # nothing decoded until asked for
+
+    # change users that only live in the file, plus ones it has never seen:
+    # ids below, between and above the stored ones, unicode and empty names
+    again.ensure_user(300, "renamed")
+    again.add_invite(500)
+    for uid, name in ((50, "ünïcode 名前"), (200, None), (10**12, "big")):
+        again.ensure_user(uid, name)
+    again.add_links(200, ["https://t.me/third"])
+    again.remove_user_link(100, 0)
+    persist(again)
+    # a second write from the same store still merges file records and new ones
+    again.add_invite(50)
+    again.ensure_user(400, "late")
+    persist(again)
+
+    reopened = main.Store(SnapshotStorage(path, missing_json))
+    assert dump(reopened) == dump(again)
+    assert sorted(reopened.users) == [50, 100, 200, 300, 400, 500, 10**12]
+    assert reopened.users[300].username == "renamed" and reopened.users[300].interval == 15
+    assert reopened.users[50].invites == 1 and reopened.users[200].username == ""
+    for token, uid in again.state["referrals"].items():
+        assert reopened.referrer_of(token) == uid
+    assert reopened.referrer_of("no-such-token") is None
+    assert [l.link for l in reopened.links] == ["https://t.me/second", "https://t.me/third"]
+    assert reopened.next_link_id == again.next_link_id
+
+def test_snapshot_lookups_by_binary_search(tmp_path):
+    path = str(tmp_path / "data.snap")
+    ids = list(range(3, 3000, 7))
+    state = empty_state()
+    state["users"] = {uid: User(f"u{uid}", f"t{uid:05d}", uid % 11, 1, 5, None) for uid in ids}
+    state["referrals"] = {f"t{uid:05d}": uid for uid in ids}
+    write_snapshot(path, state)
+    snap = MappedSnapshot(path)
+    for uid in ids:
+        u = snap.find_user(uid)
+        assert (u.username, u.token, u.invites) == (f"u{uid}", f"t{uid:05d}", uid % 11)
+        assert snap.find_referral(f"t{uid:05d}") == uid
+    for uid in (0, 4, 3000, 10**9, -1):
+        assert snap.find_user(uid) is None
+    for token in ("", "t", "t00000", "t99999", "zzz"):
+        assert snap.find_referral(token) is None
+
+def test_convert_legacy_json_to_snapshot(legacy_json, tmp_path):
+    path = str(tmp_path / "data.snap")
+    assert convert_json_to_snapshot(legacy_json, path) == {"users": 2, "links": 2, "referrals": 2}
+    from_json = main.Store(JsonStorage(legacy_json))
+    from_snap = main.Store(SnapshotStorage(path, legacy_json))
+    assert dump(from_snap) == dump(from_json)
+    # the conversion assigned link ids; they survive and new ones continue after them
+    assert [l.id for l in from_snap.links] == [1, 2]
+    assert from_snap.next_link_id == 3
+
+def test_snapshot_storage_converts_data_json_on_first_start(legacy_json, tmp_path):
+    path = str(tmp_path / "data.snap")
+    store = main.Store(SnapshotStorage(path, legacy_json))
+    assert os.path.exists(path)
+    assert sorted(store.users) == [5, 6]
+    assert store.referrer_of("tok5") == 5
@@ -0,0 +1,37 @@
+# tests/test_webhook.py
+# Webhook route and the update queue behind it.
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "ingest", main.UpdateIngest(10, 1, 100, 0.01))
+    # no `with`: the app's startup hooks would start the bot
+    return TestClient(main.app)
+
+@pytest.mark.parametrize("body", [b"not json", b"[1, 2]", b"42", b'"text"', b"null"])
+def test_webhook_rejects_non_update_bodies(client, body):
+    r = client.post(main.WEBHOOK_PATH, content=body, headers={"Content-Type": "application/json"})
+    assert r.status_code == 400
+    assert main.ingest.queue.qsize() == 0
+
+def test_webhook_queues_update_once(client):
+    for _ in range(2):
+        assert client.post(main.WEBHOOK_PATH, json={"update_id": 7}).status_code == 200
+    assert main.ingest.queue.qsize() == 1
+    assert main.ingest.duplicates == 1
+
+def test_ingest_full_queue_answers_503():
+    async def scenario():
+        ingest = main.UpdateIngest(1, 1, 100, 0.01)
+        assert await ingest.put({"update_id": 1}) == 200
+        assert await ingest.put({"update_id": 2}) == 503
+        # not remembered, so Telegram's redelivery is accepted once there is room
+        ingest.queue.get_nowait()
+        assert await ingest.put({"update_id": 2}) == 200
+        return ingest.rejected
+    assert asyncio.run(scenario()) == 1